@@ -1,9 +1,532 @@
-from contextlib import asynccontextmanager
-from sqlalchemy.ext.asyncio import create_async_engine
+import asyncio
+import contextvars
+import inspect as pyinspect
+from itertools import chain
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AsyncExitStack, asynccontextmanager, suppress
+from functools import partial
+import os
+import time
+from sqlalchemy import create_engine, event, make_url
+from sqlalchemy.exc import DBAPIError, InvalidRequestError
+from sqlalchemy.engine import CursorResult
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.asyncio import async_sessionmaker  # only in 2.0+
+from sqlalchemy.orm import sessionmaker
 from sqlalchemy.util.concurrency import greenlet_spawn
 from .core import BaseAlchemical, Alchemical as SyncAlchemical, \
-    Model  # noqa: F401
+    HealthChecker as SyncHealthChecker, PoolSizer as SyncPoolSizer, \
+    Model, StatementTimeout, StatementLog, DUMP_FORMATS, _TableCopy, \
+    _concat_column_batches, _iter_column_batches, \
+    _dump_tables, \
+    _export_snapshot, _get_dump_groups, _get_dump_jobs, _get_load_plan, \
+    _get_ready_tables, _get_restore_sources, _load_table, \
+    _write_manifest, \
+    AlchemicalSession, DatabaseTiming, check_pool, is_transient_error, \
+    logger, request_deadline, retry_delay, track_database_time  # noqa: F401
+
+
+class HealthChecker:
+    """Background task that checks the idle connections of an engine.
+
+    :param engine: the engine to check.
+    :param interval: the number of seconds between checks.
+    :param min_idle: the minimum number of idle connections to keep in the
+                     pool.
+    :param max_checks: the maximum number of connections to ping in each
+                       check.
+
+    Instances of this class are created by Alchemical when the
+    ``health_check_options`` argument is given. The task runs on the event
+    loop that is active when the database engines are created.
+    """
+    def __init__(self, engine, interval=30, min_idle=0, max_checks=10):
+        self.engine = engine
+        self.interval = interval
+        self.min_idle = min_idle
+        self.max_checks = max_checks
+        self.invalidated = 0
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.invalidated += await greenlet_spawn(
+                    check_pool, self.engine.sync_engine, self.min_idle,
+                    self.max_checks)
+            except Exception:  # pragma: no cover
+                logger.exception('Connection health check failed')
+
+    def stop(self):
+        """Stop the health checker."""
+        if not self.task.get_loop().is_closed():
+            self.task.cancel()
+
+
+class PoolSizer(SyncPoolSizer):
+    """Background task that adapts the size of the connection pool of an
+    engine to its load.
+
+    This class accepts the same arguments and uses the same sizing policy as
+    :class:`alchemical.core.PoolSizer`. Instances of this class are created
+    by Alchemical when the ``pool_sizing_options`` argument is given. The
+    task runs on the event loop that is active when the database engines are
+    created.
+    """
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await greenlet_spawn(self.adjust)
+            except Exception:  # pragma: no cover
+                logger.exception('Connection pool adjustment failed')
+
+    def stop(self):
+        """Stop the pool sizer."""
+        if not self.task.get_loop().is_closed():
+            self.task.cancel()
+        self._remove_instrumentation()
+
+
+_cleanup_tasks = set()
+
+
+class CleanupMixin:
+    """Cancellation-safe cleanup methods for asynchronous sessions."""
+    async def safe_close(self, rollback=False):
+        """Roll back (optionally) and close the session, shielding these
+        operations from cancellation.
+
+        :param rollback: if ``True``, the session is rolled back before it is
+                         closed.
+
+        If the calling task is cancelled while the cleanup is in progress, the
+        cleanup continues in the background and the cancellation is propagated
+        to the caller. If the cleanup does not complete within the cleanup
+        timeout, it is abandoned and the connections held by the session are
+        invalidated, since their state is unknown. The ``cancelled``,
+        ``timed_out`` and ``invalidated`` keys of the cleanup stats counter
+        record how often these situations occur.
+        """
+        async def cleanup():
+            if rollback:
+                await self.rollback()
+            await self.close()
+
+        task = asyncio.ensure_future(cleanup())
+        try:
+            await asyncio.wait_for(asyncio.shield(task), self.cleanup_timeout)
+        except asyncio.CancelledError:
+            self.cleanup_stats['cancelled'] += 1
+            background = asyncio.ensure_future(self._finish_cleanup(task))
+            _cleanup_tasks.add(background)
+            background.add_done_callback(_cleanup_tasks.discard)
+            raise
+        except asyncio.TimeoutError:
+            await self._abandon_cleanup(task)
+
+    async def safe_invalidate(self):
+        """Close the session, invalidating its connections.
+
+        This is used when the state of the connections is unknown, for example
+        when a commit is interrupted. The invalidation is shielded from
+        cancellation.
+        """
+        self.cleanup_stats['invalidated'] += 1
+        task = asyncio.ensure_future(self.invalidate())
+        try:
+            await asyncio.wait_for(asyncio.shield(task), self.cleanup_timeout)
+        except asyncio.TimeoutError:  # pragma: no cover
+            logger.error('Session invalidation did not complete in time')
+
+    async def _finish_cleanup(self, task):
+        try:
+            await asyncio.wait_for(asyncio.shield(task), self.cleanup_timeout)
+        except asyncio.TimeoutError:
+            await self._abandon_cleanup(task)
+
+    async def _abandon_cleanup(self, task):
+        self.cleanup_stats['timed_out'] += 1
+        task.cancel()
+        with suppress(asyncio.CancelledError, Exception):
+            await task
+        await self.safe_invalidate()
+
+
+class AlchemicalAsyncSession(CleanupMixin, AsyncSession):
+    """The asynchronous session class used by Alchemical.
+
+    :param cleanup_timeout: the maximum number of seconds that a rollback or
+                            close operation is allowed to take when the
+                            session is released.
+    :param cleanup_stats: a ``Counter`` instance where cleanup problems are
+                          recorded.
+
+    All other arguments are passed to the SQLAlchemy ``AsyncSession`` class.
+    When the session is used as a context manager, it is closed with
+    :func:`safe_close`, which protects the cleanup from task cancellation.
+    """
+    sync_session_class = AlchemicalSession
+
+    def __init__(self, *args, cleanup_timeout=5, cleanup_stats=None,
+                 **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cleanup_timeout = cleanup_timeout
+        self.cleanup_stats = cleanup_stats if cleanup_stats is not None \
+            else Counter()
+
+    async def __aexit__(self, type_, value, traceback):
+        await self.safe_close()
+
+
+class ThreadBridge:
+    """A bounded set of worker threads that run blocking database work.
+
+    :param size: the number of worker threads.
+
+    Each worker is a single-threaded executor, so that all the work done for a
+    session runs in the same thread.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.executors = [
+            ThreadPoolExecutor(max_workers=1,
+                               thread_name_prefix='alchemical-bridge')
+            for _ in range(size)]
+        self.idle = None
+
+    async def acquire(self):
+        """Reserve a worker. If all the workers are in use, wait for one to
+        be released."""
+        if self.idle is None:
+            self.idle = asyncio.Queue()
+            for executor in self.executors:
+                self.idle.put_nowait(executor)
+        return await self.idle.get()
+
+    def release(self, executor):
+        """Return a worker obtained with :func:`acquire`."""
+        self.idle.put_nowait(executor)
+
+    async def run(self, executor, f, *args, **kwargs):
+        """Run a function in the given worker."""
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(
+            executor, partial(context.run, f, *args, **kwargs))
+
+    def shutdown(self):
+        for executor in self.executors:
+            executor.shutdown(wait=False)
+
+
+def _buffer_result(result):
+    # the rows of ORM queries are buffered with the prebuffer_rows option, and
+    # those of other statements are fetched here, in the worker thread
+    if isinstance(result, CursorResult) and result.returns_rows:
+        return result.freeze()()
+    return result
+
+
+class BridgedTransaction:
+    """A transaction of a :class:`BridgedAsyncSession`.
+
+    The transaction starts when it is awaited or used as an asynchronous
+    context manager.
+    """
+    def __init__(self, session, nested=False):
+        self.session = session
+        self.nested = nested
+        self.sync_transaction = None
+
+    def __await__(self):
+        return self.start().__await__()
+
+    async def start(self):
+        self.sync_transaction = await self.session.run_sync(
+            lambda sync_session: sync_session.begin_nested() if self.nested
+            else sync_session.begin())
+        return self
+
+    async def commit(self):
+        await self.session.run_sync(
+            lambda sync_session: self.sync_transaction.commit())
+
+    async def rollback(self):
+        await self.session.run_sync(
+            lambda sync_session: self.sync_transaction.rollback())
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, type_, value, traceback):
+        if type_ is None and self.sync_transaction.is_active:
+            await self.commit()
+        elif self.sync_transaction.is_active:
+            await self.rollback()
+
+
+class BridgedAsyncResult:
+    """A streaming result of a :class:`BridgedAsyncSession`.
+
+    :param session: the session that owns the result.
+    :param result: the synchronous result.
+    :param batch_size: the number of rows fetched at a time when the result
+                       is iterated.
+
+    The rows are fetched from the database cursor in the worker thread of the
+    session, in batches. This class provides the fetching methods of the
+    SQLAlchemy ``AsyncResult`` class as coroutines, and its filtering methods,
+    such as ``scalars()``, return a new instance of this class.
+    """
+    _filters = {'columns', 'mappings', 'scalars', 'unique'}
+
+    def __init__(self, session, result, batch_size=1000):
+        self.session = session
+        self.result = result
+        self.batch_size = batch_size
+        self.rows = deque()
+
+    def __getattr__(self, name):
+        attr = getattr(self.result, name)
+        if name in self._filters:
+            return lambda *args, **kwargs: BridgedAsyncResult(
+                self.session, attr(*args, **kwargs), self.batch_size)
+        if name.startswith('_') or not callable(attr) or name == 'keys':
+            return attr
+
+        async def fetch(*args, **kwargs):
+            return await self.session.run_sync(
+                lambda sync_session: attr(*args, **kwargs))
+
+        return fetch
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.rows:
+            self.rows.extend(await self.session.run_sync(
+                lambda sync_session: self.result.fetchmany(self.batch_size)))
+            if not self.rows:
+                raise StopAsyncIteration()
+        return self.rows.popleft()
+
+    async def partitions(self, size=None):
+        """Iterate over batches of rows, fetched in the worker thread.
+
+        Note: this method is an asynchronous generator.
+        """
+        while True:
+            rows = await self.session.run_sync(
+                lambda sync_session: self.result.fetchmany(
+                    size or self.batch_size))
+            if not rows:
+                break
+            yield rows
+
+
+def _check_bridged_load(orm_execute_state):
+    # queries of bridged sessions must run in a worker thread, not in the
+    # thread of the event loop
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    raise InvalidRequestError(
+        'The session cannot run queries in the thread of the event loop. Use '
+        'run_sync(), or load the attributes eagerly.')
+
+
+class BridgedAsyncSession(CleanupMixin):
+    """Asynchronous session for databases that do not have an asyncio driver.
+
+    :param bridge: the :class:`ThreadBridge` instance that runs the database
+                   work.
+    :param session_factory: the factory that creates the synchronous session.
+    :param cleanup_timeout: the maximum number of seconds that a rollback or
+                            close operation is allowed to take when the
+                            session is released.
+    :param cleanup_stats: a ``Counter`` instance where cleanup problems are
+                          recorded.
+
+    All other arguments are passed to the synchronous session. This class
+    provides the interface of the SQLAlchemy ``AsyncSession`` class on top of
+    a synchronous session. The database work for the session runs in a worker
+    thread that is reserved for the session until it is closed, and the
+    methods that are coroutines in ``AsyncSession`` run the method of the
+    same name of the synchronous session in that thread. The results of
+    ``execute()`` are buffered in the worker thread, while ``stream()``
+    returns a :class:`BridgedAsyncResult` that fetches its rows in batches.
+    Lazy loads and loads of expired attributes are not allowed outside of
+    :func:`run_sync`, and raise ``InvalidRequestError``.
+    """
+    def __init__(self, bridge, session_factory, cleanup_timeout=5,
+                 cleanup_stats=None, **kwargs):
+        self.bridge = bridge
+        self.sync_session = session_factory(**kwargs)
+        self.cleanup_timeout = cleanup_timeout
+        self.cleanup_stats = cleanup_stats if cleanup_stats is not None \
+            else Counter()
+        self.executor = None
+        event.listen(self.sync_session, 'do_orm_execute', _check_bridged_load)
+
+    def __getattr__(self, name):
+        if name == 'sync_session':
+            raise AttributeError(name)
+        attr = getattr(self.sync_session, name)
+        if not pyinspect.iscoroutinefunction(getattr(AsyncSession, name,
+                                                     None)):
+            return attr  # attributes and methods that do not use the database
+
+        async def method(*args, **kwargs):
+            return await self.run_sync(
+                lambda sync_session: getattr(sync_session, name)(
+                    *args, **kwargs))
+
+        return method
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type_, value, traceback):
+        await self.safe_close()
+
+    async def run_sync(self, f, *args, **kwargs):
+        """Run a function that receives the synchronous session as first
+        argument in the worker thread of this session."""
+        if self.executor is None:
+            self.executor = await self.bridge.acquire()
+        return await self.bridge.run(self.executor, f, self.sync_session,
+                                     *args, **kwargs)
+
+    def begin(self):
+        return BridgedTransaction(self)
+
+    def begin_nested(self):
+        return BridgedTransaction(self, nested=True)
+
+    async def execute(self, statement, params=None, execution_options=None,
+                      **kwargs):
+        execution_options = {**(execution_options or {}),
+                             'prebuffer_rows': True}
+        return await self.run_sync(lambda sync_session: _buffer_result(
+            sync_session.execute(statement, params,
+                                 execution_options=execution_options,
+                                 **kwargs)))
+
+    async def scalars(self, *args, **kwargs):
+        return (await self.execute(*args, **kwargs)).scalars()
+
+    async def stream(self, statement, params=None, execution_options=None,
+                     **kwargs):
+        execution_options = {**(execution_options or {}),
+                             'stream_results': True}
+        result = await self.run_sync(
+            lambda sync_session: sync_session.execute(
+                statement, params, execution_options=execution_options,
+                **kwargs))
+        return BridgedAsyncResult(self, result, batch_size=execution_options
+                                  .get('yield_per') or 1000)
+
+    async def stream_scalars(self, *args, **kwargs):
+        return (await self.stream(*args, **kwargs)).scalars()
+
+    async def close(self):
+        await self._release(lambda sync_session: sync_session.close())
+
+    async def invalidate(self):
+        await self._release(lambda sync_session: sync_session.invalidate())
+
+    async def reset(self):
+        await self._release(lambda sync_session: sync_session.reset())
+
+    async def _release(self, f):
+        if self.executor is None:
+            return await asyncio.get_running_loop().run_in_executor(
+                None, f, self.sync_session)
+        try:
+            await self.run_sync(f)
+        finally:
+            self.bridge.release(self.executor)
+            self.executor = None
+
+
+class TimeoutMiddleware:
+    """ASGI middleware that sets a time budget for the database work done by
+    each request.
+
+    :param app: the ASGI application.
+    :param timeout: the number of seconds that the database sessions created
+                    while handling a request are allowed to run statements,
+                    counting from the start of the request.
+
+    Example::
+
+        app = FastAPI()
+        app.add_middleware(TimeoutMiddleware, timeout=10)
+    """
+    def __init__(self, app, timeout):
+        self.app = app
+        self.timeout = timeout
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        token = request_deadline.set(time.monotonic() + self.timeout)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            request_deadline.reset(token)
+
+
+class ServerTimingMiddleware:
+    """ASGI middleware that adds a ``Server-Timing`` header with the database
+    timings of each request.
+
+    :param app: the ASGI application.
+    :param callback: an optional function that is called at the end of each
+                     request with the ASGI scope and the
+                     :class:`~alchemical.core.DatabaseTiming` instance of the
+                     request, for example to add the timings to an access
+                     log.
+
+    The database instance must be created with the ``timing`` option enabled.
+    The header reports the statement, connection checkout and commit times of
+    each database used by the request.
+
+    Example::
+
+        db = Alchemical('sqlite:///app.db', timing=True)
+        app = FastAPI()
+        app.add_middleware(ServerTimingMiddleware)
+    """
+    def __init__(self, app, callback=None):
+        self.app = app
+        self.callback = callback
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        async def send_with_timing(message):
+            if message['type'] == 'http.response.start' and timing.binds:
+                message = dict(message, headers=[
+                    *message.get('headers', []),
+                    (b'server-timing', timing.server_timing().encode()),
+                ])
+            await send(message)
+
+        with track_database_time() as timing:
+            try:
+                await self.app(scope, receive, send_with_timing)
+            finally:
+                if self.callback:
+                    self.callback(scope, timing)
 
 
 class Alchemical(BaseAlchemical):
@@ -26,14 +549,52 @@ class Alchemical(BaseAlchemical):
                               the SQLAlchemy documentation is used by default.
                               Pass an empty dictionary to disable naming
                               conventions.
+    :param health_check_options: a dictionary with options for a background
+                                 task that pings the idle connections in the
+                                 pool and discards those that are dead. The
+                                 ``interval`` option sets the number of
+                                 seconds between checks, and ``min_idle``
+                                 the number of idle connections to keep in the
+                                 pool. A function that accepts a bind key and
+                                 returns the options for that bind (or
+                                 ``None`` to disable the checker) can also be
+                                 given.
+    :param timing: set to ``True`` to record the time spent in the database,
+                   which can then be obtained with the
+                   :func:`~alchemical.core.track_database_time` context
+                   manager or the :class:`ServerTimingMiddleware`.
+    :param pool_sizing_options: a dictionary with options for a background
+                                task that grows and shrinks the connection
+                                pool according to its load. The
+                                ``min_size`` and ``max_size`` options set the
+                                limits of the pool size, ``interval`` the
+                                number of seconds between adjustments, and
+                                ``target_wait`` the longest acceptable wait
+                                for a connection in seconds. A function that
+                                accepts a bind key and returns the options
+                                for that bind (or ``None`` to use a fixed
+                                size) can also be given. See
+                                :class:`PoolSizer` for details.
 
     The database instances can be initialized in two phases, in which case the
     :func:`Alchemical.initialize` method must be called later to complete the
     initialization. Note that the `model_class` and `naming_convention`
     arguments can only be passed in this first phase, while the remaining
     arguments can be passed in either phase.
+
+    If any of the database URLs use a driver that does not support asyncio,
+    the databases are accessed with their synchronous drivers through a
+    :class:`ThreadBridge`, which runs the database work of each session in a
+    worker thread. The number of worker threads matches the size of the
+    connection pool, and the sessions provide the interface of the SQLAlchemy
+    ``AsyncSession`` class. In this mode, the URLs that select an asyncio
+    driver use the default synchronous driver of their database instead.
     """
 
+    #: The maximum number of seconds that the rollback and close operations
+    #: that release a session are allowed to take.
+    cleanup_timeout = 5
+
     prefix_map = {
         'sqlite': 'sqlite+aiosqlite',
         'mysql': 'mysql+aiomysql',
@@ -43,15 +604,23 @@ class Alchemical(BaseAlchemical):
 
     def __init__(self, url=None, binds=None, engine_options=None,
                  session_options=None, model_class=None,
-                 naming_convention=None):
+                 naming_convention=None, health_check_options=None,
+                 timing=False, pool_sizing_options=None):
+        self._bridged = False
+        self.bridge = None
         super().__init__(url=url, binds=binds, engine_options=engine_options,
                          session_options=session_options,
                          model_class=model_class,
-                         naming_convention=naming_convention)
+                         naming_convention=naming_convention,
+                         health_check_options=health_check_options,
+                         timing=timing,
+                         pool_sizing_options=pool_sizing_options)
         self._sync = None
+        self.cleanup_stats = Counter()
 
     def initialize(self, url=None, binds=None, engine_options=None,
-                   session_options=None):
+                   session_options=None, health_check_options=None,
+                   timing=False, pool_sizing_options=None):
         """Initialize the database instance.
 
         :param url: the database URL.
@@ -63,17 +632,78 @@ class Alchemical(BaseAlchemical):
                                pass to SQLAlchemy.
         :param session_options: a dictionary with additional session options to
                                 use when creating sessions.
+        :param health_check_options: a dictionary with options for the
+                                     background connection health checker.
+        :param timing: set to ``True`` to record database timings.
+        :param pool_sizing_options: a dictionary with options for the
+                                    adaptive sizing of the connection pools.
 
         This method must be called explicitly to complete the initialization of
         the instance the two-phase initialization method is used.
         """
         super().initialize(url, binds=binds, engine_options=engine_options,
-                           session_options=session_options)
+                           session_options=session_options,
+                           health_check_options=health_check_options,
+                           timing=timing,
+                           pool_sizing_options=pool_sizing_options)
         self._sync = None
+        if self.bridge is not None:
+            self.bridge.shutdown()
+        self._bridged = False
+        self.bridge = None
+
+    def _reset_after_fork(self):
+        super()._reset_after_fork()
+        self._sync = None
+        if self.bridge is not None:
+            # worker threads do not survive a fork
+            self.bridge = ThreadBridge(self.bridge.size)
+
+    def _create_engines(self):
+        # when any of the databases lack an asyncio driver they are all
+        # accessed through a thread bridge, and all the engines are
+        # synchronous
+        urls = [self._fix_url(url, self.prefix_map)
+                for url in [self.url, *(self.binds or {}).values()] if url]
+        self._bridged = not all(
+            make_url(url).get_dialect().is_async for url in urls)
+        super()._create_engines()
+        if self._bridged and self.bridge is None:
+            self.bridge = ThreadBridge(max(
+                self._get_pool_capacity(engine.pool)
+                for engine in self.engines.values()))
+
+    def _fix_url(self, url, prefix_map=None):
+        if prefix_map is None and self._bridged:
+            prefix_map = SyncAlchemical.prefix_map
+        return super()._fix_url(url, prefix_map=prefix_map)
 
     def _create_engine(self, url, *args, **kwargs):
+        if self._bridged:
+            url = make_url(url)
+            if url.get_dialect().is_async:
+                url = url.set(drivername=url.get_backend_name())
+            return create_engine(url, *args, **kwargs)
         return create_async_engine(url, *args, **kwargs)
 
+    def _create_health_checker(self, engine, **options):
+        if self._bridged:
+            return SyncHealthChecker(engine, **options)
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return None  # the checker is started later from a coroutine
+        return HealthChecker(engine, **options)
+
+    def _create_pool_sizer(self, engine, **options):
+        if self._bridged:
+            return SyncPoolSizer(engine, **options)
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return None  # the sizer is started later from a coroutine
+        return PoolSizer(engine, **options)
+
     async def create_all(self):
         """Create the database tables.
 
@@ -100,6 +730,254 @@ class Alchemical(BaseAlchemical):
 
         await self.run_sync(sync_drop_all)
 
+    async def load_data(self, source, model=None, format=None,
+                        batch_size=1000, parallel=False, workers=None):
+        """Load data from a file into one or more tables.
+
+        :param source: the data to load. This can be the path to a file, a
+                       text file object, or an iterable of dictionaries. To
+                       load several tables, pass a dictionary with model
+                       classes as keys and any of the above as values.
+        :param model: the model class of the table to load, when ``source``
+                      is not a dictionary.
+        :param format: ``'jsonl'`` or ``'csv'``. The default is to use the
+                       extension of the file name.
+        :param batch_size: the number of rows to insert in each batch.
+        :param parallel: if ``True``, tables that do not depend on each other
+                         are loaded at the same time.
+        :param workers: the maximum number of tables to load at the same time
+                        in parallel mode.
+
+        See :func:`alchemical.Alchemical.load_data` for details.
+
+        Note: this method is a coroutine.
+        """
+        if not parallel:
+            def sync_load_data(sync_db):
+                return sync_db.load_data(source, model=model, format=format,
+                                         batch_size=batch_size)
+
+            return await self.run_sync(sync_load_data)
+
+        sources, order, dependencies = _get_load_plan(source, model)
+        self.get_engine()  # this makes sure engines are created
+        if workers is None:
+            workers = min(self._get_pool_capacity(engine.pool)
+                          for engine in self.engines.values())
+        semaphore = asyncio.Semaphore(workers)
+
+        async def load(table):
+            def sync_load(sync_db):
+                with sync_db._get_table_engine(table).begin() as conn:
+                    return _load_table(conn, table, sources[table], format,
+                                       batch_size)
+
+            async with semaphore:
+                return await self.run_sync(sync_load)
+
+        counts = {}
+        pending = list(order)
+        running = {}
+        try:
+            while pending or running:
+                for table in _get_ready_tables(pending, running.values(),
+                                               dependencies):
+                    pending.remove(table)
+                    running[asyncio.ensure_future(load(table))] = table
+                done, _ = await asyncio.wait(
+                    running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    counts[running.pop(task).name] = task.result()
+        finally:
+            if running:
+                await asyncio.gather(*running, return_exceptions=True)
+        return {table.name: counts[table.name] for table in order}
+
+    async def dump(self, directory, binds=None, tables=None, format='jsonl',
+                   batch_size=1000, workers=None, consistent=True):
+        """Write the contents of the database tables to compressed files.
+
+        :param directory: the directory where the files are written.
+        :param binds: a list with the binds to dump. Use ``None`` for the
+                      default database.
+        :param tables: a list with the models, tables or table names to dump.
+        :param format: ``'jsonl'`` or ``'csv'``.
+        :param batch_size: the number of rows to read from the database
+                           cursor at a time.
+        :param workers: the maximum number of tables to dump at the same
+                        time.
+        :param consistent: if ``True``, the tables of each bind are dumped
+                           from the same snapshot of the database.
+
+        See :func:`alchemical.Alchemical.dump` for details.
+
+        Note: this method is a coroutine.
+        """
+        if format not in DUMP_FORMATS:
+            raise ValueError(f'Unsupported format: {format}')
+        groups = _get_dump_groups(self.metadatas, binds, tables)
+        self.get_engine()  # this makes sure engines are created
+        if workers is None:
+            workers = max(min(self._get_pool_capacity(engine.pool)
+                              for engine in self.engines.values()) - 1, 1)
+        os.makedirs(directory, exist_ok=True)
+        semaphore = asyncio.Semaphore(workers)
+        snapshot_connections = []
+
+        async def dump_tables(bind_key, tables, snapshot):
+            def sync_dump_tables(sync_db):
+                return _dump_tables(sync_db.get_engine(bind_key), bind_key,
+                                    tables, snapshot, directory, format,
+                                    batch_size)
+
+            async with semaphore:
+                return await self.run_sync(sync_dump_tables)
+
+        tasks = []
+        try:
+            snapshots = {}
+            for bind_key in groups:
+                if consistent and self.get_engine(
+                        bind_key).dialect.name == 'postgresql':
+                    def sync_export_snapshot(sync_db):
+                        conn = sync_db.get_engine(bind_key).connect()
+                        snapshot_connections.append(conn)
+                        return _export_snapshot(conn)
+
+                    snapshots[bind_key] = await self.run_sync(
+                        sync_export_snapshot)
+            tasks = [asyncio.ensure_future(dump_tables(*job))
+                     for job in _get_dump_jobs(groups, snapshots, consistent)]
+            results = await asyncio.gather(*tasks)
+        finally:
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for conn in snapshot_connections:
+                await self.run_sync(lambda sync_db, conn=conn: conn.close())
+        return _write_manifest(directory, format, list(chain(*results)))
+
+    async def restore(self, directory, binds=None, tables=None,
+                      batch_size=1000, workers=None, verify=True):
+        """Load the tables written by :func:`dump` back into the database.
+
+        :param directory: the directory with the dumped files.
+        :param binds: a list with the binds to restore. Use ``None`` for the
+                      default database.
+        :param tables: a list with the models, tables or table names to
+                       restore.
+        :param batch_size: the number of rows to insert in each batch.
+        :param workers: the maximum number of tables to load at the same
+                        time.
+        :param verify: if ``True``, the checksums of the files are verified
+                       before any data is loaded.
+
+        See :func:`alchemical.Alchemical.restore` for details.
+
+        Note: this method is a coroutine.
+        """
+        sources = await asyncio.get_running_loop().run_in_executor(
+            None, partial(_get_restore_sources, self.metadatas, directory,
+                          binds, tables, verify))
+        return await self.load_data(sources, batch_size=batch_size,
+                                    parallel=True, workers=workers)
+
+    async def copy_table(self, model, src_bind, dst_bind, chunk_size=10000,
+                         partitions=1, checkpoint=None, progress=None,
+                         batch_size=1000, workers=None):
+        """Copy the rows of a table from one database to another.
+
+        :param model: the model class or table to copy.
+        :param src_bind: the bind to copy from, or the URL of a database that
+                         is not configured in this instance.
+        :param dst_bind: the bind or URL to copy to.
+        :param chunk_size: the number of rows to read and write at a time.
+        :param partitions: the number of key ranges to copy in parallel.
+        :param checkpoint: the path of a file where the progress of the copy
+                           is recorded, so that it can be resumed.
+        :param progress: a function that is called after each chunk with the
+                         progress and throughput of the copy.
+        :param batch_size: the number of rows to insert in each batch when
+                           the destination does not support ``COPY``.
+        :param workers: the maximum number of partitions to copy at the same
+                        time.
+
+        See :func:`alchemical.Alchemical.copy_table` for details.
+
+        Note: this method is a coroutine.
+        """
+        table = getattr(model, '__table__', model)
+        if src_bind == dst_bind:
+            raise ValueError('The source and destination must be different')
+        copy = _TableCopy(table, chunk_size, batch_size, checkpoint,
+                          progress)
+        async with AsyncExitStack() as stack:
+            src_engine, dst_engine = [
+                getattr(engine, 'sync_engine', engine)
+                for engine in [self._get_copy_engine(bind, stack)
+                               for bind in [src_bind, dst_bind]]]
+
+            def sync_start(sync_db):
+                with src_engine.connect() as conn:
+                    copy.start(conn, partitions)
+
+            await self.run_sync(sync_start)
+            semaphore = asyncio.Semaphore(self._get_copy_workers(
+                copy, src_engine, dst_engine, workers))
+
+            async def copy_partition(i):
+                async with semaphore:
+                    await self.run_sync(lambda sync_db: copy.copy_partition(
+                        src_engine, dst_engine, i))
+
+            tasks = [asyncio.ensure_future(copy_partition(i))
+                     for i in range(len(copy.partitions))]
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+        return copy.finish()
+
+    async def advise_indexes(self, log, min_count=1):
+        """Propose indexes for the statements in a statement log.
+
+        :param log: the statement log, given as a :class:`StatementLog`
+                    instance, the path to a log saved to disk, or an
+                    iterable of log entries.
+        :param min_count: the minimum number of executions a statement needs
+                          to have to be considered.
+
+        See :func:`alchemical.Alchemical.advise_indexes` for details.
+
+        Note: this method is a coroutine.
+        """
+        def sync_advise_indexes(sync_db):
+            return sync_db.advise_indexes(log, min_count=min_count)
+
+        return await self.run_sync(sync_advise_indexes)
+
+    async def maintain_partitions(self, ahead=3, retain=None, now=None):
+        """Create and drop partitions of range partitioned tables.
+
+        :param ahead: the number of partitions to create after the one that
+                      holds the current value of the partitioning column.
+        :param retain: the number of past partitions to keep. Older
+                       partitions are dropped, along with their data. The
+                       default is to not drop any partitions.
+        :param now: the current value of the partitioning column. The default
+                    is today's date for time intervals, or the largest value
+                    stored in each table for integer intervals.
+
+        See :func:`alchemical.Alchemical.maintain_partitions` for details.
+
+        Note: this method is a coroutine.
+        """
+        def sync_maintain_partitions(sync_db):
+            return sync_db.maintain_partitions(ahead=ahead, retain=retain,
+                                               now=now)
+
+        return await self.run_sync(sync_maintain_partitions)
+
     @property
     def Session(self):
         """Return a database session.
@@ -117,32 +995,200 @@ class Alchemical(BaseAlchemical):
 
         When the session is created in this way, ``await session.close()`` must
         be called when the session isn't needed anymore.
+
+        A timeout for the statements issued by the session can be given in
+        seconds::
+
+            async with db.Session(statement_timeout=5) as session:
+                # statements that run for more than 5 seconds raise
+                # a StatementTimeout exception
         """
+        if self.health_check_options and self._has_pending_tasks(
+                'health_check_options', self.health_checkers):
+            self._start_health_checks()
+        if self.pool_sizing_options and self._has_pending_tasks(
+                'pool_sizing_options', self.pool_sizers):
+            self._start_pool_sizers()
         if self.session_class is None:
-            options = {'future': True, 'expire_on_commit': False}
+            engine = self.get_engine()
+            if self._bridged:
+                options = {'future': True, 'expire_on_commit': False,
+                           'class_': AlchemicalSession}
+                options.update(self.session_options)
+                self.session_class = partial(
+                    BridgedAsyncSession, self.bridge, sessionmaker(
+                        bind=engine, binds=self.table_binds, **options),
+                    cleanup_timeout=self.cleanup_timeout,
+                    cleanup_stats=self.cleanup_stats)
+                return self.session_class
+            options = {'future': True, 'expire_on_commit': False,
+                       'class_': AlchemicalAsyncSession,
+                       'cleanup_timeout': self.cleanup_timeout,
+                       'cleanup_stats': self.cleanup_stats}
             options.update(self.session_options)
             self.session_class = async_sessionmaker(
-                bind=self.get_engine(), binds=self.table_binds, **options)
+                bind=engine, binds=self.table_binds, **options)
         return self.session_class
 
     @asynccontextmanager
-    async def begin(self):
+    async def begin(self, timeout=None):
         """Context manager for a database transaction.
 
+        :param timeout: the maximum number of seconds each statement issued in
+                        the transaction is allowed to run.
+
         Upon entering the context manager block, a new session is created and
         a transaction started on it. If any errors occur inside the context
         manager block, then the transaction is rolled back. If no errors occur,
         the transaction is committed. In both cases the session is then closed.
 
+        The rollback and close operations are protected from task
+        cancellation, and are given up to :attr:`cleanup_timeout` seconds to
+        complete. If the task is cancelled while the transaction is being
+        committed, or the cleanup does not complete in time, the connection is
+        invalidated instead of being returned to the pool. These events are
+        counted in the ``cleanup_stats`` attribute.
+
         Example usage::
 
             async with db.begin() as session:
                 # work with the session here
                 # a commit (on success) or rollback (on error) is automatic
         """
-        async with self.Session() as session:
-            async with session.begin():
+        async with self.Session(statement_timeout=timeout) as session:
+            await session.begin()
+            try:
                 yield session
+            except BaseException:
+                await session.safe_close(rollback=True)
+                raise
+            try:
+                await session.commit()
+            except asyncio.CancelledError:
+                # the commit may or may not have completed
+                await session.safe_invalidate()
+                raise
+
+    async def transaction(self, f, retries=3, backoff=0.1):
+        """Run a coroutine function inside a database transaction, with
+        retries.
+
+        :param f: the coroutine function to run. The function receives the
+                  session as its only argument.
+        :param retries: the number of times the transaction is retried when a
+                        transient error occurs.
+        :param backoff: the base delay in seconds between retries. The delay
+                        doubles after each attempt, and is randomized to
+                        avoid retrying at the same time as other clients.
+
+        The function runs inside a :func:`begin` block, so the transaction is
+        committed when the function returns, and rolled back if it raises an
+        exception. If the error is a serialization failure, a deadlock, a
+        locked SQLite database or a dropped connection, the whole transaction
+        is retried. The return value of the function is returned.
+
+        The changes are flushed before the transaction is committed. If the
+        connection is dropped during the commit, the transaction may or may
+        not have been committed, so the error is raised instead of retrying
+        the transaction, to avoid applying it twice.
+
+        Example::
+
+            async def transfer(session):
+                # work with the session here
+
+            await db.transaction(transfer, retries=5)
+
+        Note: this method is a coroutine.
+        """
+        attempt = 0
+        while True:
+            committing = False
+            try:
+                async with self.begin() as session:
+                    result = await f(session)
+                    await session.flush()
+                    committing = True
+                return result
+            except DBAPIError as error:
+                if attempt >= retries or not is_transient_error(error) or (
+                        committing and error.connection_invalidated):
+                    raise
+            await asyncio.sleep(retry_delay(attempt, backoff))
+            attempt += 1
+
+    async def iter_columns(self, stmt, bind=None, format='numpy',
+                           batch_size=10000):
+        """Run a query and return its results in column-oriented batches.
+
+        :param stmt: the select statement to run.
+        :param bind: the name of the bind to run the query on. The default is
+                     to use the bind of the models in the query.
+        :param format: ``'numpy'`` to return each batch as a dictionary of
+                       NumPy arrays, or ``'arrow'`` to return each batch as a
+                       ``pyarrow.RecordBatch``. The ``numpy`` or ``pyarrow``
+                       packages must be installed.
+        :param batch_size: the number of rows in each batch.
+
+        The rows are streamed from a server-side cursor on databases that
+        support it, and are read from the cursor in batches that are converted
+        to columns directly, without creating result rows or model instances.
+
+        Example::
+
+            async for batch in db.iter_columns(User.select()):
+                # work with the batch here
+
+        Note: this method is an asynchronous generator.
+        """
+        if bind is not None:
+            engine = self.get_engine(bind)
+            bind_arguments = {'bind': getattr(engine, 'sync_engine', engine)}
+        else:
+            bind_arguments = {'clause': stmt}
+        async with self.Session() as session:
+            def sync_execute(sync_session):
+                conn = sync_session.connection(bind_arguments=bind_arguments)
+                return _iter_column_batches(conn, stmt, format, batch_size)
+
+            batches = await session.run_sync(sync_execute)
+            try:
+                while True:
+                    batch = await session.run_sync(
+                        lambda sync_session: next(batches, None))
+                    if batch is None:
+                        break
+                    yield batch
+            finally:
+                await session.run_sync(lambda sync_session: batches.close())
+
+    async def fetch_columns(self, stmt, bind=None, format='numpy',
+                            batch_size=10000):
+        """Run a query and return all its results in column-oriented form.
+
+        :param stmt: the select statement to run.
+        :param bind: the name of the bind to run the query on. The default is
+                     to use the bind of the models in the query.
+        :param format: ``'numpy'`` to return a dictionary of NumPy arrays, or
+                       ``'arrow'`` to return a ``pyarrow.Table``. The
+                       ``numpy`` or ``pyarrow`` packages must be installed.
+        :param batch_size: the number of rows to read from the database cursor
+                           at a time.
+
+        This method collects all the batches returned by
+        :func:`iter_columns`.
+
+        Example::
+
+            columns = await db.fetch_columns(select(User.id, User.name))
+            print(columns['name'])
+
+        Note: this method is a coroutine.
+        """
+        names = list(stmt.selected_columns.keys())
+        batches = [batch async for batch in self.iter_columns(
+            stmt, bind=bind, format=format, batch_size=batch_size)]
+        return _concat_column_batches(names, batches, format)
 
     async def run_sync(self, f, *args, **kwargs):  # pragma: no cover
         """Run a function using a synchronous version of this object.
@@ -164,12 +1210,20 @@ class Alchemical(BaseAlchemical):
                                         engine_options=self.engine_options,
                                         model_class=self.Model)
             self.get_engine()  # this makes sure engines are created
-            self._sync.engines = {bind: engine.sync_engine
-                                  for bind, engine in self.engines.items()}
+            self._sync.engines = {
+                bind: getattr(engine, 'sync_engine', engine)
+                for bind, engine in self.engines.items()}
             self._sync.table_binds = {
-                table: engine.sync_engine
+                table: getattr(engine, 'sync_engine', engine)
                 for table, engine in self.table_binds.items()}
 
+        if self._bridged:
+            executor = await self.bridge.acquire()
+            try:
+                return await self.bridge.run(executor, f, self._sync, *args,
+                                             **kwargs)
+            finally:
+                self.bridge.release(executor)
         return await greenlet_spawn(f, self._sync, *args, **kwargs)
 
     def is_async(self):
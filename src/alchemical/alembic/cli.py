@@ -1,6 +1,17 @@
+from argparse import ArgumentParser
+import asyncio
+from importlib import import_module
 import os
+import shutil
+import sys
+from alembic import command, util
+from alembic.autogenerate import render_python_code
 from alembic.config import Config as AlembicConfig
 from alembic.config import CommandLine as AlembicCommandLine
+from alembic.operations import ops
+from alembic.script import ScriptDirectory
+from sqlalchemy import MetaData, event, inspect
+from alchemical.alembic.report import MigrationReport
 
 
 class Config(AlembicConfig):  # pragma: no cover
@@ -12,9 +23,370 @@ class Config(AlembicConfig):  # pragma: no cover
         return os.path.join(package_dir, "templates")
 
 
+def get_alchemical_db(config):  # pragma: no cover
+    """Import the Alchemical instance configured in alembic.ini."""
+    prepend_sys_path = config.get_main_option("prepend_sys_path")
+    if prepend_sys_path:
+        sys.path[:0] = [os.path.abspath(path)
+                        for path in prepend_sys_path.split(os.pathsep)]
+    try:
+        import_mod, db_name = config.get_main_option(
+            "alchemical_db", "").split(":")
+        return getattr(import_module(import_mod), db_name)
+    except (ModuleNotFoundError, AttributeError, ValueError):
+        raise util.CommandError(
+            "Could not import the Alchemical database instance. "
+            "Ensure that the alchemical_db setting in alembic.ini is correct."
+        )
+
+
+def get_scratch_urls(values):  # pragma: no cover
+    """Parse the scratch URLs given in the command line."""
+    urls = {}
+    for value in values or []:
+        bind, sep, url = value.partition("=")
+        if not sep or ":" in bind or "/" in bind:
+            bind, url = "", value
+        urls[bind] = url
+    return urls
+
+
+def run_with_sync_db(db, f):  # pragma: no cover
+    """Run a function that receives a synchronous Alchemical instance."""
+    if db.is_async():
+        return asyncio.run(db.run_sync(f))
+    return f(db)
+
+
+def get_baseline_metadatas(db):  # pragma: no cover
+    """Return copies of the metadata of each bind in which all the
+    constraints and indexes are named by the naming convention."""
+    # the constraints of models that are declared before the naming
+    # convention is set are not named, while migrated databases have the
+    # names, so the tables are copied to a metadata that has the convention
+    metadatas = {}
+    for name, metadata in db.metadatas.items():
+        metadatas[name] = MetaData(naming_convention=db.naming_convention)
+        for table in metadata.sorted_tables:
+            copy = table.to_metadata(metadatas[name])
+            for listener in table.dispatch.after_create:
+                event.listen(copy, "after_create", listener)
+    return metadatas
+
+
+def write_revision(config, db, bind_ops, message, head="head",
+                   version_path=None):  # pragma: no cover
+    """Write an Alembic revision with the given operations for each bind."""
+    names = [name or "" for name in db.metadatas
+             if db.get_engine(name) is not None]
+    config.set_main_option("databases", ",".join(names))
+    template_args = {"config": config, "imports": ""}
+    for name in names:
+        upgrade_ops = ops.UpgradeOps(bind_ops.get(name, []))
+        if upgrade_ops.ops:
+            template_args["%s_upgrades" % name] = render_python_code(
+                upgrade_ops)
+            template_args["%s_downgrades" % name] = render_python_code(
+                upgrade_ops.reverse())
+    script_directory = ScriptDirectory.from_config(config)
+    return script_directory.generate_revision(
+        util.rev_id(), message, head=head, version_path=version_path,
+        **template_args)
+
+
+def write_index_revision(config, db, suggestions,
+                         message=None):  # pragma: no cover
+    """Write an Alembic revision that creates the given indexes."""
+    bind_ops = {}
+    for suggestion in suggestions:
+        bind_ops.setdefault(suggestion["bind"] or "", []).append(
+            ops.CreateIndexOp(
+                suggestion["name"], suggestion["table"].split(".")[-1],
+                suggestion["columns"],
+                schema=suggestion["table"].rpartition(".")[0] or None))
+    return write_revision(config, db, bind_ops, message or "add indexes")
+
+
+def get_baseline_plan(config, version_path=None):  # pragma: no cover
+    """Return the revisions that a baseline revision replaces, the directory
+    where they are archived and the version location for the baseline
+    revision."""
+    script_directory = ScriptDirectory.from_config(config)
+    archive_dir = os.path.join(script_directory.dir, "archive")
+    replaced = list(script_directory.walk_revisions())
+    if version_path is None:
+        locations = script_directory.version_locations or [
+            script_directory.versions]
+        head_locations = {
+            os.path.dirname(script.path) for script in replaced
+            if script.is_head}
+        if len(head_locations) == 1:
+            version_path = head_locations.pop()
+        elif len(locations) == 1:
+            version_path = locations[0]
+        else:
+            raise util.CommandError(
+                "Multiple version locations present, please specify "
+                "--version-path")
+    return replaced, archive_dir, version_path
+
+
+def write_baseline_revision(config, db, replaced, archive_dir, version_path,
+                            message=None):  # pragma: no cover
+    """Write an Alembic revision that creates the current schema, and then
+    move the revisions that it replaces to an archive directory."""
+    for script in replaced:
+        if os.path.exists(os.path.join(
+                archive_dir, os.path.basename(script.path))):
+            raise util.CommandError(
+                "%s is already in the archive directory" %
+                os.path.basename(script.path))
+    bind_ops = {}
+    for name, metadata in get_baseline_metadatas(db).items():
+        bind_ops[name or ""] = [
+            op for table in metadata.sorted_tables for op in [
+                ops.CreateTableOp.from_table(table),
+                *[ops.CreateIndexOp.from_index(index)
+                  for index in sorted(table.indexes,
+                                      key=lambda index: index.name or "")]]]
+    # the baseline revision starts a new branch, so that the existing
+    # revisions are left untouched until it is known to be valid
+    script = write_revision(config, db, bind_ops, message or "baseline",
+                            head="base", version_path=version_path)
+    try:
+        loaded = ScriptDirectory.from_config(config).get_revision(
+            script.revision)
+        if loaded is None or loaded.down_revision is not None:
+            raise util.CommandError(
+                "The baseline revision %s is not valid" % script.revision)
+    except Exception:
+        os.remove(script.path)
+        raise
+    if replaced:
+        os.makedirs(archive_dir, exist_ok=True)
+    for old_script in replaced:
+        shutil.move(old_script.path, archive_dir)
+    return script
+
+
+def baseline(config, squash=False, message=None, version_path=None,
+             yes=False):  # pragma: no cover
+    """Create the current schema in empty databases and stamp them at
+    head."""
+    db = get_alchemical_db(config)
+    if squash:
+        replaced, archive_dir, version_path = get_baseline_plan(
+            config, version_path)
+        if not yes:
+            config.print_stdout(
+                "A baseline revision that creates the current schema will be "
+                "written to %s." % version_path)
+            if replaced:
+                config.print_stdout(
+                    "These revisions will be moved to %s:" % archive_dir)
+                for script in replaced:
+                    config.print_stdout("  %s" % script.path)
+            config.print_stdout("Run again with --yes to proceed.")
+            return
+
+    def check_empty(sync_db):
+        for name in sync_db.metadatas:
+            engine = sync_db.get_engine(name)
+            if engine is not None and set(inspect(
+                    engine).get_table_names()) - {"alembic_version"}:
+                raise util.CommandError(
+                    "Database %s is not empty" % (name or "[default]"))
+
+    run_with_sync_db(db, check_empty)
+    if squash:
+        script = write_baseline_revision(
+            config, db, replaced, archive_dir, version_path, message)
+        config.print_stdout("Generated baseline revision %s" % script.path)
+        if replaced:
+            config.print_stdout(
+                "Moved %d replaced revisions to %s. Databases that were "
+                "migrated with these revisions can be moved to the baseline "
+                "with 'stamp --purge %s'." % (
+                    len(replaced), archive_dir, script.revision))
+
+    def create_all(sync_db):
+        for name, metadata in get_baseline_metadatas(sync_db).items():
+            engine = sync_db.get_engine(name)
+            if engine is not None:
+                metadata.create_all(engine)
+
+    run_with_sync_db(db, create_all)
+    command.stamp(config, "head")
+
+
+def advise_indexes(config, log_file, min_count=1, revision=False,
+                   message=None):  # pragma: no cover
+    """Propose indexes for the statements in a statement log."""
+    db = get_alchemical_db(config)
+    if db.is_async():
+        suggestions = asyncio.run(db.advise_indexes(
+            log_file, min_count=min_count))
+    else:
+        suggestions = db.advise_indexes(log_file, min_count=min_count)
+    if not suggestions:
+        config.print_stdout("No missing indexes found.")
+        return
+    config.print_stdout("%10s %8s  %s" % ("Duration", "Count", "Index"))
+    for suggestion in suggestions:
+        config.print_stdout("%9.3fs %8d  %s ON %s (%s)%s" % (
+            suggestion["duration"], suggestion["count"], suggestion["name"],
+            suggestion["table"], ", ".join(suggestion["columns"]),
+            " [%s]" % suggestion["bind"] if suggestion["bind"] else ""))
+    if revision:
+        script = write_index_revision(config, db, suggestions, message)
+        config.print_stdout("Generated revision %s" % script.path)
+
+
+def copy_table(config, table, source=None, destination=None,
+               chunk_size=10000, partitions=1,
+               checkpoint=None):  # pragma: no cover
+    """Copy the rows of a table to another bind or database."""
+    db = get_alchemical_db(config)
+    tables = [metadata.tables[table] for metadata in db.metadatas.values()
+              if table in metadata.tables]
+    if not tables:
+        raise util.CommandError("Unknown table %s" % table)
+
+    def report_progress(stats):
+        config.print_stdout("%s: %d%s rows copied in %.1fs (%.0f rows/s)" % (
+            stats["table"], stats["rows"],
+            "" if stats["total"] is None else " of ~%d" % stats["total"],
+            stats["elapsed"], stats["rows_per_second"]))
+
+    args = (tables[0], source or None, destination or None)
+    kwargs = {"chunk_size": chunk_size, "partitions": partitions,
+              "checkpoint": checkpoint, "progress": report_progress}
+    if db.is_async():
+        count = asyncio.run(db.copy_table(*args, **kwargs))
+    else:
+        count = db.copy_table(*args, **kwargs)
+    config.print_stdout("Copied %d rows" % count)
+
+
 class CommandLine(AlembicCommandLine):  # pragma: no cover
+    def __init__(self, prog=None):
+        super().__init__(prog)
+        self._add_timing_arguments(self.parser)
+        # the commands that Alchemical adds have a parser of their own, with
+        # the same global options as the parser of the Alembic commands
+        self.commands_parser = ArgumentParser(prog=prog)
+        self.commands_parser.add_argument(
+            "-c", "--config", action="append",
+            help="Alternate config file; defaults to value of "
+            'ALEMBIC_CONFIG environment variable, or "alembic.ini".')
+        self.commands_parser.add_argument(
+            "-n", "--name", type=str, default="alembic",
+            help="Name of section in .ini file to use for Alembic config.")
+        self.commands_parser.add_argument(
+            "-x", action="append",
+            help="Additional arguments consumed by custom env.py scripts.")
+        self.commands_parser.add_argument(
+            "--raiseerr", action="store_true",
+            help="Raise a full stack trace on error.")
+        self.commands_parser.add_argument(
+            "-q", "--quiet", action="store_true",
+            help="Do not log to std output.")
+        self._add_timing_arguments(self.commands_parser)
+        subparsers = self.commands_parser.add_subparsers()
+        self.commands = ["advise-indexes", "baseline", "copy-table"]
+        self.parser.epilog = "Alchemical commands: %s" % ", ".join(
+            self.commands)
+
+        parser = subparsers.add_parser(
+            "advise-indexes", help=advise_indexes.__doc__)
+        parser.add_argument(
+            "log_file", help="Statement log saved by capture_statements().")
+        parser.add_argument(
+            "--min-count", type=int, default=1,
+            help="Ignore statements executed fewer times than this.")
+        parser.add_argument(
+            "--revision", action="store_true",
+            help="Write the proposed indexes to a new revision.")
+        parser.add_argument(
+            "-m", "--message", help="Message for the new revision.")
+        parser.set_defaults(cmd=(advise_indexes, ["log_file"],
+                                 ["min_count", "revision", "message"]))
+
+        parser = subparsers.add_parser("baseline", help=baseline.__doc__)
+        parser.add_argument(
+            "--squash", action="store_true",
+            help="Replace the existing revisions with a single revision that "
+            "creates the current schema.")
+        parser.add_argument(
+            "-m", "--message", help="Message for the baseline revision.")
+        parser.add_argument(
+            "--version-path",
+            help="Version location for the baseline revision, when there "
+            "are multiple version locations.")
+        parser.add_argument(
+            "--yes", action="store_true",
+            help="Apply the --squash changes. Without this option the "
+            "changes are only printed.")
+        parser.set_defaults(cmd=(baseline, [], [
+            "squash", "message", "version_path", "yes"]))
+
+        parser = subparsers.add_parser("copy-table", help=copy_table.__doc__)
+        parser.add_argument("table", help="Name of the table to copy.")
+        parser.add_argument(
+            "--from", dest="source", default="", metavar="BIND_OR_URL",
+            help="Bind name or database URL to copy from. The default is "
+            "the default database.")
+        parser.add_argument(
+            "--to", dest="destination", required=True, metavar="BIND_OR_URL",
+            help="Bind name or database URL to copy to. The table must "
+            "exist.")
+        parser.add_argument(
+            "--chunk-size", type=int, default=10000,
+            help="Number of rows to copy in each transaction.")
+        parser.add_argument(
+            "--partitions", type=int, default=1,
+            help="Number of primary key ranges to copy in parallel.")
+        parser.add_argument(
+            "--checkpoint", metavar="FILE",
+            help="File where the progress is recorded, to resume an "
+            "interrupted copy.")
+        parser.set_defaults(cmd=(copy_table, ["table"], [
+            "source", "destination", "chunk_size", "partitions",
+            "checkpoint"]))
+
+    @staticmethod
+    def _add_timing_arguments(parser):
+        parser.add_argument(
+            "--timing-report", metavar="FILE",
+            help="Record timing and lock statistics for each revision and "
+            "database, and write them to a JSON file.")
+        parser.add_argument(
+            "--dry-run-timing", action="store_true",
+            help="Apply the migrations to scratch copies of the databases "
+            "and report their timing. SQLite databases are copied, other "
+            "databases need a scratch URL.")
+        parser.add_argument(
+            "--scratch-url", action="append", metavar="[BIND=]URL",
+            help="Scratch database URL to use for a bind with "
+            "--dry-run-timing. May be given once per bind.")
+
+    def _get_command(self, argv):
+        # the first positional argument is the command, skipping the values
+        # of the global options
+        args = iter(argv)
+        for arg in args:
+            if arg in ("-c", "--config", "-n", "--name", "-x",
+                       "--timing-report", "--scratch-url"):
+                next(args, None)
+            elif not arg.startswith("-"):
+                return arg
+
     def main(self, argv=None):
-        options = self.parser.parse_args(argv)
+        argv = sys.argv[1:] if argv is None else list(argv)
+        if self._get_command(argv) in self.commands:
+            options = self.commands_parser.parse_args(argv)
+        else:
+            options = self.parser.parse_args(argv)
         if not hasattr(options, "cmd"):
             # see http://bugs.python.org/issue9253, argparse
             # behavior changed incompatibly in py3.3
@@ -25,6 +397,11 @@ class CommandLine(AlembicCommandLine):  # pragma: no cover
             except AttributeError:
                 toml = None
                 ini = options.config
+                if ini is None or isinstance(ini, list):
+                    # older Alembic versions accept a single config file,
+                    # while the parser of the Alchemical commands takes a list
+                    ini = (ini or [os.environ.get(
+                        "ALEMBIC_CONFIG", "alembic.ini")])[-1]
             if toml:
                 cfg = Config(
                     file_=ini,
@@ -38,7 +415,22 @@ class CommandLine(AlembicCommandLine):  # pragma: no cover
                     ini_section=options.name,
                     cmd_opts=options,
                 )
-            self.run_cmd(cfg, options)
+            report = None
+            if options.timing_report or options.dry_run_timing:
+                report = MigrationReport(dry_run=options.dry_run_timing)
+                cfg.attributes["alchemical_migration_report"] = report
+            if options.dry_run_timing:
+                cfg.attributes["alchemical_dry_run"] = get_scratch_urls(
+                    options.scratch_url)
+            try:
+                self.run_cmd(cfg, options)
+            finally:
+                for path in cfg.attributes.get("alchemical_scratch_dirs", []):
+                    shutil.rmtree(path, ignore_errors=True)
+            if report is not None:
+                cfg.print_stdout(report.summary())
+                if options.timing_report:
+                    report.save(options.timing_report)
 
 
 def main(argv=None, prog=None, **kwargs):
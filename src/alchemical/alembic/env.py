@@ -1,6 +1,11 @@
 import logging
 from logging.config import fileConfig
-from alembic import context
+import os
+import shutil
+import tempfile
+from alembic import context, util
+from sqlalchemy import create_engine
+from sqlalchemy.pool import NullPool
 
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
@@ -48,12 +53,38 @@ def run_migrations_offline(db, configure_options):  # pragma: no cover
     config.set_main_option("databases", ",".join(db_names))
 
 
+def get_scratch_engine(engine, name, scratch_urls):
+    """Return an engine for a scratch copy of a database."""
+    url = scratch_urls.get(name or "")
+    if url is None:
+        url = engine.url
+        if url.get_backend_name() != "sqlite" or \
+                url.database in (None, "", ":memory:"):  # pragma: no cover
+            raise util.CommandError(
+                "A scratch URL is required for the dry run of database %s"
+                % (name or "[default]"))
+        scratch_dir = tempfile.mkdtemp()
+        config.attributes.setdefault("alchemical_scratch_dirs", []).append(
+            scratch_dir)
+        path = os.path.join(scratch_dir, os.path.basename(url.database))
+        if os.path.exists(url.database):
+            shutil.copy(url.database, path)
+        url = url.set(database=path)
+    if hasattr(engine, "sync_engine"):
+        from sqlalchemy.ext.asyncio import create_async_engine
+        return create_async_engine(url, poolclass=NullPool)
+    return create_engine(url, poolclass=NullPool)
+
+
 def get_engines(db):
     engines = {}
+    scratch_urls = config.attributes.get("alchemical_dry_run")
     for name in db.metadatas:
         engine = db.get_engine(name)
         if engine is None:  # pragma: no cover
             continue
+        if scratch_urls is not None:
+            engine = get_scratch_engine(engine, name, scratch_urls)
 
         print_name = name
         if print_name is None:
@@ -65,6 +96,23 @@ def get_engines(db):
 
 
 def do_run_migrations_online(connection, metadata, name, configure_options):
+    report = config.attributes.get("alchemical_migration_report")
+    if report is None:
+        configure_and_run_migrations(
+            connection, metadata, name, configure_options)
+        return
+    with report.track(connection, name) as on_version_apply:
+        callbacks = configure_options.get("on_version_apply") or []
+        if callable(callbacks):  # pragma: no cover
+            callbacks = [callbacks]
+        configure_and_run_migrations(
+            connection, metadata, name, dict(
+                configure_options,
+                on_version_apply=[*callbacks, on_version_apply]))
+
+
+def configure_and_run_migrations(connection, metadata, name,
+                                 configure_options):
     context.configure(
         connection=connection,
         upgrade_token="%s_upgrades" % (name or ""),
@@ -72,18 +120,27 @@ def do_run_migrations_online(connection, metadata, name, configure_options):
         target_metadata=metadata,
         **configure_options,
     )
-    context.run_migrations(engine_name=name or "")
+    with context.begin_transaction():
+        context.run_migrations(engine_name=name or "")
 
 
 def run_migrations_online(db, configure_options):
-    """Run migrations in 'online' mode."""
+    """Run migrations in 'online' mode.
+
+    By default, the migrations of each database run in a single transaction
+    that is committed after all the databases are migrated. When the
+    ``transaction_per_migration`` option is set, each migration is committed
+    as soon as it runs instead.
+    """
     engines = get_engines(db)
     config.set_main_option("databases", ",".join(
         [name or "" for name in engines.keys()]))
+    per_migration = configure_options.get("transaction_per_migration")
 
     for rec in engines.values():
         rec["connection"] = rec["engine"].connect()
-        rec["transaction"] = rec["connection"].begin()
+        if not per_migration:
+            rec["connection"].begin()
 
     try:
         for name, rec in engines.items():
@@ -91,11 +148,17 @@ def run_migrations_online(db, configure_options):
             do_run_migrations_online(
                 rec["connection"], db.metadatas.get(name), name,
                 configure_options)
+        # autocommit blocks in the migrations replace the transaction, so
+        # the current one is committed instead of the one started above
         for rec in engines.values():
-            rec["transaction"].commit()
+            transaction = rec["connection"].get_transaction()
+            if transaction is not None:
+                transaction.commit()
     except:  # noqa: E722  # pragma: no cover
         for rec in engines.values():
-            rec["transaction"].rollback()
+            transaction = rec["connection"].get_transaction()
+            if transaction is not None:
+                transaction.rollback()
         raise
     finally:
         for rec in engines.values():
@@ -108,11 +171,13 @@ async def run_migrations_async(db, configure_options):
     config.set_main_option("databases", ",".join(
         [name or "" for name in engines.keys()]))
 
+    per_migration = configure_options.get("transaction_per_migration")
+
     for rec in engines.values():
         rec["connection"] = rec["engine"].connect()
         await rec["connection"].start()
-        rec["transaction"] = rec["connection"].begin()
-        await rec["transaction"].start()
+        if not per_migration:
+            await rec["connection"].begin().start()
 
     try:
         for name, rec in engines.items():
@@ -121,10 +186,10 @@ async def run_migrations_async(db, configure_options):
                 do_run_migrations_online, db.metadatas.get(name), name,
                 configure_options)
         for rec in engines.values():
-            await rec["transaction"].commit()
+            await rec["connection"].commit()
     except:  # noqa: E722  # pragma: no cover
         for rec in engines.values():
-            await rec["transaction"].rollback()
+            await rec["connection"].rollback()
         raise
     finally:
         for rec in engines.values():
@@ -0,0 +1,219 @@
+from contextlib import contextmanager
+from functools import wraps
+import time
+from alembic import op
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+from alchemical.core import _get_error_code, logger, retry_delay
+
+LOCK_TIMEOUT_SQLSTATES = {
+    "55P03",  # lock not available (PostgreSQL lock_timeout)
+}
+LOCK_TIMEOUT_MYSQL_ERRORS = {
+    1205,  # lock wait timeout exceeded
+}
+
+
+@contextmanager
+def autocommit_block():
+    """Run the enclosed migration operations outside of a transaction.
+
+    The transaction in progress is committed before the block starts, and a
+    new transaction is started when the block ends, so the operations that
+    precede the block are committed even if the migration fails later.
+
+    Example::
+
+        def upgrade_():
+            with autocommit_block():
+                op.execute("ALTER TYPE mood ADD VALUE 'soso'")
+    """
+    context = op.get_context()
+    if context.as_sql or not getattr(
+            context, "_in_external_transaction", False):
+        # transactions are managed by Alembic
+        with context.autocommit_block():
+            yield
+        return
+
+    # transactions are managed by the Alchemical environment
+    connection = context.connection
+    transaction = connection.get_transaction()
+    if transaction is not None:
+        transaction.commit()
+    isolation_level = connection.get_execution_options().get(
+        "isolation_level")
+    connection.execution_options(isolation_level="AUTOCOMMIT")
+    transaction = connection.begin()
+    try:
+        yield
+    finally:
+        transaction.commit()
+        connection.execution_options(
+            isolation_level=isolation_level or
+            connection.default_isolation_level)
+        connection.begin()
+
+
+def non_transactional(f):
+    """Decorator that runs a migration function outside of a transaction.
+
+    This decorator can be applied to the ``upgrade_<name>()`` and
+    ``downgrade_<name>()`` functions of a revision to mark the whole revision
+    as non-transactional, or to any other function that issues migration
+    operations. See :func:`autocommit_block` for details.
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        with autocommit_block():
+            return f(*args, **kwargs)
+
+    return decorated
+
+
+def create_index_concurrently(index_name, table_name, columns, schema=None,
+                              **kwargs):
+    """Create an index without blocking writes to the table.
+
+    :param index_name: the name of the index.
+    :param table_name: the name of the table.
+    :param columns: the list of columns in the index.
+    :param schema: the schema of the table.
+    :param kwargs: additional arguments for ``op.create_index()``.
+
+    On PostgreSQL, the index is built with ``CREATE INDEX CONCURRENTLY``
+    outside of a transaction. An invalid index with the same name left by a
+    previously failed attempt is dropped first. On other databases a regular
+    index is created.
+    """
+    context = op.get_context()
+    if context.dialect.name != "postgresql":
+        op.create_index(index_name, table_name, columns, schema=schema,
+                        **kwargs)
+        return
+    with autocommit_block():
+        if not context.as_sql and op.get_bind().execute(text(
+                "SELECT 1 FROM pg_index i "
+                "JOIN pg_class c ON c.oid = i.indexrelid "
+                "WHERE c.relname = :name AND NOT i.indisvalid"),
+                {"name": index_name}).first():
+            op.drop_index(index_name, table_name=table_name, schema=schema,
+                          postgresql_concurrently=True)
+        op.create_index(index_name, table_name, columns, schema=schema,
+                        postgresql_concurrently=True, **kwargs)
+
+
+def drop_index_concurrently(index_name, table_name=None, schema=None,
+                            **kwargs):
+    """Drop an index without blocking access to the table.
+
+    :param index_name: the name of the index.
+    :param table_name: the name of the table.
+    :param schema: the schema of the table.
+    :param kwargs: additional arguments for ``op.drop_index()``.
+
+    On PostgreSQL, the index is dropped with ``DROP INDEX CONCURRENTLY``
+    outside of a transaction. On other databases the index is dropped
+    normally.
+    """
+    if op.get_context().dialect.name != "postgresql":
+        op.drop_index(index_name, table_name=table_name, schema=schema,
+                      **kwargs)
+        return
+    with autocommit_block():
+        op.drop_index(index_name, table_name=table_name, schema=schema,
+                      postgresql_concurrently=True, **kwargs)
+
+
+def is_lock_timeout(error):
+    """Return ``True`` if the given error was caused by a lock timeout.
+
+    :param error: the exception raised by SQLAlchemy.
+    """
+    if not isinstance(error, DBAPIError):
+        return False
+    sqlstate, code = _get_error_code(error.orig)
+    if sqlstate in LOCK_TIMEOUT_SQLSTATES or \
+            code in LOCK_TIMEOUT_MYSQL_ERRORS:
+        return True
+    return "database is locked" in str(error.orig)
+
+
+def _get_lock_timeout_statements(connection, timeout, autocommit):
+    name = connection.dialect.name
+    if name == "postgresql":
+        scope = "" if autocommit else " LOCAL"
+        previous = connection.exec_driver_sql("SHOW lock_timeout").scalar()
+        return (f"SET{scope} lock_timeout = '{int(timeout * 1000)}ms'",
+                f"SET{scope} lock_timeout = '{previous}'")
+    elif name in ("mysql", "mariadb"):
+        previous = connection.exec_driver_sql(
+            "SELECT @@SESSION.lock_wait_timeout").scalar()
+        return (f"SET SESSION lock_wait_timeout = {max(int(timeout), 1)}",
+                f"SET SESSION lock_wait_timeout = {previous}")
+    elif name == "sqlite":
+        previous = connection.exec_driver_sql(
+            "PRAGMA busy_timeout").scalar()
+        return (f"PRAGMA busy_timeout = {int(timeout * 1000)}",
+                f"PRAGMA busy_timeout = {previous}")
+    return None, None
+
+
+def run_with_lock_timeout(f, timeout=5, retries=5, backoff=1):
+    """Run migration operations with a lock timeout, retrying them if the
+    locks they need cannot be obtained in time.
+
+    :param f: a function that issues the migration operations.
+    :param timeout: the maximum number of seconds to wait for locks.
+    :param retries: the number of times the operations are retried after a
+                    lock timeout.
+    :param backoff: the base delay in seconds between retries. The delay
+                    doubles after each attempt, and is randomized.
+
+    A DDL statement that waits for a lock on a busy table blocks all the
+    queries on that table that are issued after it. Setting a short lock
+    timeout and retrying limits how long other clients are blocked. On
+    PostgreSQL each attempt runs inside a savepoint, so that a failed attempt
+    can be retried without aborting the migration. The return value of the
+    function is returned.
+
+    Example::
+
+        def upgrade_():
+            run_with_lock_timeout(
+                lambda: op.add_column('user', sa.Column('age', sa.Integer)),
+                timeout=2)
+    """
+    context = op.get_context()
+    if context.as_sql:
+        return f()
+    connection = op.get_bind()
+    autocommit = connection.get_execution_options().get(
+        "isolation_level") == "AUTOCOMMIT"
+    set_timeout, reset_timeout = _get_lock_timeout_statements(
+        connection, timeout, autocommit)
+    savepoints = connection.dialect.name == "postgresql" and not autocommit
+    attempt = 0
+    while True:
+        savepoint = connection.begin_nested() if savepoints else None
+        if set_timeout:
+            connection.exec_driver_sql(set_timeout)
+        try:
+            result = f()
+        except DBAPIError as error:
+            if savepoint is not None:
+                savepoint.rollback()  # this also reverts the timeout
+            elif reset_timeout:
+                connection.exec_driver_sql(reset_timeout)
+            if attempt >= retries or not is_lock_timeout(error):
+                raise
+        else:
+            if savepoint is not None:
+                savepoint.commit()
+            if reset_timeout:
+                connection.exec_driver_sql(reset_timeout)
+            return result
+        logger.info("Lock timeout in migration, retrying (attempt %d)",
+                    attempt + 1)
+        time.sleep(retry_delay(attempt, backoff))
+        attempt += 1
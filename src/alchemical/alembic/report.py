@@ -0,0 +1,118 @@
+from contextlib import contextmanager
+import json
+import time
+from sqlalchemy import event
+from alchemical.alembic.ops import is_lock_timeout
+
+
+class MigrationReport:
+    """Statistics about the migrations applied in a run of Alembic.
+
+    :param dry_run: ``True`` if the migrations were applied to scratch
+                    copies of the databases.
+
+    The ``steps`` attribute is a list with an entry for each revision applied
+    to each database. Entries are dictionaries with the following keys:
+
+    - ``revision``: the revision identifier.
+    - ``description``: the message given to the revision.
+    - ``direction``: ``'upgrade'`` or ``'downgrade'``.
+    - ``bind``: the bind key, or ``None`` for the default database.
+    - ``time``: the wall time in seconds.
+    - ``statements``: the number of SQL statements executed.
+    - ``rows``: the number of rows affected, for drivers that report it.
+    - ``lock_waits``: the number of lock timeouts and busy errors raised.
+
+    Reports are created by the ``alchemical.alembic.cli`` command when the
+    ``--timing-report`` or ``--dry-run-timing`` options are given.
+    """
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self.steps = []
+
+    @contextmanager
+    def track(self, connection, bind_key):
+        """Record the migration steps applied on a connection.
+
+        :param connection: the connection that runs the migrations.
+        :param bind_key: the bind key of the connection.
+
+        This context manager returns a function that must be given to
+        Alembic as ``on_version_apply`` callback.
+        """
+        stats = {"statements": 0, "rows": 0, "lock_waits": 0}
+        last = [time.perf_counter()]
+
+        def count_statement(conn, cursor, statement, parameters, context,
+                            executemany):
+            stats["statements"] += 1
+            if (cursor.rowcount or 0) > 0:
+                stats["rows"] += cursor.rowcount
+
+        def count_lock_wait(context):
+            if context.connection is connection and \
+                    is_lock_timeout(context.sqlalchemy_exception):
+                stats["lock_waits"] += 1
+
+        def on_version_apply(ctx, step, heads, run_args):
+            now = time.perf_counter()
+            self.steps.append({
+                "revision": step.up_revision_id,
+                "description": step.up_revision.doc,
+                "direction": "upgrade" if step.is_upgrade else "downgrade",
+                "bind": bind_key,
+                "time": now - last[0],
+                **stats,
+            })
+            stats.update(statements=0, rows=0, lock_waits=0)
+            last[0] = now
+
+        event.listen(connection, "after_cursor_execute", count_statement)
+        event.listen(connection.engine, "handle_error", count_lock_wait)
+        try:
+            yield on_version_apply
+        finally:
+            event.remove(connection, "after_cursor_execute", count_statement)
+            event.remove(connection.engine, "handle_error", count_lock_wait)
+
+    @property
+    def totals(self):
+        """The totals of the statistics for all the steps."""
+        return {key: sum(step[key] for step in self.steps)
+                for key in ["time", "statements", "rows", "lock_waits"]}
+
+    def save(self, path):
+        """Write the report to a JSON file.
+
+        :param path: the path of the file.
+        """
+        with open(path, "wt") as f:
+            json.dump({"dry_run": self.dry_run, "steps": self.steps,
+                       "totals": self.totals}, f, indent=2)
+
+    def summary(self):
+        """Return a summary table of the report, as a string."""
+        rows = [("Revision", "Bind", "Time", "Statements", "Rows",
+                 "Lock waits", "Description")]
+        for step in self.steps + [dict(self.totals, revision="Total",
+                                       direction=None, bind="",
+                                       description="")]:
+            revision = step["revision"]
+            if step["direction"] == "downgrade":
+                revision += " (down)"
+            rows.append((
+                revision,
+                "[default]" if step["bind"] is None else step["bind"],
+                "%.3fs" % step["time"], str(step["statements"]),
+                str(step["rows"]), str(step["lock_waits"]),
+                step["description"] or ""))
+        widths = [max(len(row[i]) for row in rows) for i in range(6)]
+        lines = []
+        for row in rows:
+            lines.append("  ".join(
+                [row[0].ljust(widths[0]), row[1].ljust(widths[1])] +
+                [value.rjust(width) for value, width in zip(
+                    row[2:6], widths[2:])] + [row[6]]).rstrip())
+        if self.dry_run:
+            lines.append("(dry run against scratch databases)")
+        return "\n".join(lines)
@@ -21,6 +21,8 @@ except (ModuleNotFoundError, AttributeError):
 # The dictionary provided as second argument includes options to pass to the
 # Alembic context. For details on what other options are available, see
 # https://alembic.sqlalchemy.org/en/latest/autogenerate.html
+# Add 'transaction_per_migration': True to commit each migration as it runs,
+# instead of migrating each database in a single transaction.
 run_migrations(db, {
     'render_as_batch': True,
     'compare_type': True,
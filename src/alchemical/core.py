@@ -1,9 +1,43 @@
-from contextlib import contextmanager
+import base64
+from collections.abc import Mapping
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, \
+    ThreadPoolExecutor, wait
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+import csv
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
+from enum import Enum
+import gzip
+import hashlib
+import inspect as pyinspect
+import io
+from itertools import chain, islice
+import json
+import logging
+import os
+import random
 import re
-from threading import Lock
+from threading import Event, Lock, Thread, get_ident
+import time
+import weakref
 
-from sqlalchemy import create_engine, MetaData, select, update, delete
-from sqlalchemy.orm import DeclarativeBase, sessionmaker
+from sqlalchemy import create_engine, event, func, inspect, MetaData, \
+    select, insert, update, delete, any_, bindparam, text, tuple_, ARRAY, \
+    Column, Table, UniqueConstraint, JSON
+from sqlalchemy.exc import DBAPIError, OperationalError
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.schema import sort_tables
+from sqlalchemy.sql import operators, visitors
+from sqlalchemy.sql.elements import BinaryExpression
+from sqlalchemy.sql.selectable import Join
+from sqlalchemy.util.concurrency import await_only
+from sqlalchemy.util import queue as sqla_queue
+from sqlalchemy.orm import DeclarativeBase, Session, aliased, \
+    scoped_session, sessionmaker, strategies
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.base import LoaderCallableStatus, PassiveFlag
+from sqlalchemy.orm.relationships import RelationshipProperty
 
 DEFAULT_NAMING_CONVENTION = {
   "ix": "ix_%(column_0_label)s",
@@ -13,6 +47,113 @@ DEFAULT_NAMING_CONVENTION = {
   "pk": "pk_%(table_name)s"
 }
 
+TRANSIENT_SQLSTATES = {
+    '40001',  # serialization failure
+    '40P01',  # deadlock detected (PostgreSQL)
+}
+TRANSIENT_MYSQL_ERRORS = {
+    1205,  # lock wait timeout exceeded
+    1213,  # deadlock found when trying to get lock
+}
+TIMEOUT_SQLSTATES = {
+    '57014',  # query canceled (PostgreSQL statement_timeout)
+}
+TIMEOUT_MYSQL_ERRORS = {
+    1969,  # max_statement_time exceeded (MariaDB)
+    3024,  # maximum statement execution time exceeded (MySQL)
+}
+PARTITION_INTERVALS = {
+    'day': '%Y_%m_%d',
+    'week': '%Y_%m_%d',
+    'month': '%Y_%m',
+    'year': '%Y',
+}
+_PARTITION_NAME = '%(table_name)s_%(partition_range)s'
+EQUALITY_OPERATORS = {operators.eq, operators.in_op, operators.is_}
+RANGE_OPERATORS = {operators.lt, operators.le, operators.gt, operators.ge,
+                   operators.between_op, operators.like_op,
+                   operators.startswith_op}
+DUMP_FORMATS = ('jsonl', 'csv')
+DUMP_MANIFEST = 'manifest.json'
+DUMP_COMPRESSLEVEL = 6  # much faster than the maximum, for a small loss
+
+# statements that do not invalidate cached counts
+READ_STATEMENTS = ('SELECT', 'SHOW', 'EXPLAIN')
+
+# names of the PostgreSQL types in the psycopg types registry
+COPY_TYPE_NAMES = {
+    'boolean': 'bool',
+    'smallint': 'int2',
+    'integer': 'int4',
+    'bigint': 'int8',
+    'real': 'float4',
+    'float': 'float8',
+    'double precision': 'float8',
+    'character varying': 'varchar',
+    'char': 'bpchar',
+    'character': 'bpchar',
+    'time without time zone': 'time',
+    'time with time zone': 'timetz',
+    'timestamp without time zone': 'timestamp',
+    'timestamp with time zone': 'timestamptz',
+}
+
+PARAMETER_LIMITS = {
+    'mssql': 2000,
+    'mysql': 65535,
+    'mariadb': 65535,
+    'oracle': 1000,  # the limit applies to IN lists
+    'postgresql': 32767,
+}
+
+logger = logging.getLogger('alchemical')
+request_deadline = ContextVar('alchemical_request_deadline', default=None)
+_session_scope = ContextVar('alchemical_session_scope')
+database_timing = ContextVar('alchemical_database_timing', default=None)
+_worker_db = None
+_instances = weakref.WeakSet()
+
+
+def _get_context_scope():
+    # copied contexts (threads started with asyncio.to_thread() or
+    # run_in_executor(), child tasks) inherit the value of the variable, so
+    # the scope is only reused by the context that set it, which is the only
+    # one where its token can be reset
+    state = _session_scope.get(None)
+    if state is not None:
+        try:
+            _session_scope.reset(state[0])
+        except (ValueError, RuntimeError):
+            pass  # the scope belongs to the context this one was copied from
+        else:
+            state[0] = _session_scope.set(state)
+            return state[1]
+    state = [None, object()]
+    state[0] = _session_scope.set(state)
+    return state[1]
+
+
+def _init_partition_worker(cls, options, config):
+    global _worker_db
+    # the engines are created on first use, after the function has been
+    # unpickled and the modules that define the models have been imported
+    _worker_db = cls(**options)
+    _worker_db.initialize(**config)
+
+
+def _run_partition(f, partition):
+    with _worker_db.begin() as session:
+        return f(session, partition)
+
+
+def _reset_after_fork():
+    for db in list(_instances):
+        db._reset_after_fork()
+
+
+if hasattr(os, 'register_at_fork'):  # pragma: no branch
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
 
 class TableNamer:  # pragma: no cover
     def __get__(self, obj, type):
@@ -24,12 +165,851 @@ class TableNamer:  # pragma: no cover
         return getattr(type, '__tablename__', None)
 
 
+def _get_copy_type_name(column, dialect):
+    name = re.sub(r'\(.*?\)', '', column.type.compile(dialect)).lower()
+    name = ' '.join(name.split())
+    array = name.endswith('[]')
+    name = name[:-2] if array else name
+    name = COPY_TYPE_NAMES.get(name, name)
+    return name + '[]' if array else name
+
+
+def _process_bind_values(conn, columns, rows):
+    dialect = conn.dialect
+    processors = [column.type.dialect_impl(dialect).bind_processor(dialect)
+                  for column in columns]
+    if not any(processors):
+        return rows
+    return (tuple(value if processor is None else processor(value)
+                  for processor, value in zip(processors, row))
+            for row in rows)
+
+
+def _copy_from_psycopg(conn, table, columns, rows, binary):
+    preparer = conn.dialect.identifier_preparer
+    sql = 'COPY {} ({}) FROM STDIN'.format(
+        preparer.format_table(table),
+        ', '.join(preparer.quote(column.name) for column in columns))
+    if binary:
+        sql += ' (FORMAT BINARY)'
+    else:
+        # in binary mode psycopg adapts the values to the given types, but
+        # in text mode they need the conversions that inserts apply
+        rows = _process_bind_values(conn, columns, rows)
+    count = 0
+    with conn.connection.driver_connection.cursor() as cursor:
+        with cursor.copy(sql) as copy:
+            if binary:
+                copy.set_types([_get_copy_type_name(column, conn.dialect)
+                                for column in columns])
+            for row in rows:
+                copy.write_row(row)
+                count += 1
+    return count
+
+
+def _copy_from_asyncpg(conn, table, columns, rows):
+    driver_connection = conn.connection.driver_connection
+    if not driver_connection.is_in_transaction():
+        # the asyncpg adapter begins its transaction with the first statement
+        # that goes through a cursor, so the copy would be autocommitted
+        conn.exec_driver_sql('SELECT 1')
+    status = await_only(
+        driver_connection.copy_records_to_table(
+            table.name, records=_process_bind_values(conn, columns, rows),
+            schema_name=table.schema,
+            columns=[column.name for column in columns]))
+    return int(status.split()[-1])
+
+
+def _copy_from_executemany(conn, table, columns, rows, batch_size):
+    names = [column.name for column in columns]
+    stmt = insert(table)
+    count = 0
+    rows = iter(rows)
+    while True:
+        batch = [dict(zip(names, row)) for row in islice(rows, batch_size)]
+        if not batch:
+            break
+        conn.execute(stmt, batch)
+        count += len(batch)
+    return count
+
+
+def _get_data_format(path):
+    name = os.fspath(path).lower()
+    if name.endswith('.gz'):
+        name = name[:-3]
+    if name.endswith('.csv'):
+        return 'csv'
+    elif name.endswith(('.jsonl', '.ndjson', '.json')):
+        return 'jsonl'
+    raise ValueError(f'Cannot determine the format of {path}')
+
+
+def _open_data_file(path, mode='rt'):
+    if os.fspath(path).lower().endswith('.gz'):
+        return gzip.open(path, mode, encoding='utf-8', newline='')
+    return open(path, mode, encoding='utf-8', newline='')
+
+
+def _read_data(source, format=None):
+    if isinstance(source, (str, os.PathLike)):
+        with _open_data_file(source) as f:
+            yield from _read_data(f, format or _get_data_format(source))
+    elif hasattr(source, 'read'):
+        if format == 'csv':
+            yield from csv.DictReader(source)
+        elif format == 'jsonl':
+            for line in source:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            raise ValueError(f'Unsupported format: {format}')
+    else:
+        yield from source
+
+
+def _get_value_converter(column, csv=False):
+    if isinstance(column.type, JSON):
+        if not csv:
+            return None  # JSON values are given in their decoded form
+        python_type = dict  # JSON columns report object as their type
+    else:
+        try:
+            python_type = column.type.python_type
+        except NotImplementedError:
+            return None
+    if python_type is str:
+        return None
+    elif python_type is bool:
+        def convert(value):
+            if isinstance(value, str):
+                return value.lower() in ('1', 'true', 't', 'yes', 'y', 'on')
+            return bool(value)
+    elif python_type is bytes:
+        def convert(value):
+            return base64.b64decode(value) if isinstance(value, str) \
+                else value
+    elif python_type in (dict, list):
+        def convert(value):
+            return json.loads(value) if isinstance(value, str) else value
+    elif python_type in (int, float, Decimal):
+        def convert(value):
+            return python_type(str(value) if python_type is Decimal
+                               else value)
+    elif hasattr(python_type, 'fromisoformat'):  # dates and times
+        def convert(value):
+            return python_type.fromisoformat(value) \
+                if isinstance(value, str) else value
+    else:  # enums and other types accept the values as given
+        def convert(value):
+            return value
+
+    def convert_value(value):
+        if value == '':  # empty strings are nulls in CSV files
+            return None
+        if value is None or isinstance(value, python_type):
+            return value
+        return convert(value)
+
+    return convert_value
+
+
+def _load_table(conn, table, source, format, batch_size):
+    if format is None and isinstance(source, (str, os.PathLike)):
+        format = _get_data_format(source)
+    records = _read_data(source, format)
+    keys = set(table.c.keys())
+    converters = {}
+    count = 0
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            break
+        # records that omit keys are inserted separately, so that the
+        # defaults of the omitted columns apply to them
+        groups = {}
+        for record in batch:
+            groups.setdefault(frozenset(record), []).append(record)
+        for group_keys, group in groups.items():
+            unknown = group_keys - keys
+            if unknown:
+                raise ValueError(f'Unknown columns in {table.name}: '
+                                 f'{", ".join(sorted(unknown))}')
+            names = [name for name in table.c.keys() if name in group_keys]
+            for name in names:
+                if name not in converters:
+                    converters[name] = _get_value_converter(
+                        table.c[name], csv=format == 'csv')
+            group_converters = [converters[name] for name in names]
+            rows = [tuple(value if convert is None else convert(value)
+                          for convert, value in zip(group_converters,
+                                                    map(record.get, names)))
+                    for record in group]
+            count += _copy_from_executemany(
+                conn, table, [table.c[name] for name in names], rows,
+                batch_size)
+    return count
+
+
+def _get_load_plan(source, model):
+    sources = source if isinstance(source, Mapping) else {model: source}
+    if None in sources:
+        raise ValueError('The model of the data must be given')
+    sources = {getattr(model, '__table__', model): source
+               for model, source in sources.items()}
+    order = sort_tables(sources)
+    dependencies = {
+        table: {fk.column.table for fk in table.foreign_keys} &
+        set(sources) - {table} for table in order}
+    return sources, order, dependencies
+
+
+def _get_ready_tables(pending, running, dependencies):
+    busy = {*pending, *running}
+    ready = [table for table in pending if not dependencies[table] & busy]
+    if not ready and not running:
+        ready = pending[:1]  # tables with circular dependencies
+    return ready
+
+
+def _format_value(value):
+    if isinstance(value, (bytes, memoryview)):
+        return base64.b64encode(value).decode()
+    elif isinstance(value, Enum):
+        return value.name
+    elif hasattr(value, 'isoformat'):  # dates and times
+        return value.isoformat()
+    return str(value)
+
+
+def _format_csv_value(value, json_column=False):
+    if value is None:
+        return ''
+    elif json_column or isinstance(value, (dict, list)):
+        return json.dumps(value, default=_format_value)
+    elif isinstance(value, (str, int, float)):
+        return value
+    return _format_value(value)
+
+
+def _get_table_key(table):
+    if isinstance(table, str):
+        return table
+    return getattr(table, '__table__', table).key
+
+
+def _get_dump_groups(metadatas, binds, tables):
+    keys = None if tables is None else {_get_table_key(t) for t in tables}
+    groups = {}
+    for bind_key, metadata in metadatas.items():
+        if binds is not None and bind_key not in binds:
+            continue
+        selected = [table for table in metadata.sorted_tables
+                    if keys is None or table.key in keys]
+        if selected:
+            groups[bind_key] = selected
+    if keys is not None:
+        unknown = keys - {table.key for tables in groups.values()
+                          for table in tables}
+        if unknown:
+            raise ValueError(f'Unknown tables: {", ".join(sorted(unknown))}')
+    return groups
+
+
+def _get_dump_jobs(groups, snapshots, consistent):
+    jobs = []
+    for bind_key, tables in groups.items():
+        snapshot = snapshots.get(bind_key)
+        if consistent and snapshot is None:
+            # without a shared snapshot, all the tables of the bind have to
+            # be read in the same transaction
+            jobs.append((bind_key, tables, None))
+        else:
+            jobs.extend((bind_key, [table], snapshot) for table in tables)
+    return jobs
+
+
+def _export_snapshot(conn):
+    conn.execution_options(isolation_level='REPEATABLE READ')
+    return conn.exec_driver_sql('SELECT pg_export_snapshot()').scalar()
+
+
+def _dump_table(conn, bind_key, table, directory, format, batch_size):
+    filename = f'{table.key}.{format}.gz'
+    if bind_key is not None:
+        filename = f'{bind_key}/{filename}'
+    path = os.path.join(directory, filename)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    names = table.c.keys()
+    json_columns = [isinstance(column.type, JSON) for column in table.columns]
+    result = conn.execution_options(stream_results=True).execute(
+        select(table).order_by(*table.primary_key.columns))
+    checksum = hashlib.sha256()
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    if format == 'csv':
+        writer.writerow(names)
+    count = 0
+    with gzip.open(path, 'wb', compresslevel=DUMP_COMPRESSLEVEL) as f:
+        # the initial empty batch writes the header of empty CSV files
+        for rows in chain([[]], result.partitions(batch_size)):
+            if format == 'csv':
+                writer.writerows([
+                    _format_csv_value(value, json_column)
+                    for value, json_column in zip(row, json_columns)]
+                    for row in rows)
+            else:
+                buffer.writelines(json.dumps(
+                    dict(zip(names, row)), default=_format_value) + '\n'
+                    for row in rows)
+            data = buffer.getvalue().encode()
+            checksum.update(data)
+            f.write(data)
+            buffer.seek(0)
+            buffer.truncate()
+            count += len(rows)
+    return {'bind': bind_key, 'table': table.key, 'file': filename,
+            'rows': count, 'sha256': checksum.hexdigest()}
+
+
+def _dump_tables(engine, bind_key, tables, snapshot, directory, format,
+                 batch_size):
+    with engine.connect() as conn:
+        if snapshot is not None:
+            conn.execution_options(isolation_level='REPEATABLE READ')
+            conn.exec_driver_sql(f"SET TRANSACTION SNAPSHOT '{snapshot}'")
+        elif len(tables) > 1 and conn.dialect.name == 'sqlite':
+            # pysqlite does not start a transaction for reads
+            conn.exec_driver_sql('BEGIN')
+        return [_dump_table(conn, bind_key, table, directory, format,
+                            batch_size) for table in tables]
+
+
+def _write_manifest(directory, format, entries):
+    path = os.path.join(directory, DUMP_MANIFEST)
+    with open(path + '.tmp', 'wt') as f:
+        json.dump({
+            'format': format,
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'tables': entries,
+        }, f, indent=2)
+    os.replace(path + '.tmp', path)  # the manifest marks a complete dump
+    return {entry['table']: entry['rows'] for entry in entries}
+
+
+def _get_file_checksum(path):
+    checksum = hashlib.sha256()
+    with gzip.open(path, 'rb') as f:
+        for data in iter(lambda: f.read(1024 * 1024), b''):
+            checksum.update(data)
+    return checksum.hexdigest()
+
+
+def _get_restore_sources(metadatas, directory, binds, tables, verify):
+    with open(os.path.join(directory, DUMP_MANIFEST), 'rt') as f:
+        manifest = json.load(f)
+    keys = None if tables is None else {_get_table_key(t) for t in tables}
+    sources = {}
+    for entry in manifest['tables']:
+        if (binds is not None and entry['bind'] not in binds) or \
+                (keys is not None and entry['table'] not in keys):
+            continue
+        metadata = metadatas.get(entry['bind'])
+        table = metadata.tables.get(entry['table']) \
+            if metadata is not None else None
+        if table is None:
+            raise ValueError(f'Table {entry["table"]} is not in bind '
+                             f'{entry["bind"]}')
+        path = os.path.join(directory, entry['file'])
+        if verify and _get_file_checksum(path) != entry['sha256']:
+            raise ValueError(f'Checksum mismatch in {entry["file"]}')
+        sources[table] = path
+    return sources
+
+
+def _get_keyset_clause(columns, values):
+    if len(columns) == 1:
+        return columns[0] > values[0]
+    return tuple_(*columns) > tuple_(*values)
+
+
+def _delete_keys(conn, table, columns, keys):
+    key = columns[0] if len(columns) == 1 else tuple_(*columns)
+    size = max(_get_parameter_limit(conn.dialect) // len(columns), 1)
+    for i in range(0, len(keys), size):
+        batch = keys[i:i + size]
+        if len(columns) == 1:
+            batch = [values[0] for values in batch]
+        conn.execute(delete(table).where(key.in_(batch)))
+
+
+def _write_rows(conn, table, rows, batch_size):
+    columns = list(table.columns)
+    dialect = conn.dialect
+    if dialect.name == 'postgresql' and dialect.driver == 'psycopg':
+        return _copy_from_psycopg(conn, table, columns, rows, False)
+    return _copy_from_executemany(conn, table, columns, rows, batch_size)
+
+
+class _TableCopy:
+    def __init__(self, table, chunk_size, batch_size, checkpoint, progress):
+        self.table = table
+        self.key = list(table.primary_key.columns)
+        if not self.key:
+            raise ValueError(f'Table {table.name} does not have a primary '
+                             'key')
+        self.key_positions = [list(table.columns).index(column)
+                              for column in self.key]
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        self.checkpoint = checkpoint
+        self.progress = progress
+        self.partitions = []
+        self.resumed = False
+        self.rows = 0
+        self.copied = 0
+        self.total = None
+        self.start_time = None
+        self.lock = Lock()
+
+    def start(self, conn, partitions):
+        self.total = _estimate_table_count(conn, self.table)
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            with open(self.checkpoint, 'rt') as f:
+                state = json.load(f)
+            if state['table'] != self.table.key:
+                raise ValueError(f'The checkpoint is for table '
+                                 f'{state["table"]}')
+            converters = [_get_value_converter(column)
+                          for column in self.key]
+            for partition in state['partitions']:
+                if partition['last'] is not None:
+                    partition['last'] = [
+                        value if convert is None else convert(value)
+                        for convert, value in zip(converters,
+                                                  partition['last'])]
+            self.partitions = state['partitions']
+            self.rows = state['rows']
+            self.resumed = True
+        elif partitions > 1:
+            if len(self.key) != 1:
+                raise ValueError('Tables with composite primary keys cannot '
+                                 'be copied in partitions')
+            low, high = conn.execute(select(
+                func.min(self.key[0]), func.max(self.key[0]))).one()
+            if low is not None and (not isinstance(low, int) or
+                                    not isinstance(high, int)):
+                raise ValueError('The primary key must be an integer to copy '
+                                 'in partitions')
+            if low is not None:
+                count = min(partitions, high - low + 1)
+                size = -(-(high - low + 1) // count)  # rounded up
+                starts = list(range(low, high + 1, size))
+                # the first and last partitions are open ended
+                self.partitions = [
+                    {'start': start if i > 0 else None,
+                     'stop': start + size if i < len(starts) - 1 else None,
+                     'last': None} for i, start in enumerate(starts)]
+        if not self.partitions:
+            self.partitions = [{'start': None, 'stop': None, 'last': None}]
+        self.start_time = time.perf_counter()
+
+    def copy_partition(self, src_engine, dst_engine, index):
+        partition = self.partitions[index]
+        stmt = select(self.table).order_by(*self.key).limit(self.chunk_size)
+        if partition['start'] is not None:
+            stmt = stmt.where(self.key[0] >= partition['start'])
+        if partition['stop'] is not None:
+            stmt = stmt.where(self.key[0] < partition['stop'])
+        resumed = self.resumed
+        with src_engine.connect() as src_conn:
+            while True:
+                query = stmt
+                if partition['last'] is not None:
+                    query = stmt.where(_get_keyset_clause(
+                        self.key, partition['last']))
+                rows = src_conn.execute(query).all()
+                src_conn.rollback()  # do not hold locks between chunks
+                if not rows:
+                    break
+                keys = [tuple(row[i] for i in self.key_positions)
+                        for row in rows]
+                with dst_engine.begin() as dst_conn:
+                    if resumed:
+                        # the first chunk after the checkpoint may have been
+                        # written before the copy was interrupted
+                        _delete_keys(dst_conn, self.table, self.key, keys)
+                        resumed = False
+                    _write_rows(dst_conn, self.table, rows, self.batch_size)
+                partition['last'] = list(keys[-1])
+                self.advance(len(rows))
+                if len(rows) < self.chunk_size:
+                    break
+
+    def advance(self, count):
+        with self.lock:
+            self.rows += count
+            self.copied += count
+            if self.checkpoint:
+                with open(self.checkpoint + '.tmp', 'wt') as f:
+                    json.dump({'table': self.table.key, 'rows': self.rows,
+                               'partitions': self.partitions}, f,
+                              default=_format_value)
+                os.replace(self.checkpoint + '.tmp', self.checkpoint)
+            stats = self.get_stats()
+        if self.progress:
+            self.progress(stats)
+
+    def get_stats(self):
+        elapsed = time.perf_counter() - self.start_time
+        return {'table': self.table.name, 'rows': self.rows,
+                'total': self.total, 'elapsed': elapsed,
+                'rows_per_second': self.copied / elapsed if elapsed else 0.0}
+
+    def finish(self):
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+        return self.copied
+
+
+def _compile_query(conn, stmt):
+    return str(stmt.compile(dialect=conn.dialect,
+                            compile_kwargs={'literal_binds': True}))
+
+
+def _copy_to_psycopg(conn, stmt, output):
+    sql = f'COPY ({_compile_query(conn, stmt)}) TO STDOUT (FORMAT CSV)'
+    with conn.connection.driver_connection.cursor() as cursor:
+        with cursor.copy(sql) as copy:
+            for data in copy:
+                output.write(data)
+        return cursor.rowcount
+
+
+def _copy_to_asyncpg(conn, stmt, output):
+    status = await_only(conn.connection.driver_connection.copy_from_query(
+        _compile_query(conn, stmt), output=output, format='csv'))
+    return int(status.split()[-1])
+
+
+def _copy_to_csv(conn, stmt, output, batch_size):
+    result = conn.execution_options(stream_results=True).execute(stmt)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    count = 0
+    for rows in result.partitions(batch_size):
+        writer.writerows(rows)
+        output.write(buffer.getvalue().encode())
+        buffer.seek(0)
+        buffer.truncate()
+        count += len(rows)
+    return count
+
+
+def _estimate_table_count(conn, table):
+    dialect = conn.dialect.name
+    if dialect == 'postgresql':
+        count = conn.execute(text(
+            'SELECT reltuples FROM pg_class WHERE oid = to_regclass(:name)'),
+            {'name': conn.dialect.identifier_preparer.format_table(table)},
+        ).scalar()
+    elif dialect in ['mysql', 'mariadb']:
+        count = conn.execute(text(
+            'SELECT TABLE_ROWS FROM information_schema.TABLES '
+            'WHERE TABLE_SCHEMA = COALESCE(:schema, DATABASE()) '
+            'AND TABLE_NAME = :name'),
+            {'schema': table.schema, 'name': table.name}).scalar()
+    elif dialect == 'sqlite':
+        if conn.execute(text('SELECT 1 FROM sqlite_master '
+                             'WHERE name = \'sqlite_stat1\'')).first() is None:
+            return None  # the database was never analyzed
+        stat = conn.execute(text('SELECT stat FROM sqlite_stat1 '
+                                 'WHERE tbl = :name'),
+                            {'name': table.name}).scalar()
+        count = int(stat.split()[0]) if stat else None
+    else:
+        return None
+    # PostgreSQL reports -1 for tables that were never analyzed
+    return int(count) if count is not None and count >= 0 else None
+
+
+def _estimate_query_count(conn, stmt):
+    if conn.dialect.name != 'postgresql':
+        return None
+    plan = conn.exec_driver_sql(
+        'EXPLAIN (FORMAT JSON) ' + _compile_query(conn, stmt)).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+_count_caches = weakref.WeakKeyDictionary()
+
+
+def _get_count_cache(engine):
+    cache = _count_caches.get(engine)
+    if cache is None:
+        cache = _count_caches[engine] = {}
+        event.listen(engine, 'after_cursor_execute', _invalidate_counts)
+        event.listen(engine, 'commit', _invalidate_written_counts)
+        event.listen(engine, 'rollback', _invalidate_written_counts)
+    return cache
+
+
+def _invalidate_counts(conn, cursor, statement, parameters, context,
+                       executemany):
+    if context is not None and (
+            context.isinsert or context.isupdate or context.isdelete):
+        table = getattr(getattr(context.compiled, 'statement', None),
+                        'table', None)
+    elif not executemany and statement.lstrip(' \t\n(').upper().startswith(
+            READ_STATEMENTS):
+        return
+    else:
+        table = None  # a statement that may write to any table
+    cache = _count_caches.get(conn.engine, {})
+    if table is not None:
+        cache.pop(table, None)
+    else:
+        cache.clear()
+    conn.info.setdefault('alchemical_written_tables', set()).add(table)
+
+
+def _invalidate_written_counts(conn):
+    # counts cached by other connections while the transaction was in
+    # progress do not include its changes
+    cache = _count_caches.get(conn.engine, {})
+    tables = conn.info.pop('alchemical_written_tables', ())
+    if None in tables:
+        cache.clear()
+    for table in tables:
+        cache.pop(table, None)
+
+
+def _get_parameter_limit(dialect):
+    if dialect.name == 'sqlite':
+        version = getattr(dialect.dbapi, 'sqlite_version_info', (0,))
+        return 32766 if version >= (3, 32) else 999
+    return PARAMETER_LIMITS.get(dialect.name, 1000)
+
+
+def _make_column_batch(names, columns, format):
+    if format == 'arrow':
+        import pyarrow
+        return pyarrow.RecordBatch.from_arrays(
+            [pyarrow.array(column) for column in columns], names=names)
+    elif format == 'numpy':
+        import numpy
+        return {name: numpy.array(column)
+                for name, column in zip(names, columns)}
+    raise ValueError(f'Unsupported format: {format}')
+
+
+def _iter_column_batches(conn, stmt, format, batch_size):
+    # the rows are read from the DBAPI cursor, and the result processors of
+    # the column types are applied to whole columns, without creating rows
+    result = conn.execution_options(stream_results=True).execute(stmt)
+    try:
+        names = list(result.keys())
+        cursor = result.cursor
+        # streaming results buffer the first row when they are created, so
+        # that row is read through the result
+        pending = [tuple(row) for row in result.fetchmany(1)]
+        if not pending:
+            return  # the result closes the cursor when it is exhausted
+        columns = getattr(stmt, 'selected_columns', [])
+        if len(columns) == len(names):
+            processors = [
+                column.type.dialect_impl(conn.dialect).result_processor(
+                    conn.dialect, description[1])
+                for column, description in zip(columns, cursor.description)]
+        else:
+            processors = [None] * len(names)
+        while True:
+            size = batch_size - len(pending)
+            rows = cursor.fetchmany(size) if size > 0 else []
+            if not rows and not pending:
+                break
+            yield _make_column_batch(names, [
+                [*processed, *(values if processor is None
+                               else map(processor, values))]
+                for processed, values, processor in zip(
+                    list(zip(*pending)) or [()] * len(names),
+                    list(zip(*rows)) or [()] * len(names), processors)],
+                format)
+            if len(rows) < size:
+                break
+            pending = []
+    finally:
+        result.close()
+
+
+def _concat_column_batches(names, batches, format):
+    if format == 'arrow':
+        import pyarrow
+        if not batches:
+            return pyarrow.table({name: [] for name in names})
+        return pyarrow.Table.from_batches(batches)
+    import numpy
+    if not batches:
+        return {name: numpy.array([]) for name in names}
+    return {name: numpy.concatenate([batch[name] for batch in batches])
+            for name in names}
+
+
+_BaseLazyLoader = getattr(strategies, '_LazyLoader', None) or \
+    strategies.LazyLoader
+# batch loading is only enabled when the internal loading method of the lazy
+# loader accepts the arguments that the batch loader was written for
+_BATCH_LOADING = {'state', 'passive', 'loadopt', 'extra_criteria'} <= set(
+    pyinspect.signature(_BaseLazyLoader._load_for_state).parameters)
+_sibling_sets = weakref.WeakKeyDictionary()
+
+
+def _track_siblings(target, context):
+    siblings = context.attributes.get('alchemical_siblings')
+    if siblings is None:
+        siblings = context.attributes['alchemical_siblings'] = \
+            weakref.WeakSet()
+    state = inspect(target)
+    siblings.add(state)
+    _sibling_sets[state] = siblings
+
+
+def _apply_lazy_loading_policy(mapper, cls):
+    batch = getattr(cls, '__lazy_loading__', None) == 'batch'
+    tracked = False
+    for prop in mapper._props.values():
+        if not isinstance(prop, RelationshipProperty):
+            continue
+        if batch and prop.lazy in ('select', True):
+            prop.lazy = 'batch'
+            prop.strategy_key = (('lazy', 'batch'),)
+        tracked = tracked or prop.lazy == 'batch'
+    if tracked:
+        event.listen(mapper, 'load', _track_siblings)
+
+
+@RelationshipProperty.strategy_for(lazy='batch')
+class BatchLazyLoader(_BaseLazyLoader):
+    """Relationship loader that loads a relationship for all the objects
+    returned by the same query the first time it is accessed in one of them.
+
+    This loader is used for relationships configured with ``lazy='batch'``,
+    and for all the lazy loaded relationships of models that have the
+    ``__lazy_loading__`` attribute set to ``'batch'``.
+
+    With the asynchronous version of Alchemical, relationships cannot be
+    loaded implicitly. The models must include SQLAlchemy's ``AsyncAttrs``
+    mixin, so that the first access can be awaited through the
+    ``awaitable_attrs`` attribute.
+
+    Note: this loader extends the internal lazy loader of SQLAlchemy, and is
+    tested with SQLAlchemy 2.0 and 2.1. With versions in which the arguments
+    of the internal loading method are different, relationships are loaded
+    one object at a time.
+    """
+    __slots__ = ()
+
+    def _load_for_state(self, state, passive, *args, **kwargs):
+        if not _BATCH_LOADING or args or \
+                kwargs.get('loadopt') is not None or \
+                kwargs.get('extra_criteria') or state.key is None or \
+                not passive & PassiveFlag.SQL_OK or state.session_id is None:
+            return super()._load_for_state(state, passive, *args, **kwargs)
+        if self.use_get:
+            # many-to-one relationships that can be resolved from the
+            # identity map do not need a query
+            value = super()._load_for_state(
+                state, passive & ~PassiveFlag.SQL_OK, **kwargs)
+            if value is not LoaderCallableStatus.PASSIVE_NO_RESULT:
+                return value
+        session = state.session
+        prop = self.parent_property
+        states = [state] + [
+            sibling for sibling in _sibling_sets.get(state, ())
+            if sibling is not state and sibling.key is not None and
+            sibling.session_id == state.session_id and
+            sibling.mapper.isa(prop.parent) and self.key not in sibling.dict]
+        if passive & PassiveFlag.NO_AUTOFLUSH:
+            with session.no_autoflush:
+                values = self._batch_load(session, states)
+        else:
+            values = self._batch_load(session, states)
+        for sibling in states[1:]:
+            obj = sibling.obj()
+            if obj is not None:
+                set_committed_value(obj, self.key, values[sibling.identity])
+        return values[state.identity]
+
+    def _batch_load(self, session, states):
+        prop = self.parent_property
+        # the parent side is aliased so that self-referential relationships
+        # and the ordering of the relationship work without adaptation
+        parent = aliased(prop.parent.class_)
+        pk = [getattr(parent, prop.parent.get_property_by_column(c).key)
+              for c in prop.parent.primary_key]
+        column = pk[0] if len(pk) == 1 else tuple_(*pk)
+        chunk_size = _get_parameter_limit(
+            session.get_bind(prop.parent).dialect) // len(pk)
+        values = {s.identity: [] for s in states}
+        for i in range(0, len(states), chunk_size):
+            ids = [s.identity[0] if len(pk) == 1 else s.identity
+                   for s in states[i:i + chunk_size]]
+            stmt = select(*pk, prop.mapper).select_from(parent).join(
+                getattr(parent, self.key)).where(column.in_(ids))
+            if prop.order_by:
+                stmt = stmt.order_by(*prop.order_by)
+            for row in session.execute(stmt):
+                values[tuple(row[:len(pk)])].append(row[len(pk)])
+        if not prop.uselist:
+            values = {k: v[0] if v else None for k, v in values.items()}
+        return values
+
+
+class Record:
+    """Base class for the lightweight records returned by
+    :func:`BaseModel.fetch_lite`.
+
+    A subclass with a ``__slots__`` attribute for each column is generated for
+    each model.
+    """
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and \
+            self._astuple() == other._astuple()
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join(
+            f'{name}={getattr(self, name)!r}' for name in self.__slots__))
+
+    def _astuple(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def _asdict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+_record_classes = weakref.WeakKeyDictionary()
+
+
 class BaseModel:
     """This is the base model class from where all models inherit from."""
     __metadatas__ = {}
     __tablename__ = TableNamer()
 
     def __init_subclass__(cls, **kwargs):
+        partition_by = cls.__dict__.get('__partition_by__')
+        if partition_by is not None:
+            cls.__table_args__ = _add_partition_args(
+                cls.__dict__.get('__table_args__'), partition_by)
         bind_key = getattr(cls, '__bind_key__', None)
         if bind_key is not None:
             if bind_key not in cls.__metadatas__:
@@ -39,6 +1019,9 @@ class BaseModel:
                 getattr(cls, 'metadata', None) is not None:
             cls.__metadatas__[None] = cls.metadata
         super().__init_subclass__(**kwargs)
+        if partition_by is not None and '__table__' in cls.__dict__:
+            event.listen(cls.__table__, 'after_create',
+                         _create_initial_partitions)
 
     @classmethod
     def select(cls):
@@ -70,17 +1053,1254 @@ class BaseModel:
         """
         return delete(cls)
 
+    @classmethod
+    def count(cls, session, stmt=None, estimate=False, max_age=None):
+        """Return the number of rows in the table of this model.
+
+        :param session: the session to use.
+        :param stmt: a select statement on this model to count the rows of.
+                     The default is to count all the rows of the table.
+        :param estimate: if ``True``, an estimate obtained from the
+                         statistics kept by the database is returned when
+                         available, instead of an exact count.
+        :param max_age: the number of seconds an exact count can be cached.
+                        The cached counts of a table are discarded when the
+                        table is written, and all the cached counts of a
+                        database are discarded when a statement other than
+                        a query is executed on it without the table being
+                        known. The default is to not cache counts.
+
+        Estimates of the total number of rows are obtained from
+        ``pg_class.reltuples`` in PostgreSQL, ``information_schema.TABLES``
+        in MySQL and ``sqlite_stat1`` in SQLite, the latter only when the
+        database has been analyzed. When a statement is given, PostgreSQL
+        estimates the number of rows with ``EXPLAIN``. In all other cases an
+        exact count is returned.
+
+        Example::
+
+            with db.Session() as session:
+                total = User.count(session, estimate=True)
+
+        When used with an asynchronous session, this method is a coroutine.
+        """
+        if hasattr(session, 'sync_session'):
+            return session.run_sync(lambda sync_session: cls.count(
+                sync_session, stmt=stmt, estimate=estimate, max_age=max_age))
+        table = cls.__table__
+        whole_table = stmt is None or stmt.compare(select(cls))
+        conn = session.connection(bind_arguments={'mapper': inspect(cls)})
+        if estimate:
+            count = _estimate_table_count(conn, table) if whole_table \
+                else _estimate_query_count(conn, stmt)
+            if count is not None:
+                return count
+
+        if whole_table:
+            count_stmt = select(func.count()).select_from(table)
+        else:
+            count_stmt = select(func.count()).select_from(
+                stmt.order_by(None).subquery())
+        written = conn.info.get('alchemical_written_tables', ())
+        if not max_age or table in written or None in written:
+            # the transaction has uncommitted changes to the table
+            return session.scalar(count_stmt)
+        compiled = count_stmt.compile(dialect=conn.dialect)
+        key = (str(compiled), repr(sorted(compiled.params.items())))
+        counts = _get_count_cache(conn.engine).setdefault(table, {})
+        cached = counts.get(key)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+        count = session.scalar(count_stmt)
+        counts[key] = (time.monotonic() + max_age, count)
+        return count
+
+    @classmethod
+    def get_many(cls, session, ids, chunk_size=None):
+        """Return the objects of this model with the given primary keys.
+
+        :param session: the session to use.
+        :param ids: an iterable with the primary keys of the objects to
+                    return. For models with a composite primary key, each
+                    element must be a tuple.
+        :param chunk_size: the maximum number of primary keys to send in a
+                           query. The default is to use the bound parameter
+                           limit of the database.
+
+        The return value is a list with the objects in the same order as the
+        given primary keys, with ``None`` for keys that do not exist. Objects
+        that are present in the identity map of the session are returned
+        without querying the database. The remaining objects are loaded with
+        ``IN`` queries, or with a single ``= ANY(:ids)`` query that sends all
+        the keys in an array parameter in PostgreSQL.
+
+        Example::
+
+            with db.Session() as session:
+                users = User.get_many(session, [3, 1, 2])
+
+        When used with an asynchronous session, this method is a coroutine.
+        """
+        if hasattr(session, 'sync_session'):
+            return session.run_sync(lambda sync_session: cls.get_many(
+                sync_session, ids, chunk_size=chunk_size))
+        mapper = inspect(cls)
+        pk = mapper.primary_key
+        keys = [tuple(id) if len(pk) > 1 else (id,) for id in ids]
+        found = {}
+        missing = []
+        for key in dict.fromkeys(keys):
+            obj = session.identity_map.get(
+                mapper.identity_key_from_primary_key(key))
+            if obj is not None and not inspect(obj).expired:
+                found[key] = obj
+            else:
+                missing.append(key)
+        if not missing:
+            return [found.get(key) for key in keys]
+
+        dialect = session.get_bind(mapper).dialect
+        if len(pk) == 1 and dialect.name == 'postgresql' and \
+                chunk_size is None:
+            stmts = [select(cls).where(pk[0] == any_(bindparam(
+                'ids', [key[0] for key in missing],
+                type_=ARRAY(pk[0].type))))]
+        else:
+            if chunk_size is None:
+                chunk_size = _get_parameter_limit(dialect) // len(pk)
+            column = pk[0] if len(pk) == 1 else tuple_(*pk)
+            stmts = [
+                select(cls).where(column.in_([
+                    key[0] if len(pk) == 1 else key
+                    for key in missing[i:i + chunk_size]]))
+                for i in range(0, len(missing), chunk_size)]
+        for stmt in stmts:
+            for obj in session.scalars(stmt):
+                found[tuple(mapper.primary_key_from_instance(obj))] = obj
+        return [found.get(key) for key in keys]
+
+    @classmethod
+    def fetch_lite(cls, session, stmt=None, format='record'):
+        """Run a query on this model and return lightweight results.
+
+        :param session: the session to use.
+        :param stmt: the select statement to run. The default is to return all
+                     the rows of the table.
+        :param format: ``'record'`` to return instances of a generated class
+                       with a ``__slots__`` attribute for each column,
+                       ``'dict'`` to return dictionaries, or ``'tuple'`` to
+                       return tuples.
+
+        The columns of the model are selected instead of the model itself, so
+        no model instances are created, and nothing is added to the identity
+        map of the session. Statements that select individual columns are also
+        accepted. The results cannot be modified and saved back to the
+        database. The return value is a list.
+
+        Example::
+
+            with db.Session() as session:
+                users = User.fetch_lite(session, User.select().where(
+                    User.name.startswith('s')))
+                return [user._asdict() for user in users]
+
+        When used with an asynchronous session, this method is a coroutine.
+        """
+        if hasattr(session, 'sync_session'):
+            return session.run_sync(lambda sync_session: cls.fetch_lite(
+                sync_session, stmt=stmt, format=format))
+        if stmt is None:
+            stmt = cls.select()
+        descriptions = stmt.column_descriptions
+        whole_model = len(descriptions) == 1 and descriptions[0]['expr'] is cls
+        if whole_model:
+            stmt = stmt.with_only_columns(*[
+                prop.columns[0].label(prop.key)
+                for prop in inspect(cls).column_attrs])
+        result = session.execute(stmt)
+        names = tuple(result.keys())
+        if format == 'tuple':
+            return [tuple(row) for row in result]
+        elif format == 'dict':
+            return [dict(zip(names, row)) for row in result]
+        elif format == 'record':
+            record_class = _record_classes.get(cls)
+            if record_class is None or record_class.__slots__ != names:
+                record_class = type(f'{cls.__name__}Record', (Record,),
+                                    {'__slots__': names})
+                if whole_model:
+                    _record_classes[cls] = record_class
+            return [record_class(*row) for row in result]
+        raise ValueError(f'Unsupported format: {format}')
+
+    @classmethod
+    def copy_from(cls, session, rows, columns=None, binary=False,
+                  batch_size=1000):
+        """Bulk load rows into the table of this model.
+
+        :param session: the session to use. The rows are inserted in the
+                        current transaction of the session.
+        :param rows: an iterable with the rows to insert. Each row can be a
+                     sequence with the values of the columns, or a dictionary
+                     with column names as keys.
+        :param columns: the list of column names that are given in each row.
+                        The default is to use all the columns of the table, in
+                        order.
+        :param binary: if ``True``, the data is sent to the database in binary
+                       format instead of text. This only affects the psycopg
+                       driver.
+        :param batch_size: the number of rows to insert in each batch when the
+                           database does not support ``COPY``.
+
+        On PostgreSQL with the psycopg or asyncpg drivers, the rows are
+        streamed to the database with ``COPY ... FROM STDIN``. Other databases
+        insert the rows in batches with ``executemany``. The rows are not added
+        to the session. The return value is the number of rows inserted.
+
+        Example::
+
+            with db.begin() as session:
+                User.copy_from(session, [('susan',), ('john',)],
+                               columns=['name'])
+
+        When used with an asynchronous session, this method is a coroutine.
+        """
+        if hasattr(session, 'sync_session'):
+            return session.run_sync(lambda sync_session: cls.copy_from(
+                sync_session, rows, columns=columns, binary=binary,
+                batch_size=batch_size))
+        table = cls.__table__
+        columns = [table.c[name] for name in columns] if columns \
+            else list(table.columns)
+        rows = (tuple(row[column.name] for column in columns)
+                if isinstance(row, Mapping) else row for row in rows)
+        conn = session.connection(bind_arguments={'mapper': cls})
+        if isinstance(session, AlchemicalSession):
+            # COPY statements do not go through the cursor events
+            session._uncommitted = True
+        driver = conn.dialect.driver if conn.dialect.name == 'postgresql' \
+            else None
+        if driver == 'psycopg':
+            return _copy_from_psycopg(conn, table, columns, rows, binary)
+        elif driver == 'asyncpg':
+            return _copy_from_asyncpg(conn, table, columns, rows)
+        return _copy_from_executemany(conn, table, columns, rows, batch_size)
+
+    @classmethod
+    def copy_to(cls, session, output, stmt=None, batch_size=1000):
+        """Export the results of a query on this model in CSV format.
+
+        :param session: the session to use.
+        :param output: a binary file-like object where the CSV data is
+                       written.
+        :param stmt: the select statement to export. The default is to export
+                     all the rows of the table.
+        :param batch_size: the number of rows to fetch in each batch when the
+                           database does not support ``COPY``.
+
+        On PostgreSQL with the psycopg or asyncpg drivers, the data is
+        streamed from the database with ``COPY ... TO STDOUT``. Other databases
+        run the query and format the rows in batches. The return value is the
+        number of rows exported.
+
+        Example::
+
+            with db.Session() as session, open('users.csv', 'wb') as f:
+                User.copy_to(session, f, User.select().order_by(User.name))
+
+        When used with an asynchronous session, this method is a coroutine.
+        """
+        if hasattr(session, 'sync_session'):
+            return session.run_sync(lambda sync_session: cls.copy_to(
+                sync_session, output, stmt=stmt, batch_size=batch_size))
+        if stmt is None:
+            stmt = select(cls.__table__)
+        conn = session.connection(bind_arguments={'mapper': cls})
+        driver = conn.dialect.driver if conn.dialect.name == 'postgresql' \
+            else None
+        if driver == 'psycopg':
+            return _copy_to_psycopg(conn, stmt, output)
+        elif driver == 'asyncpg':
+            return _copy_to_asyncpg(conn, stmt, output)
+        return _copy_to_csv(conn, stmt, output, batch_size)
+
+
+# only the mappers of Alchemical models are modified
+event.listen(BaseModel, 'before_mapper_configured',
+             _apply_lazy_loading_policy, propagate=True)
+
 
 class Model(BaseModel, DeclarativeBase):
     __abstract__ = True
 
 
+class StatementTimeout(OperationalError):
+    """Exception raised when a statement is interrupted because it exceeded
+    its timeout."""
+
+
+def _get_error_code(orig):
+    sqlstate = getattr(orig, 'sqlstate', None) or getattr(orig, 'pgcode', None)
+    args = getattr(orig, 'args', None) or (None,)
+    return sqlstate, args[0]
+
+
+def is_transient_error(error):
+    """Return ``True`` if the given error is likely to go away on a retry.
+
+    :param error: the exception raised by SQLAlchemy.
+
+    Serialization failures, deadlocks, locked SQLite databases and dropped
+    connections are considered transient.
+    """
+    if not isinstance(error, DBAPIError):
+        return False
+    if error.connection_invalidated:
+        return True
+    sqlstate, code = _get_error_code(error.orig)
+    if sqlstate in TRANSIENT_SQLSTATES or code in TRANSIENT_MYSQL_ERRORS:
+        return True
+    return 'database is locked' in str(error.orig)
+
+
+def retry_delay(attempt, backoff):
+    """Return the number of seconds to wait before retrying a transaction.
+
+    The delay grows exponentially with the attempt number, and is randomized
+    so that concurrent clients do not retry at the same time.
+    """
+    return random.uniform(0, backoff * 2 ** attempt)
+
+
+class AlchemicalSession(Session):
+    """The session class used by Alchemical.
+
+    :param statement_timeout: the maximum number of seconds each statement
+                              issued by this session is allowed to run.
+    :param deadline: a ``time.monotonic()`` value after which statements issued
+                     by this session are interrupted. The default is to use
+                     the deadline of the current request, if one is set.
+
+    All other arguments are passed to the SQLAlchemy ``Session`` class. The
+    timeout is configured at the start of each transaction, using the
+    ``statement_timeout`` setting in PostgreSQL, ``max_execution_time`` in
+    MySQL, ``max_statement_time`` in MariaDB and a progress handler in SQLite.
+    A :class:`StatementTimeout` exception is raised when a statement is
+    interrupted.
+
+    The ``stats`` attribute of the session is a dictionary that counts the
+    transactions that were started, the statements that were executed, how
+    many of those statements were not queries, and the flushes that were
+    issued by the session.
+    """
+    def __init__(self, *args, statement_timeout=None, deadline=None,
+                 **kwargs):
+        super().__init__(*args, **kwargs)
+        self.statement_timeout = statement_timeout
+        self.deadline = deadline if deadline is not None \
+            else request_deadline.get()
+        self.stats = {'transactions': 0, 'statements': 0, 'writes': 0,
+                      'flushes': 0}
+        self._uncommitted = False
+        self._connection_infos = []
+
+    def has_changes(self):
+        """Return ``True`` if the session has changes that need a commit.
+
+        This includes pending changes to objects, as well as flushes and
+        statements that were not queries issued in the current transaction,
+        including those executed directly on the connections of the session.
+        """
+        return bool(self._uncommitted or self.new or self.deleted or
+                    self.dirty)
+
+    def get_statement_timeout(self):
+        """Return the timeout in seconds to apply to the next statement."""
+        timeout = self.statement_timeout
+        if self.deadline is not None:
+            remaining = max(self.deadline - time.monotonic(), 0.001)
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        return timeout
+
+
+@event.listens_for(AlchemicalSession, 'after_begin')
+def _count_transaction(session, transaction, connection):
+    session.stats['transactions'] += 1
+
+
+@event.listens_for(AlchemicalSession, 'do_orm_execute')
+def _count_statement(orm_execute_state):
+    stats = orm_execute_state.session.stats
+    stats['statements'] += 1
+    if not orm_execute_state.is_select:
+        stats['writes'] += 1
+        orm_execute_state.session._uncommitted = True
+
+
+@event.listens_for(AlchemicalSession, 'after_flush')
+def _count_flush(session, flush_context):
+    session.stats['flushes'] += 1
+    session._uncommitted = True
+
+
+@event.listens_for(AlchemicalSession, 'after_transaction_end')
+def _end_transaction(session, transaction):
+    if transaction.parent is None:
+        session._uncommitted = False
+        for info in session._connection_infos:
+            info.pop('alchemical_session', None)
+        session._connection_infos = []
+
+
+@event.listens_for(AlchemicalSession, 'after_begin')
+def _set_statement_timeout(session, transaction, connection):
+    timeout = session.get_statement_timeout()
+    if timeout is None:
+        return
+    dialect = connection.dialect
+    ms = max(int(timeout * 1000), 1)
+    if dialect.name == 'postgresql':
+        connection.exec_driver_sql(f'SET LOCAL statement_timeout = {ms}')
+    elif getattr(dialect, 'is_mariadb', False):
+        connection.exec_driver_sql(
+            f'SET SESSION max_statement_time = {ms / 1000}')
+        connection.info['alchemical_reset_timeout'] = 'max_statement_time'
+    elif dialect.name in ['mysql', 'mariadb']:
+        connection.exec_driver_sql(f'SET SESSION max_execution_time = {ms}')
+        connection.info['alchemical_reset_timeout'] = 'max_execution_time'
+    elif dialect.name == 'sqlite':
+        info = connection.info
+        if 'alchemical_statement_timeout' not in info:
+            def progress_handler():
+                timeout = info.get('alchemical_statement_timeout')
+                start = info.get('alchemical_statement_start')
+                if timeout is not None and start is not None and \
+                        time.monotonic() - start > timeout:
+                    return 1  # interrupt the statement
+                return 0
+
+            ret = connection.connection.driver_connection \
+                .set_progress_handler(progress_handler, 1000)
+            if pyinspect.isawaitable(ret):
+                await_only(ret)
+        info['alchemical_statement_timeout'] = timeout
+
+
+@event.listens_for(AlchemicalSession, 'after_begin')
+def _track_connection_writes(session, transaction, connection):
+    # registered after the statement timeout is configured, so that the
+    # statements that set it are not considered writes
+    connection.info['alchemical_session'] = weakref.ref(session)
+    session._connection_infos.append(connection.info)
+
+
+def _track_write(conn, cursor, statement, parameters, context, executemany):
+    ref = conn.info.get('alchemical_session')
+    if ref is not None and (context.isinsert or context.isupdate or
+                            context.isdelete or cursor.description is None):
+        session = ref()
+        if session is not None:
+            session._uncommitted = True
+
+
+def _start_statement_timer(conn, cursor, statement, parameters, context,
+                           executemany):
+    if 'alchemical_statement_timeout' in conn.info:
+        conn.info['alchemical_statement_start'] = time.monotonic()
+
+
+def _reset_statement_timeout(dbapi_connection, connection_record):
+    info = connection_record.info
+    info.pop('alchemical_session', None)
+    if info.get('alchemical_statement_timeout') is not None:
+        info['alchemical_statement_timeout'] = None
+    setting = info.pop('alchemical_reset_timeout', None)
+    if setting and dbapi_connection is not None:
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f'SET SESSION {setting} = DEFAULT')
+        cursor.close()
+
+
+def _raise_statement_timeout(context):
+    orig = context.original_exception
+    sqlstate, code = _get_error_code(orig)
+    if sqlstate in TIMEOUT_SQLSTATES or code in TIMEOUT_MYSQL_ERRORS or (
+            context.dialect.name == 'sqlite' and
+            str(orig) == 'interrupted'):
+        raise StatementTimeout(context.statement, context.parameters,
+                               orig) from orig
+
+
+class DatabaseTiming:
+    """Database time used by a unit of work such as a request.
+
+    The ``binds`` attribute is a dictionary with bind keys as keys (``None``
+    for the default database), and dictionaries with the ``time``,
+    ``statements``, ``checkout`` and ``commit`` metrics of each bind as
+    values. The ``time`` metric is the time spent executing statements,
+    ``checkout`` is the time spent opening new connections for the pool, and
+    ``commit`` is the time spent committing transactions. All times are in
+    seconds.
+
+    Timings are only recorded for database instances created with the
+    ``timing`` option enabled.
+    """
+    def __init__(self):
+        self.binds = {}
+
+    def add(self, bind_key, metric, value):
+        """Add a value to a metric of a bind."""
+        metrics = self.binds.get(bind_key)
+        if metrics is None:
+            metrics = self.binds[bind_key] = {
+                'time': 0.0, 'statements': 0, 'checkout': 0.0, 'commit': 0.0}
+        metrics[metric] += value
+
+    @property
+    def total(self):
+        """The total database time, in seconds, across all binds."""
+        return sum(m['time'] + m['checkout'] + m['commit']
+                   for m in self.binds.values())
+
+    def server_timing(self):
+        """Return the timings formatted as a ``Server-Timing`` header."""
+        entries = []
+        for bind_key, m in self.binds.items():
+            name = 'db' if bind_key is None \
+                else 'db.' + re.sub(r'[^\w.-]', '_', str(bind_key))
+            entries += [
+                f'{name};dur={m["time"] * 1000:.2f};'
+                f'desc="{m["statements"]} statements"',
+                f'{name}-checkout;dur={m["checkout"] * 1000:.2f}',
+                f'{name}-commit;dur={m["commit"] * 1000:.2f}',
+            ]
+        if len(self.binds) > 1:
+            entries.append(f'db-total;dur={self.total * 1000:.2f}')
+        return ', '.join(entries)
+
+
+@contextmanager
+def track_database_time():
+    """Record the database time used in a block of code.
+
+    This function is a context manager that returns a :class:`DatabaseTiming`
+    instance with the timings of all the database work done inside the block.
+    """
+    timing = DatabaseTiming()
+    token = database_timing.set(timing)
+    try:
+        yield timing
+    finally:
+        database_timing.reset(token)
+
+
+def _add_timing_instrumentation(engine, bind_key):
+    engine = getattr(engine, 'sync_engine', engine)
+
+    def start(info, key):
+        if database_timing.get() is not None:
+            info[key] = time.perf_counter()
+
+    def stop(info, key, metric):
+        start = info.pop(key, None)
+        timing = database_timing.get()
+        if timing is not None and start is not None:
+            timing.add(bind_key, metric, time.perf_counter() - start)
+            return True
+        return False
+
+    def start_timer(conn, cursor, statement, parameters, context,
+                    executemany):
+        stop(conn.info, 'alchemical_commit_start', 'commit')
+        start(conn.info, 'alchemical_timing_start')
+
+    def stop_timer(conn, cursor, statement, parameters, context,
+                   executemany):
+        if stop(conn.info, 'alchemical_timing_start', 'time'):
+            database_timing.get().add(bind_key, 'statements', 1)
+
+    # a commit ends when the connection starts another transaction, executes
+    # another statement or is returned to the pool, whichever happens first
+    def start_commit(conn):
+        start(conn.info, 'alchemical_commit_start')
+
+    def stop_commit(conn):
+        stop(conn.info, 'alchemical_commit_start', 'commit')
+
+    def reset(connection_record, **kwargs):
+        stop(connection_record.info, 'alchemical_commit_start', 'commit')
+
+    # new connections are timed from the driver call to the pool connect event
+    def start_connect(dialect, conn_rec, cargs, cparams):
+        start(conn_rec.info, 'alchemical_connect_start')
+
+    def stop_connect(dbapi_connection, connection_record):
+        stop(connection_record.info, 'alchemical_connect_start', 'checkout')
+
+    event.listen(engine, 'before_cursor_execute', start_timer)
+    event.listen(engine, 'after_cursor_execute', stop_timer)
+    event.listen(engine, 'commit', start_commit)
+    event.listen(engine, 'begin', stop_commit)
+    event.listen(engine, 'do_connect', start_connect, insert=True)
+    event.listen(engine.pool, 'connect', stop_connect)
+    event.listen(engine.pool, 'reset', reset, named=True)
+
+
+def _get_table_column(element):
+    if not isinstance(element, Column):
+        return None
+    table = element.table
+    while table is not None and not isinstance(table, Table):
+        table = getattr(table, 'element', None)  # aliases
+    return None if table is None else (table.fullname, element.name)
+
+
+def _get_statement_columns(compiled):
+    stmt = compiled.statement
+    usage = {}
+
+    def add(kind, element):
+        column = _get_table_column(element)
+        if column is not None:
+            columns = usage.setdefault(column[0], {
+                'equality': [], 'range': [], 'join': [], 'order_by': []})
+            if column[1] not in columns[kind]:
+                columns[kind].append(column[1])
+
+    def add_predicates(clause, join=False):
+        for element in visitors.iterate(clause):
+            if not isinstance(element, BinaryExpression):
+                continue
+            if join or (isinstance(element.left, Column) and
+                        isinstance(element.right, Column)):
+                kind = 'join'
+            elif element.operator in EQUALITY_OPERATORS:
+                kind = 'equality'
+            elif element.operator in RANGE_OPERATORS:
+                kind = 'range'
+            else:
+                continue
+            add(kind, element.left)
+            add(kind, element.right)
+
+    if getattr(stmt, 'whereclause', None) is not None:
+        add_predicates(stmt.whereclause)
+    state = getattr(compiled, 'compile_state', None)
+    for from_clause in getattr(state, 'from_clauses', None) or []:
+        for element in visitors.iterate(from_clause):
+            if isinstance(element, Join) and element.onclause is not None:
+                add_predicates(element.onclause, join=True)
+    for clause in getattr(stmt, '_order_by_clauses', ()):
+        for element in visitors.iterate(clause):
+            if isinstance(element, Column):
+                add('order_by', element)
+                break
+    return usage
+
+
+class StatementLog:
+    """A log of the table columns used by SQL statements.
+
+    :param entries: an optional iterable with entries to add to the log.
+
+    Each entry in the log records the columns of a table that are used in the
+    ``WHERE``, ``JOIN`` and ``ORDER BY`` clauses of a group of similar
+    statements, along with the number of times these statements were
+    executed and their total duration in seconds. Entries are dictionaries
+    with ``bind``, ``table``, ``equality``, ``range``, ``join``,
+    ``order_by``, ``count`` and ``duration`` keys.
+
+    Logs are normally recorded with the
+    :func:`Alchemical.capture_statements` context manager, and are used to
+    find missing indexes with :func:`Alchemical.advise_indexes`.
+    """
+    def __init__(self, entries=None):
+        self.entries = {}
+        self.lock = Lock()
+        self._columns = weakref.WeakKeyDictionary()
+        for entry in entries or []:
+            self.add_entry(entry)
+
+    def add_entry(self, entry):
+        """Add an entry to the log.
+
+        :param entry: the entry to add. If the log already has an entry for
+                      the same columns of the table, the count and duration
+                      of the two entries are combined.
+        """
+        entry = {'bind': entry.get('bind'), 'table': entry['table'],
+                 'equality': list(entry.get('equality', [])),
+                 'range': list(entry.get('range', [])),
+                 'join': list(entry.get('join', [])),
+                 'order_by': list(entry.get('order_by', [])),
+                 'count': entry.get('count', 1),
+                 'duration': entry.get('duration', 0.0)}
+        key = (entry['bind'], entry['table'], tuple(entry['equality']),
+               tuple(entry['range']), tuple(entry['join']),
+               tuple(entry['order_by']))
+        with self.lock:
+            if key in self.entries:
+                self.entries[key]['count'] += entry['count']
+                self.entries[key]['duration'] += entry['duration']
+            else:
+                self.entries[key] = entry
+
+    def add_statement(self, bind_key, compiled, duration=0.0):
+        """Add a compiled statement to the log.
+
+        :param bind_key: the bind in which the statement was executed.
+        :param compiled: the compiled statement.
+        :param duration: the execution time of the statement in seconds.
+        """
+        usage = self._columns.get(compiled)
+        if usage is None:
+            usage = self._columns[compiled] = _get_statement_columns(compiled)
+        for table, columns in usage.items():
+            self.add_entry({'bind': bind_key, 'table': table, **columns,
+                            'duration': duration})
+
+    def save(self, path):
+        """Write the log to a file in JSON lines format.
+
+        :param path: the path of the file.
+        """
+        with open(path, 'wt') as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry) + '\n')
+
+    @classmethod
+    def load(cls, path):
+        """Load a log from a file in JSON lines format.
+
+        :param path: the path of the file.
+        """
+        with open(path, 'rt') as f:
+            return cls(json.loads(line) for line in f if line.strip())
+
+
+def _get_index_candidates(entry):
+    equality = sorted(set(entry['equality']))
+    candidates = []
+    columns = list(equality)
+    range_columns = [c for c in entry['range'] if c not in equality]
+    if range_columns:
+        columns.append(range_columns[0])
+    else:
+        columns += [c for c in entry['order_by'] if c not in equality]
+    if columns:
+        candidates.append(tuple(columns))
+    candidates += [(column,) for column in entry['join']]
+    return candidates
+
+
+def _get_existing_indexes(conn, table):
+    indexes = [tuple(c.name for c in table.primary_key)]
+    indexes += [tuple(c.name for c in index.columns)
+                for index in table.indexes]
+    indexes += [tuple(constraint.columns.keys())
+                for constraint in table.constraints
+                if isinstance(constraint, UniqueConstraint)]
+    inspector = inspect(conn)
+    if inspector.has_table(table.name, schema=table.schema):
+        indexes.append(tuple(inspector.get_pk_constraint(
+            table.name, schema=table.schema)['constrained_columns']))
+        for index in inspector.get_indexes(table.name, schema=table.schema):
+            indexes.append(tuple(index['column_names']))
+        for constraint in inspector.get_unique_constraints(
+                table.name, schema=table.schema):
+            indexes.append(tuple(constraint['column_names']))
+    return indexes
+
+
+def _get_index_name(table, columns, naming_convention):
+    template = (naming_convention or {}).get('ix', 'ix_%(column_0_label)s')
+    names = '_'.join(columns)
+    return template % {
+        'table_name': table.name,
+        'column_0_name': names, 'column_0_N_name': names,
+        'column_0N_name': ''.join(columns),
+        'column_0_label': f'{table.name}_{names}',
+        'column_0_N_label': f'{table.name}_{names}',
+        'column_0N_label': table.name + ''.join(columns),
+    }
+
+
+def _add_partition_args(table_args, partition_by):
+    method, column, *interval = partition_by
+    method = method.lower()
+    if method not in ('range', 'list', 'hash'):
+        raise ValueError(f'Invalid partitioning method: {method}')
+    interval = interval[0] if interval else \
+        ('month' if method == 'range' else None)
+    if method == 'range' and interval not in PARTITION_INTERVALS and (
+            not isinstance(interval, int) or interval <= 0):
+        raise ValueError(f'Invalid partition interval: {interval}')
+    options = {
+        'postgresql_partition_by': f'{method.upper()} ({column})',
+        'info': {'alchemical_partition_by': (method, column, interval)},
+    }
+    if table_args is None:
+        return options
+    if isinstance(table_args, dict):
+        args, kwargs = (), table_args
+    elif table_args and isinstance(table_args[-1], dict):
+        args, kwargs = tuple(table_args[:-1]), table_args[-1]
+    else:
+        args, kwargs = tuple(table_args), {}
+    options['info'] = {**kwargs.get('info', {}), **options['info']}
+    return args + ({**kwargs, **options},)
+
+
+def _get_partition_start(value, interval):
+    if isinstance(interval, int):
+        return value // interval * interval
+    if isinstance(value, datetime):
+        value = value.date()
+    if interval == 'week':
+        return value - timedelta(days=value.weekday())
+    elif interval == 'month':
+        return value.replace(day=1)
+    elif interval == 'year':
+        return value.replace(month=1, day=1)
+    return value
+
+
+def _shift_partition_start(start, interval, count):
+    if isinstance(interval, int):
+        return start + interval * count
+    elif interval == 'day':
+        return start + timedelta(days=count)
+    elif interval == 'week':
+        return start + timedelta(days=7 * count)
+    elif interval == 'month':
+        month = start.year * 12 + start.month - 1 + count
+        return date(month // 12, month % 12 + 1, 1)
+    return date(start.year + count, 1, 1)
+
+
+def _get_partition_name(table, start, interval):
+    if isinstance(interval, int):
+        label = str(start).replace('-', 'm')
+    else:
+        label = start.strftime(PARTITION_INTERVALS[interval])
+    template = (table.metadata.naming_convention or {}).get(
+        'partition', _PARTITION_NAME)
+    return template % {'table_name': table.name, 'partition_range': label}
+
+
+def _get_partition_spec(table):
+    spec = table.info.get('alchemical_partition_by')
+    if spec is None or spec[0] != 'range':
+        raise ValueError(f'Table {table.name} is not range partitioned')
+    return spec
+
+
+def _get_current_partition_value(conn, table, column, interval):
+    if isinstance(interval, int):
+        return conn.execute(text(
+            f'SELECT coalesce(max({column}), 0) FROM '
+            f'{conn.dialect.identifier_preparer.format_table(table)}'
+        )).scalar()
+    return datetime.now(timezone.utc).date()
+
+
+def _get_partitions(conn, table):
+    table_name = conn.dialect.identifier_preparer.format_table(table)
+    return dict(conn.execute(text(
+        'SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) '
+        'FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+        'WHERE i.inhparent = to_regclass(:name)'), {'name': table_name}))
+
+
+def _format_partition_name(conn, table, name):
+    preparer = conn.dialect.identifier_preparer
+    if table.schema:
+        return f'{preparer.quote_schema(table.schema)}.{preparer.quote(name)}'
+    return preparer.quote(name)
+
+
+def create_partitions(conn, table, ahead=3, now=None):
+    """Create the partitions of a range partitioned table.
+
+    :param conn: the database connection to use.
+    :param table: the partitioned table, given as a model class or a
+                  ``Table`` instance.
+    :param ahead: the number of partitions to create after the one that
+                  holds the current value.
+    :param now: the current value of the partitioning column. The default is
+                today's date for time intervals, or the largest value stored
+                in the table for integer intervals.
+
+    Partitions that already exist are not modified. The return value is a
+    list with the names of the partitions that were created. This function
+    does nothing on databases other than PostgreSQL.
+
+    This function can be used in migration scripts, with the connection
+    returned by ``op.get_bind()``.
+    """
+    table = getattr(table, '__table__', table)
+    _, column, interval = _get_partition_spec(table)
+    if conn.dialect.name != 'postgresql':
+        return []
+    if now is None:
+        now = _get_current_partition_value(conn, table, column, interval)
+    existing = _get_partitions(conn, table)
+    table_name = conn.dialect.identifier_preparer.format_table(table)
+    start = _get_partition_start(now, interval)
+    created = []
+    for i in range(ahead + 1):
+        end = _shift_partition_start(start, interval, 1)
+        name = _get_partition_name(table, start, interval)
+        if name not in existing:
+            lower, upper = (f"'{start.isoformat()}'", f"'{end.isoformat()}'") \
+                if isinstance(start, date) else (start, end)
+            conn.exec_driver_sql(
+                f'CREATE TABLE IF NOT EXISTS '
+                f'{_format_partition_name(conn, table, name)} PARTITION OF '
+                f'{table_name} FOR VALUES FROM ({lower}) TO ({upper})')
+            logger.info('Created partition %s of table %s', name, table.name)
+            created.append(name)
+        start = end
+    return created
+
+
+def drop_partitions(conn, table, retain, now=None):
+    """Drop the old partitions of a range partitioned table.
+
+    :param conn: the database connection to use.
+    :param table: the partitioned table, given as a model class or a
+                  ``Table`` instance.
+    :param retain: the number of partitions to keep before the one that holds
+                   the current value. Partitions older than these are
+                   dropped, along with their data.
+    :param now: the current value of the partitioning column. The default is
+                today's date for time intervals, or the largest value stored
+                in the table for integer intervals.
+
+    The return value is a list with the names of the partitions that were
+    dropped. This function does nothing on databases other than PostgreSQL.
+    """
+    table = getattr(table, '__table__', table)
+    _, column, interval = _get_partition_spec(table)
+    if conn.dialect.name != 'postgresql':
+        return []
+    if now is None:
+        now = _get_current_partition_value(conn, table, column, interval)
+    cutoff = _shift_partition_start(_get_partition_start(now, interval),
+                                    interval, -retain)
+    dropped = []
+    for name, bound in sorted(_get_partitions(conn, table).items()):
+        match = re.search(r"TO \('?([^')]*)'?\)", bound or '')
+        if match is None or match[1] == 'MAXVALUE':
+            continue  # default partition or unbounded range
+        if isinstance(cutoff, int):
+            expired = int(match[1]) <= cutoff
+        else:
+            expired = match[1][:10] <= cutoff.isoformat()
+        if expired:
+            conn.exec_driver_sql(
+                f'DROP TABLE {_format_partition_name(conn, table, name)}')
+            logger.info('Dropped partition %s of table %s', name, table.name)
+            dropped.append(name)
+    return dropped
+
+
+def _create_initial_partitions(table, conn, **kwargs):
+    if table.info['alchemical_partition_by'][0] == 'range':
+        create_partitions(conn, table)
+
+
+def check_pool(engine, min_idle=0, max_checks=10):
+    """Ping the idle connections in the pool of a synchronous engine.
+
+    :param engine: the engine to check.
+    :param min_idle: the minimum number of idle connections to keep in the
+                     pool. New connections are opened as needed, without
+                     exceeding the size of the pool.
+    :param max_checks: the maximum number of connections to ping in a call.
+                       Pass ``None`` to ping all the idle connections.
+
+    The idle connections are checked one at a time, so that the pool never
+    loses more than one of them while the check runs. Pools that return the
+    most recently used connection first (``pool_use_lifo=True``) return the
+    connection that was just checked again, so in that case the connections
+    that were already checked are kept out of the pool until the check ends.
+    Connections that fail the ping are invalidated, so that they are replaced
+    with new connections the next time they are used. The return value is the
+    number of connections that were invalidated.
+    """
+    pool = engine.pool
+    if not hasattr(pool, 'checkedin'):
+        return 0  # this pool does not keep idle connections
+    checks = pool.checkedin()
+    if max_checks is not None:
+        checks = min(checks, max_checks)
+    checked = []
+    held = []
+    invalidated = 0
+    try:
+        while len(checked) < checks and pool.checkedin():
+            conn = pool.connect()
+            if any(conn.dbapi_connection is c for c in checked):
+                held.append(conn)
+                continue
+            checked.append(conn.dbapi_connection)
+            try:
+                engine.dialect.do_ping(conn.dbapi_connection)
+            except Exception:
+                conn.invalidate()
+                invalidated += 1
+            finally:
+                conn.close()
+    finally:
+        for conn in held:
+            conn.close()
+    connections = []
+    try:
+        while pool.checkedin() + len(connections) < min_idle and \
+                pool.checkedout() < pool.size():
+            connections.append(pool.connect())
+    finally:
+        for conn in connections:
+            conn.close()
+    return invalidated
+
+
+class HealthChecker:
+    """Background thread that checks the idle connections of an engine.
+
+    :param engine: the engine to check.
+    :param interval: the number of seconds between checks.
+    :param min_idle: the minimum number of idle connections to keep in the
+                     pool.
+    :param max_checks: the maximum number of connections to ping in each
+                       check.
+
+    Instances of this class are created by Alchemical when the
+    ``health_check_options`` argument is given.
+    """
+    def __init__(self, engine, interval=30, min_idle=0, max_checks=10):
+        self.engine = engine
+        self.interval = interval
+        self.min_idle = min_idle
+        self.max_checks = max_checks
+        self.invalidated = 0
+        self.stopped = Event()
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.invalidated += check_pool(self.engine, self.min_idle,
+                                               self.max_checks)
+            except Exception:  # pragma: no cover
+                logger.exception('Connection health check failed')
+
+    def stop(self):
+        """Stop the health checker."""
+        self.stopped.set()
+
+
+def resize_pool(engine, size):
+    """Change the size of the connection pool of an engine.
+
+    :param engine: the engine with the pool to resize, which must be a
+                   ``QueuePool`` or a subclass of it.
+    :param size: the new size of the pool. The ``max_overflow`` setting of the
+                 pool is not changed.
+
+    The pool is resized in place. When it grows, its idle connections are
+    kept, and new connections are opened as they are needed. When it shrinks,
+    the idle connections in excess of the new size are closed, and the
+    connections in use are closed when they are returned to a full pool. The
+    return value is the number of idle connections that were closed.
+    """
+    pool = engine.pool
+    # the size of a QueuePool is the capacity of its queue of idle
+    # connections, and the overflow counter starts at minus that size
+    with pool._overflow_lock:
+        pool._overflow -= size - pool.size()
+        pool._pool.maxsize = size
+        # the asyncio queue of an async pool is created on first use
+        queue = pool._pool.__dict__.get('_queue')
+        if queue is not None:
+            queue._maxsize = size
+    closed = 0
+    for _ in range(pool.checkedin() - size):
+        try:
+            record = pool._pool.get(False)
+        except sqla_queue.Empty:  # pragma: no cover
+            break
+        try:
+            record.close()
+        finally:
+            pool._dec_overflow()
+        closed += 1
+    return closed
+
+
+class PoolSizer:
+    """Background thread that adapts the size of the connection pool of an
+    engine to its load.
+
+    :param engine: the engine with the pool to manage.
+    :param min_size: the minimum size of the pool.
+    :param max_size: the maximum size of the pool.
+    :param interval: the number of seconds between adjustments.
+    :param target_wait: the longest wait for a connection, in seconds, that is
+                        considered acceptable.
+    :param bind_key: the bind key of the engine, used in log messages.
+
+    At each adjustment, the pool grows by one connection above the peak
+    number of connections that were in use if that peak exceeded the size of
+    the pool, or if a connection request waited longer than ``target_wait``.
+    If the peak stayed two or more connections below the size of the pool,
+    the pool shrinks by one connection. The pool is resized in place, as
+    explained in :func:`resize_pool`. Each resize is logged, and the
+    ``metrics`` attribute holds the state of the pool as of the last
+    adjustment. The event listeners and the instrumentation installed by the
+    sizer are removed when it is stopped.
+
+    Instances of this class are created by Alchemical when the
+    ``pool_sizing_options`` argument is given.
+    """
+    def __init__(self, engine, min_size=1, max_size=20, interval=10,
+                 target_wait=0.05, bind_key=None):
+        self.engine = getattr(engine, 'sync_engine', engine)
+        pool = self.engine.pool
+        if not isinstance(pool, QueuePool) or pool.size() == 0:
+            raise ValueError('Adaptive pool sizing requires a QueuePool '
+                             'with a size limit')
+        if not 1 <= min_size <= max_size:
+            raise ValueError('Invalid pool size limits')
+        self.min_size = min_size
+        self.max_size = max_size
+        self.interval = interval
+        self.target_wait = target_wait
+        self.bind_key = bind_key
+        self.lock = Lock()
+        self.active = True
+        self._in_use = pool.checkedout()
+        self._peak = self._in_use
+        self._max_wait = 0.0
+        self._waits = 0
+
+        # the connections in use are counted with pool events, which are
+        # carried over to the pools that replace this one when the engine is
+        # disposed
+        def checkout(dbapi_connection, connection_record, connection_proxy):
+            if not self.active:
+                return
+            with self.lock:
+                self._in_use += 1
+                self._peak = max(self._peak, self._in_use)
+
+        def checkin(dbapi_connection, connection_record):
+            if not self.active:
+                return
+            with self.lock:
+                self._in_use -= 1
+
+        self._listeners = [(pool, 'checkout', checkout),
+                           (pool, 'checkin', checkin)]
+        for listener in self._listeners:
+            event.listen(*listener)
+
+        size = min(max(pool.size(), min_size), max_size)
+        if size != pool.size():
+            resize_pool(self.engine, size)
+        self.metrics = {'size': size, 'min_size': min_size,
+                        'max_size': max_size, 'peak': 0, 'max_wait': 0.0,
+                        'waits': 0, 'resizes': 0}
+
+        # there is no event that marks the start of a pool checkout, so the
+        # wait for a connection is measured by wrapping the engine method
+        # that checks out connections
+        raw_connection = self.engine.raw_connection
+        self._raw_connection = self.engine.__dict__.get('raw_connection')
+
+        def timed_raw_connection(*args, **kwargs):
+            if not self.active:
+                return raw_connection(*args, **kwargs)
+            start = time.perf_counter()
+            conn = raw_connection(*args, **kwargs)
+            wait = time.perf_counter() - start
+            with self.lock:
+                self._max_wait = max(self._max_wait, wait)
+                if wait > self.target_wait:
+                    self._waits += 1
+            return conn
+
+        self.engine.raw_connection = self._timed_raw_connection = \
+            timed_raw_connection
+        self.start()
+
+    def start(self):
+        self.stopped = Event()
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.adjust()
+            except Exception:  # pragma: no cover
+                logger.exception('Connection pool adjustment failed')
+
+    def adjust(self):
+        """Resize the pool according to the load observed since the last
+        adjustment. The return value is the new size of the pool."""
+        with self.lock:
+            peak, max_wait, waits = self._peak, self._max_wait, self._waits
+            self._peak = self._in_use
+            self._max_wait = 0.0
+            self._waits = 0
+        size = new_size = self.engine.pool.size()
+        if (waits or peak > size) and size < self.max_size:
+            new_size = min(max(peak, size) + 1, self.max_size)
+        elif peak < size - 1 and size > self.min_size:
+            new_size = max(size - 1, self.min_size)
+        if new_size != size:
+            logger.info('Resizing connection pool of bind %r from %d to %d '
+                        '(peak usage: %d, max wait: %.3fs)', self.bind_key,
+                        size, new_size, peak, max_wait)
+            resize_pool(self.engine, new_size)
+            self.metrics['resizes'] += 1
+        self.metrics.update(size=new_size, peak=peak, max_wait=max_wait,
+                            waits=waits)
+        return new_size
+
+    def stop(self):
+        """Stop the pool sizer."""
+        self.stopped.set()
+        self._remove_instrumentation()
+
+    def _remove_instrumentation(self):
+        self.active = False
+        for listener in self._listeners:
+            if event.contains(*listener):
+                event.remove(*listener)
+        # a wrapper installed on top of this one cannot be removed without
+        # also removing the other wrapper, so in that case it is disabled
+        if self.engine.__dict__.get('raw_connection') is \
+                self._timed_raw_connection:
+            if self._raw_connection is None:
+                del self.engine.raw_connection
+            else:
+                self.engine.raw_connection = self._raw_connection
+
+
 class BaseAlchemical:
     def __init__(self, url=None, binds=None, engine_options=None,
                  session_options=None, model_class=None,
-                 naming_convention=None):
+                 naming_convention=None, health_check_options=None,
+                 timing=False, pool_sizing_options=None):
         self.engine_options = engine_options or {}
         self.session_options = session_options or {}
+        self.health_check_options = health_check_options
+        self.pool_sizing_options = pool_sizing_options
+        self.timing = timing
         self.naming_convention = DEFAULT_NAMING_CONVENTION \
             if naming_convention is None else naming_convention
 
@@ -90,13 +2310,19 @@ class BaseAlchemical:
         self.session_class = None
         self.engines = None
         self.table_binds = None
+        self.health_checkers = {}
+        self.pool_sizers = {}
+        self._bind_options = {}
+        self.scoped_sessions = {}
         self.Model = self._get_declarative_base(model_class)
+        _instances.add(self)
 
         if url or binds:
             self.initialize(url, binds=binds)
 
     def initialize(self, url=None, binds=None, engine_options=None,
-                   session_options=None):
+                   session_options=None, health_check_options=None,
+                   timing=False, pool_sizing_options=None):
         """Initialize the database instance.
 
         :param url: the database URL.
@@ -108,6 +2334,11 @@ class BaseAlchemical:
                                pass to SQLAlchemy.
         :param session_options: a dictionary with additional session options to
                                 use when creating sessions.
+        :param health_check_options: a dictionary with options for the
+                                     background connection health checker.
+        :param timing: set to ``True`` to record database timings.
+        :param pool_sizing_options: a dictionary with options for the
+                                    adaptive sizing of the connection pools.
 
         This method must be called explicitly to complete the initialization of
         the instance the two-phase initialization method is used.
@@ -119,7 +2350,15 @@ class BaseAlchemical:
         self.binds = binds or self.binds
         self.engine_options = engine_options or self.engine_options
         self.session_options = session_options or self.session_options
+        self.health_check_options = health_check_options or \
+            self.health_check_options
+        self.timing = timing or self.timing
+        self.pool_sizing_options = pool_sizing_options or \
+            self.pool_sizing_options
+        self._stop_health_checks()
+        self._stop_pool_sizers()
         self.session_class = None
+        self.scoped_sessions = {}
         self.engines = None
         self.table_binds = None
 
@@ -137,6 +2376,7 @@ class BaseAlchemical:
         return model_class
 
     def _create_engines(self):
+        self._bind_options = {}
         options = (self.engine_options if not callable(self.engine_options)
                    else self.engine_options(None))
         options.setdefault('future', True)
@@ -146,6 +2386,7 @@ class BaseAlchemical:
         if self.url:
             self.engines[None] = self._create_engine(
                 self._fix_url(self.url), **options)
+            self._add_engine_listeners(self.engines[None], None)
         self.table_binds = {}
         for bind_key, url in (self.binds or {}).items():
             options = (self.engine_options if not callable(self.engine_options)
@@ -153,11 +2394,118 @@ class BaseAlchemical:
             options.setdefault('future', True)
             self.engines[bind_key] = self._create_engine(
                 self._fix_url(url), **options)
+            self._add_engine_listeners(self.engines[bind_key], bind_key)
             for table in self.Model.__metadatas__[bind_key].tables.values():
                 self.table_binds[table] = self.engines[bind_key]
+        self._start_health_checks()
+        self._start_pool_sizers()
+
+    def _add_engine_listeners(self, engine, bind_key):
+        engine = getattr(engine, 'sync_engine', engine)
+        event.listen(engine, 'handle_error', _raise_statement_timeout)
+        event.listen(engine, 'after_cursor_execute', _track_write)
+        event.listen(engine.pool, 'checkin', _reset_statement_timeout)
+        if engine.dialect.name == 'sqlite':
+            event.listen(engine, 'before_cursor_execute',
+                         _start_statement_timer)
+        if self.timing:
+            _add_timing_instrumentation(engine, bind_key)
+
+    def _get_bind_options(self, name, bind_key):
+        # options given as a function are computed once per bind
+        if (name, bind_key) not in self._bind_options:
+            options = getattr(self, name)
+            self._bind_options[name, bind_key] = \
+                options(bind_key) if callable(options) else options
+        return self._bind_options[name, bind_key]
 
-    def _fix_url(self, url):
-        for prefix, updated_prefix in self.prefix_map.items():
+    def _has_pending_tasks(self, name, tasks):
+        # returns True if a bind needs a background task that is not running
+        return self.engines is not None and any(
+            bind_key not in tasks and
+            self._get_bind_options(name, bind_key) is not None
+            for bind_key in self.engines)
+
+    def _start_health_checks(self):
+        if not self.health_check_options:
+            return
+        for bind_key, engine in self.engines.items():
+            if bind_key in self.health_checkers:
+                continue
+            options = self._get_bind_options('health_check_options',
+                                             bind_key)
+            if options is not None:
+                checker = self._create_health_checker(engine, **options)
+                if checker is not None:
+                    self.health_checkers[bind_key] = checker
+
+    def _stop_health_checks(self):
+        for checker in self.health_checkers.values():
+            checker.stop()
+        self.health_checkers = {}
+
+    def _start_pool_sizers(self):
+        if not self.pool_sizing_options:
+            return
+        for bind_key, engine in self.engines.items():
+            if bind_key in self.pool_sizers:
+                continue
+            options = self._get_bind_options('pool_sizing_options',
+                                             bind_key)
+            if options is not None:
+                sizer = self._create_pool_sizer(engine, bind_key=bind_key,
+                                                **options)
+                if sizer is not None:
+                    self.pool_sizers[bind_key] = sizer
+
+    def _stop_pool_sizers(self):
+        for sizer in self.pool_sizers.values():
+            sizer.stop()
+        self.pool_sizers = {}
+
+    def _reset_after_fork(self):
+        # connections inherited from the parent process cannot be shared, so
+        # the pools are replaced with new ones, without closing the parent's
+        # connections
+        self.lock = Lock()
+        for engine in (self.engines or {}).values():
+            getattr(engine, 'sync_engine', engine).dispose(close=False)
+        self.session_class = None
+        self.scoped_sessions = {}
+        # background threads and tasks do not survive a fork
+        self.health_checkers = {}
+        self._stop_pool_sizers()
+        if self.engines:
+            self._start_health_checks()
+            self._start_pool_sizers()
+
+    @staticmethod
+    def _get_pool_capacity(pool):
+        if not callable(getattr(pool, 'size', None)):
+            return 5  # pools without a size limit
+        return pool.size() + max(getattr(pool, '_max_overflow', 0), 0)
+
+    def _get_copy_engine(self, bind, stack):
+        if bind is not None and '://' in bind:
+            engine = self._create_engine(self._fix_url(bind))
+            if hasattr(engine, 'sync_engine'):
+                stack.push_async_callback(engine.dispose)
+            else:
+                stack.callback(engine.dispose)
+            return engine
+        engine = self.get_engine(bind)
+        if engine is None:
+            raise ValueError(f'Unknown bind {bind}')
+        return engine
+
+    def _get_copy_workers(self, copy, src_engine, dst_engine, workers):
+        if workers is None:
+            workers = min(self._get_pool_capacity(engine.pool)
+                          for engine in [src_engine, dst_engine])
+        return max(min(workers, len(copy.partitions)), 1)
+
+    def _fix_url(self, url, prefix_map=None):
+        for prefix, updated_prefix in (prefix_map or self.prefix_map).items():
             if url.startswith(f'{prefix}://'):
                 url = f'{updated_prefix}://' + url[len(prefix) + 3:]
                 break
@@ -183,6 +2531,54 @@ class BaseAlchemical:
     def bind_names(self):
         return [bind for bind in self.engines if bind is not None]
 
+    def _get_table_engine(self, table):
+        for bind_key, metadata in self.metadatas.items():
+            if metadata.tables.get(table.key) is table:
+                return self.get_engine(bind_key)
+        raise ValueError(f'Table {table.name} is not in any bind')
+
+    @contextmanager
+    def capture_statements(self, log=None):
+        """Record the table columns used by the statements issued by the
+        application.
+
+        :param log: the :class:`StatementLog` instance in which statements
+                    are recorded. If not given, a new log is created.
+
+        This context manager returns the statement log. Statements that are
+        executed by any of the database engines while the context manager
+        is active are added to it. Example::
+
+            with db.capture_statements() as log:
+                run_workload()
+            log.save('statements.jsonl')
+        """
+        log = StatementLog() if log is None else log
+        self.get_engine()
+        listeners = []
+        for bind_key, engine in self.engines.items():
+            def start_timer(conn, cursor, statement, parameters, context,
+                            executemany):
+                conn.info['alchemical_capture_start'] = time.perf_counter()
+
+            def add_statement(conn, cursor, statement, parameters, context,
+                              executemany, bind_key=bind_key):
+                start = conn.info.pop('alchemical_capture_start', None)
+                if context.compiled is not None and start is not None:
+                    log.add_statement(bind_key, context.compiled,
+                                      time.perf_counter() - start)
+
+            engine = getattr(engine, 'sync_engine', engine)
+            event.listen(engine, 'before_cursor_execute', start_timer)
+            event.listen(engine, 'after_cursor_execute', add_statement)
+            listeners += [(engine, 'before_cursor_execute', start_timer),
+                          (engine, 'after_cursor_execute', add_statement)]
+        try:
+            yield log
+        finally:
+            for listener in listeners:
+                event.remove(*listener)
+
     def is_async(self):
         """Return True if this database instance is asynchronous."""
         return False
@@ -208,6 +2604,32 @@ class Alchemical(BaseAlchemical):
                               the SQLAlchemy documentation is used by default.
                               Pass an empty dictionary to disable naming
                               conventions.
+    :param health_check_options: a dictionary with options for a background
+                                 thread that pings the idle connections in the
+                                 pool and discards those that are dead. The
+                                 ``interval`` option sets the number of
+                                 seconds between checks, ``min_idle`` the
+                                 number of idle connections to keep in the
+                                 pool, and ``max_checks`` the number of
+                                 connections to ping in each check. A
+                                 function that accepts a bind key and returns
+                                 the options for that bind (or ``None`` to
+                                 disable the checker) can also be given.
+    :param timing: set to ``True`` to record the time spent in the database,
+                   which can then be obtained with the
+                   :func:`track_database_time` context manager.
+    :param pool_sizing_options: a dictionary with options for a background
+                                thread that grows and shrinks the connection
+                                pool according to its load. The
+                                ``min_size`` and ``max_size`` options set the
+                                limits of the pool size, ``interval`` the
+                                number of seconds between adjustments, and
+                                ``target_wait`` the longest acceptable wait
+                                for a connection in seconds. A function that
+                                accepts a bind key and returns the options
+                                for that bind (or ``None`` to use a fixed
+                                size) can also be given. See
+                                :class:`PoolSizer` for details.
 
     The database instances can be initialized in two phases, in which case the
     :func:`Alchemical.initialize` method must be called later to complete the
@@ -221,6 +2643,12 @@ class Alchemical(BaseAlchemical):
     def _create_engine(self, url, *args, **kwargs):
         return create_engine(url, *args, **kwargs)
 
+    def _create_health_checker(self, engine, **options):
+        return HealthChecker(engine, **options)
+
+    def _create_pool_sizer(self, engine, **options):
+        return PoolSizer(engine, **options)
+
     def create_all(self):
         """Create the database tables.
 
@@ -245,6 +2673,112 @@ class Alchemical(BaseAlchemical):
         for bind_key in self.binds or {}:
             self.metadatas[bind_key].drop_all(self.get_engine(bind_key))
 
+    def advise_indexes(self, log, min_count=1):
+        """Propose indexes for the statements in a statement log.
+
+        :param log: the statement log, given as a :class:`StatementLog`
+                    instance, the path to a log saved to disk, or an
+                    iterable of log entries.
+        :param min_count: the minimum number of executions a statement needs
+                          to have to be considered.
+
+        The columns used in the ``WHERE``, ``JOIN`` and ``ORDER BY`` clauses of
+        the logged statements are compared against the indexes declared in
+        the models and those that exist in the database. The return value is
+        a list of proposed indexes, each given as a dictionary with ``bind``,
+        ``table``, ``columns`` and ``name`` keys, plus the ``count`` and
+        total ``duration`` of the statements that would use the index. The
+        list is sorted by the estimated benefit of the indexes, with the
+        index that would speed up the most statement time first.
+        """
+        if isinstance(log, (str, os.PathLike)):
+            log = StatementLog.load(log)
+        elif not isinstance(log, StatementLog):
+            log = StatementLog(log)
+
+        candidates = {}
+        for entry in log.entries.values():
+            for columns in _get_index_candidates(entry):
+                key = (entry['bind'], entry['table'], columns)
+                stats = candidates.setdefault(key, {'count': 0,
+                                                    'duration': 0.0})
+                stats['count'] += entry['count']
+                stats['duration'] += entry['duration']
+
+        # an index also serves the statements that use a prefix of its
+        # columns, so candidates that are prefixes of others are merged
+        for key in sorted(candidates, key=lambda key: len(key[2])):
+            bind_key, table, columns = key
+            for other in candidates:
+                if other != key and other[:2] == key[:2] and \
+                        other[2][:len(columns)] == columns:
+                    candidates[other]['count'] += candidates[key]['count']
+                    candidates[other]['duration'] += \
+                        candidates[key]['duration']
+                    candidates[key] = None
+                    break
+        candidates = {key: stats for key, stats in candidates.items()
+                      if stats is not None}
+
+        existing = {}
+        suggestions = []
+        for (bind_key, table_name, columns), stats in candidates.items():
+            metadata = self.metadatas.get(bind_key)
+            table = None if metadata is None else \
+                metadata.tables.get(table_name)
+            if table is None or stats['count'] < min_count:
+                continue
+            if (bind_key, table_name) not in existing:
+                with self.get_engine(bind_key).connect() as conn:
+                    existing[(bind_key, table_name)] = \
+                        _get_existing_indexes(conn, table)
+            if any(index[:len(columns)] == columns
+                   for index in existing[(bind_key, table_name)]):
+                continue
+            suggestions.append({
+                'bind': bind_key, 'table': table_name,
+                'columns': list(columns),
+                'name': _get_index_name(table, columns,
+                                        metadata.naming_convention),
+                **stats})
+        return sorted(suggestions, key=lambda suggestion: (
+            -suggestion['duration'], -suggestion['count']))
+
+    def maintain_partitions(self, ahead=3, retain=None, now=None):
+        """Create and drop partitions of range partitioned tables.
+
+        :param ahead: the number of partitions to create after the one that
+                      holds the current value of the partitioning column.
+        :param retain: the number of past partitions to keep. Older
+                       partitions are dropped, along with their data. The
+                       default is to not drop any partitions.
+        :param now: the current value of the partitioning column. The default
+                    is today's date for time intervals, or the largest value
+                    stored in each table for integer intervals.
+
+        This method is intended to run on a schedule, so that partitions are
+        always available for new rows. Tables are partitioned with the
+        ``__partition_by__`` model attribute. Only PostgreSQL databases are
+        partitioned. The return value is a dictionary with the names of the
+        created and dropped partitions for each table.
+        """
+        results = {}
+        for bind_key in [None] + list(self.binds or {}):
+            engine = self.get_engine(bind_key)
+            if engine is None or engine.dialect.name != 'postgresql':
+                continue
+            tables = [table for table in self.metadatas[bind_key].sorted_tables
+                      if table.info.get('alchemical_partition_by', ('',))[0]
+                      == 'range']
+            for table in tables:
+                with engine.begin() as conn:
+                    result = {'created': create_partitions(
+                        conn, table, ahead=ahead, now=now)}
+                    result['dropped'] = [] if retain is None else \
+                        drop_partitions(conn, table, retain, now=now)
+                results[table.name] = result
+        return results
+
     @property
     def Session(self):
         """Return a database session.
@@ -262,18 +2796,28 @@ class Alchemical(BaseAlchemical):
 
         When the session is created in this way, ``session.close()`` must be
         called when the session isn't needed anymore.
+
+        A timeout for the statements issued by the session can be given in
+        seconds::
+
+            with db.Session(statement_timeout=5) as session:
+                # statements that run for more than 5 seconds raise
+                # a StatementTimeout exception
         """
         if self.session_class is None:
-            options = {'future': True}
+            options = {'future': True, 'class_': AlchemicalSession}
             options.update(self.session_options)
             self.session_class = sessionmaker(
                 bind=self.get_engine(), binds=self.table_binds, **options)
         return self.session_class
 
     @contextmanager
-    def begin(self):
+    def begin(self, timeout=None):
         """Context manager for a database transaction.
 
+        :param timeout: the maximum number of seconds each statement issued in
+                        the transaction is allowed to run.
+
         Upon entering the context manager block, a new session is created and
         a transaction started on it. If any errors occur inside the context
         manager block, then the transation is rolled back. If no errors occur,
@@ -285,6 +2829,482 @@ class Alchemical(BaseAlchemical):
                 # work with the session here
                 # a commit (on success) or rollback (on error) is automatic
         """
-        with self.Session() as session:
+        with self.Session(statement_timeout=timeout) as session:
             with session.begin():
                 yield session
+
+    def transaction(self, f, retries=3, backoff=0.1):
+        """Run a function inside a database transaction, with retries.
+
+        :param f: the function to run. The function receives the session as
+                  its only argument.
+        :param retries: the number of times the transaction is retried when a
+                        transient error occurs.
+        :param backoff: the base delay in seconds between retries. The delay
+                        doubles after each attempt, and is randomized to
+                        avoid retrying at the same time as other clients.
+
+        The function runs inside a :func:`begin` block, so the transaction is
+        committed when the function returns, and rolled back if it raises an
+        exception. If the error is a serialization failure, a deadlock, a
+        locked SQLite database or a dropped connection, the whole transaction
+        is retried. The function can be called multiple times, so it should not
+        have side effects outside of the database. The return value of the
+        function is returned.
+
+        The changes are flushed before the transaction is committed. If the
+        connection is dropped during the commit, the transaction may or may
+        not have been committed, so the error is raised instead of retrying
+        the transaction, to avoid applying it twice.
+
+        Example::
+
+            def transfer(session):
+                # work with the session here
+
+            db.transaction(transfer, retries=5)
+        """
+        attempt = 0
+        while True:
+            committing = False
+            try:
+                with self.begin() as session:
+                    result = f(session)
+                    session.flush()
+                    committing = True
+                return result
+            except DBAPIError as error:
+                if attempt >= retries or not is_transient_error(error) or (
+                        committing and error.connection_invalidated):
+                    raise
+            time.sleep(retry_delay(attempt, backoff))
+            attempt += 1
+
+    def scoped_session(self, scope='thread'):
+        """Return a registry of sessions scoped to the current thread or
+        context.
+
+        :param scope: ``'thread'`` to give each thread its own session, or
+                      ``'context'`` to give each context its own session, as
+                      defined by the ``contextvars`` package.
+
+        The registry is a SQLAlchemy ``scoped_session`` object, which can be
+        called to obtain the session for the current scope, and also proxies
+        the session methods. The same registry is returned every time this
+        method is called with the same scope. With the ``'context'`` scope,
+        copies of a context, such as those used by ``asyncio`` tasks and by
+        ``asyncio.to_thread()``, get their own sessions. When a thread or
+        context does not need its session anymore, it must call ``remove()``
+        on the registry to close it.
+
+        Example::
+
+            Session = db.scoped_session()
+
+            def worker():
+                Session.add(User(name='susan'))
+                Session.commit()
+                Session.remove()
+        """
+        if scope not in self.scoped_sessions:
+            if scope == 'thread':
+                scopefunc = None
+            elif scope == 'context':
+                scopefunc = _get_context_scope
+            else:
+                raise ValueError(f'Unsupported scope: {scope}')
+            self.scoped_sessions[scope] = scoped_session(
+                self.Session, scopefunc=scopefunc)
+        return self.scoped_sessions[scope]
+
+    def thread_map(self, f, items, workers=None):
+        """Run a function on each item of an iterable, using a pool of
+        threads, each with its own session.
+
+        :param f: the function to run. The function receives a session and an
+                  item as arguments.
+        :param items: an iterable with the items to process.
+        :param workers: the number of threads. The default is to use as many
+                        threads as connections can be obtained from the
+                        connection pool.
+
+        Each call runs inside a transaction that is committed when the
+        function returns, or rolled back if it raises an exception. The
+        sessions are closed when all the items have been processed. The return
+        value is a list with the results of each call, in the same order as
+        the items.
+
+        Example::
+
+            def rename(session, user_id):
+                user = session.get(User, user_id)
+                user.name = user.name.title()
+
+            db.thread_map(rename, user_ids, workers=8)
+        """
+        self.get_engine()  # this makes sure engines are created
+        capacity = min(self._get_pool_capacity(engine.pool)
+                       for engine in self.engines.values())
+        if workers is None:
+            workers = capacity
+        elif workers > capacity:
+            logger.warning('%d workers will share %d database connections',
+                           workers, capacity)
+        sessions = {}
+
+        def run(item):
+            session = sessions.get(get_ident())
+            if session is None:
+                session = sessions[get_ident()] = self.Session()
+            with session.begin():
+                return f(session, item)
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                return list(executor.map(run, items))
+        finally:
+            for session in sessions.values():
+                session.close()
+
+    def load_data(self, source, model=None, format=None, batch_size=1000,
+                  parallel=False, workers=None):
+        """Load data from a file into one or more tables.
+
+        :param source: the data to load. This can be the path to a file, a
+                       text file object, or an iterable of dictionaries. To
+                       load several tables, pass a dictionary with model
+                       classes as keys and any of the above as values.
+        :param model: the model class of the table to load, when ``source``
+                      is not a dictionary.
+        :param format: ``'jsonl'`` for files that have a JSON object per line,
+                       or ``'csv'`` for CSV files with a header row. The
+                       default is to use the extension of the file name.
+                       Files with a ``.gz`` extension are decompressed.
+        :param batch_size: the number of rows to insert in each batch.
+        :param parallel: if ``True``, tables that do not depend on each other
+                         are loaded at the same time.
+        :param workers: the maximum number of tables to load at the same time
+                        in parallel mode. The default is to use as many as
+                        connections can be obtained from the connection pool.
+
+        The rows are streamed from the source, converted to the types of the
+        table columns, and inserted in batches with ``executemany``, without
+        using the session. Tables are loaded in the order given by their
+        foreign keys, each in its own transaction. Keys in the rows that do
+        not match a column raise a ``ValueError``. The return value is a
+        dictionary with the number of rows inserted in each table.
+
+        Example::
+
+            db.load_data({User: 'users.csv', Post: 'posts.jsonl.gz'})
+        """
+        sources, order, dependencies = _get_load_plan(source, model)
+
+        def load(table):
+            with self._get_table_engine(table).begin() as conn:
+                return _load_table(conn, table, sources[table], format,
+                                   batch_size)
+
+        if not parallel:
+            return {table.name: load(table) for table in order}
+        self.get_engine()  # this makes sure engines are created
+        if workers is None:
+            workers = min(self._get_pool_capacity(engine.pool)
+                          for engine in self.engines.values())
+        counts = {}
+        pending = list(order)
+        running = {}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while pending or running:
+                for table in _get_ready_tables(pending, running.values(),
+                                               dependencies):
+                    pending.remove(table)
+                    running[executor.submit(load, table)] = table
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    counts[running.pop(future).name] = future.result()
+        return {table.name: counts[table.name] for table in order}
+
+    def dump(self, directory, binds=None, tables=None, format='jsonl',
+             batch_size=1000, workers=None, consistent=True):
+        """Write the contents of the database tables to compressed files.
+
+        :param directory: the directory where the files are written. It is
+                          created if it does not exist.
+        :param binds: a list with the binds to dump. Use ``None`` for the
+                      default database. The default is to dump all the binds.
+        :param tables: a list with the models, tables or table names to dump.
+                       The default is to dump all the tables.
+        :param format: ``'jsonl'`` to write a JSON object per row, or
+                       ``'csv'`` to write CSV files with a header row. Note
+                       that CSV files cannot distinguish null values from
+                       empty strings.
+        :param batch_size: the number of rows to read from the database
+                           cursor at a time.
+        :param workers: the maximum number of tables to dump at the same
+                        time. The default is to use as many as connections
+                        can be obtained from the connection pool.
+        :param consistent: if ``True``, the tables of each bind are dumped
+                           from the same snapshot of the database.
+
+        Each table is streamed in primary key order with a server-side cursor
+        to a gzip compressed file. On PostgreSQL, the tables of a consistent
+        dump are read in parallel from a snapshot shared by all the
+        connections. On other databases, the tables of each bind are read in
+        a single transaction, so only binds are dumped in parallel, unless
+        ``consistent`` is set to ``False``. A ``manifest.json`` file with
+        the number of rows and the SHA-256 checksum of each file is written
+        when the dump completes. The return value is a dictionary with the
+        number of rows dumped from each table.
+
+        Example::
+
+            db.dump('backups/latest', binds=[None, 'users'])
+        """
+        if format not in DUMP_FORMATS:
+            raise ValueError(f'Unsupported format: {format}')
+        groups = _get_dump_groups(self.metadatas, binds, tables)
+        self.get_engine()  # this makes sure engines are created
+        if workers is None:
+            workers = max(min(self._get_pool_capacity(engine.pool)
+                              for engine in self.engines.values()) - 1, 1)
+        os.makedirs(directory, exist_ok=True)
+        with ExitStack() as stack:
+            snapshots = {}
+            for bind_key in groups:
+                engine = self.get_engine(bind_key)
+                if consistent and engine.dialect.name == 'postgresql':
+                    snapshots[bind_key] = _export_snapshot(
+                        stack.enter_context(engine.connect()))
+
+            def dump_tables(bind_key, tables, snapshot):
+                return _dump_tables(self.get_engine(bind_key), bind_key,
+                                    tables, snapshot, directory, format,
+                                    batch_size)
+
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(lambda job: dump_tables(*job),
+                                            _get_dump_jobs(groups, snapshots,
+                                                           consistent)))
+        return _write_manifest(directory, format, list(chain(*results)))
+
+    def restore(self, directory, binds=None, tables=None, batch_size=1000,
+                workers=None, verify=True):
+        """Load the tables written by :func:`dump` back into the database.
+
+        :param directory: the directory with the dumped files.
+        :param binds: a list with the binds to restore. Use ``None`` for the
+                      default database. The default is to restore all the
+                      binds in the dump.
+        :param tables: a list with the models, tables or table names to
+                       restore. The default is to restore all the tables in
+                       the dump.
+        :param batch_size: the number of rows to insert in each batch.
+        :param workers: the maximum number of tables to load at the same
+                        time.
+        :param verify: if ``True``, the checksums of the files are verified
+                       before any data is loaded.
+
+        The tables must exist and should be empty. They are loaded with
+        :func:`load_data` in parallel mode, so the foreign key order is
+        respected. The return value is a dictionary with the number of rows
+        inserted in each table.
+
+        Example::
+
+            db.create_all()
+            db.restore('backups/latest')
+        """
+        sources = _get_restore_sources(self.metadatas, directory, binds,
+                                       tables, verify)
+        return self.load_data(sources, batch_size=batch_size, parallel=True,
+                              workers=workers)
+
+    def copy_table(self, model, src_bind, dst_bind, chunk_size=10000,
+                   partitions=1, checkpoint=None, progress=None,
+                   batch_size=1000, workers=None):
+        """Copy the rows of a table from one database to another.
+
+        :param model: the model class or table to copy.
+        :param src_bind: the bind to copy from, or the URL of a database that
+                         is not configured in this instance. Use ``None`` for
+                         the default database.
+        :param dst_bind: the bind or URL to copy to.
+        :param chunk_size: the number of rows to read and write at a time.
+                           Each chunk is written in its own transaction.
+        :param partitions: the number of key ranges to copy in parallel. This
+                           requires a single integer primary key.
+        :param checkpoint: the path of a file where the progress of the copy
+                           is recorded after each chunk. If the file exists
+                           when the copy starts, the copy resumes from it.
+                           The file is deleted when the copy completes.
+        :param progress: a function that is called after each chunk with a
+                         dictionary with the ``table`` name, the number of
+                         ``rows`` copied, the estimated ``total`` rows (or
+                         ``None``), the ``elapsed`` seconds and the
+                         ``rows_per_second`` rate.
+        :param batch_size: the number of rows to insert in each batch when
+                           the destination does not support ``COPY``.
+        :param workers: the maximum number of partitions to copy at the same
+                        time. Each partition uses a connection to both
+                        databases, so the default is the number of partitions,
+                        limited by the capacity of the connection pools.
+
+        The rows are read in primary key order, in chunks that start after
+        the last key of the previous chunk, so that every query uses the
+        primary key index. On PostgreSQL with the psycopg driver the rows are
+        written with ``COPY``, and other databases insert them in batches
+        with ``executemany``. The destination table must exist. The source
+        table should not be modified while it is copied. The return value is
+        the number of rows copied.
+
+        Example::
+
+            db.copy_table(Event, None, 'postgresql://localhost/archive',
+                          partitions=4, checkpoint='events.checkpoint')
+        """
+        table = getattr(model, '__table__', model)
+        if src_bind == dst_bind:
+            raise ValueError('The source and destination must be different')
+        copy = _TableCopy(table, chunk_size, batch_size, checkpoint,
+                          progress)
+        with ExitStack() as stack:
+            src_engine, dst_engine = [
+                self._get_copy_engine(bind, stack)
+                for bind in [src_bind, dst_bind]]
+            with src_engine.connect() as conn:
+                copy.start(conn, partitions)
+            workers = self._get_copy_workers(
+                copy, src_engine, dst_engine, workers)
+            if workers == 1:
+                for i in range(len(copy.partitions)):
+                    copy.copy_partition(src_engine, dst_engine, i)
+            else:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    list(executor.map(
+                        lambda i: copy.copy_partition(
+                            src_engine, dst_engine, i),
+                        range(len(copy.partitions))))
+        return copy.finish()
+
+    def map_partitions(self, model, f, workers=None, partition_by=None,
+                       partitions=None, mp_context=None):
+        """Process a table in parallel, using a pool of processes.
+
+        :param model: the model class of the table to process.
+        :param f: the function to run on each partition. The function receives
+                  a session and a ``range`` object with the values of the
+                  partition column that are included in the partition. The
+                  function and its arguments must be picklable.
+        :param workers: the number of processes. The default is the number of
+                        CPUs.
+        :param partition_by: the integer column used to partition the table.
+                             The default is the primary key of the model.
+        :param partitions: the number of partitions. The default is four
+                           partitions per process.
+        :param mp_context: the ``multiprocessing`` context used to start the
+                           processes. The default is the default context of
+                           the platform.
+
+        The table is divided into ranges of similar size, according to the
+        minimum and maximum values of the partition column. Each process
+        creates a database instance with the URLs and options of this one,
+        and its own database engines, so the declarative base class, the
+        engine and session options and the function must all be picklable.
+        Each call runs inside a transaction that is committed when the
+        function returns. The return value is a list with the results for
+        each partition, in order.
+
+        Example::
+
+            def recompute(session, ids):
+                for user in session.scalars(User.select().where(
+                        User.id >= ids.start, User.id < ids.stop)):
+                    user.score = compute_score(user)
+
+            db.map_partitions(User, recompute, workers=8)
+        """
+        if partition_by is None:
+            primary_key = inspect(model).primary_key
+            if len(primary_key) != 1:
+                raise ValueError('partition_by must be given for models with '
+                                 'composite primary keys')
+            partition_by = primary_key[0]
+        with self.Session() as session:
+            low, high = session.execute(select(
+                func.min(partition_by), func.max(partition_by))).one()
+        if low is None:
+            return []
+        if not isinstance(low, int) or not isinstance(high, int):
+            raise ValueError('The partition column must be an integer')
+        workers = workers or os.cpu_count() or 1
+        partitions = min(partitions or workers * 4, high - low + 1)
+        size = -(-(high - low + 1) // partitions)  # rounded up
+        ranges = [range(start, min(start + size, high + 1))
+                  for start in range(low, high + 1, size)]
+        options = {'model_class': self.Model,
+                   'naming_convention': self.naming_convention}
+        config = {'url': self.url, 'binds': self.binds,
+                  'engine_options': self.engine_options,
+                  'session_options': self.session_options}
+        with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context,
+                                 initializer=_init_partition_worker,
+                                 initargs=(type(self), options,
+                                           config)) as executor:
+            return list(executor.map(_run_partition, [f] * len(ranges),
+                                     ranges))
+
+    def iter_columns(self, stmt, bind=None, format='numpy', batch_size=10000):
+        """Run a query and return its results in column-oriented batches.
+
+        :param stmt: the select statement to run.
+        :param bind: the name of the bind to run the query on. The default is
+                     to use the bind of the models in the query.
+        :param format: ``'numpy'`` to return each batch as a dictionary of
+                       NumPy arrays, or ``'arrow'`` to return each batch as a
+                       ``pyarrow.RecordBatch``. The ``numpy`` or ``pyarrow``
+                       packages must be installed.
+        :param batch_size: the number of rows in each batch.
+
+        The rows are streamed from a server-side cursor on databases that
+        support it, and are read from the cursor in batches that are converted
+        to columns directly, without creating result rows or model instances.
+        This method is a generator.
+
+        Example::
+
+            for batch in db.iter_columns(User.select(), format='arrow'):
+                # work with the batch here
+        """
+        with self.Session() as session:
+            if bind is not None:
+                conn = session.connection(
+                    bind_arguments={'bind': self.get_engine(bind)})
+            else:
+                conn = session.connection(bind_arguments={'clause': stmt})
+            yield from _iter_column_batches(conn, stmt, format, batch_size)
+
+    def fetch_columns(self, stmt, bind=None, format='numpy',
+                      batch_size=10000):
+        """Run a query and return all its results in column-oriented form.
+
+        :param stmt: the select statement to run.
+        :param bind: the name of the bind to run the query on. The default is
+                     to use the bind of the models in the query.
+        :param format: ``'numpy'`` to return a dictionary of NumPy arrays, or
+                       ``'arrow'`` to return a ``pyarrow.Table``.
+        :param batch_size: the number of rows to read from the database cursor
+                           at a time.
+
+        This method collects all the batches returned by
+        :func:`iter_columns`.
+
+        Example::
+
+            columns = db.fetch_columns(select(User.id, User.name))
+            print(columns['name'])
+        """
+        names = list(stmt.selected_columns.keys())
+        batches = list(self.iter_columns(stmt, bind=bind, format=format,
+                                         batch_size=batch_size))
+        return _concat_column_batches(names, batches, format)
@@ -1,5 +1,7 @@
-from flask import g
-from .core import Alchemical as BaseAlchemical, Model  # noqa: F401
+import time
+from flask import current_app, g
+from .core import Alchemical as BaseAlchemical, DatabaseTiming, Model, \
+    StatementTimeout, database_timing  # noqa: F401
 
 
 class Alchemical(BaseAlchemical):
@@ -16,9 +18,28 @@ class Alchemical(BaseAlchemical):
                             ``__bind_key__`` class attribute.
     - ``ALCHEMICAL_ENGINE_OPTIONS``: a dictionary with SQLAlchemy engine
                                      options.
+    - ``ALCHEMICAL_HEALTH_CHECK_OPTIONS``: a dictionary with options for the
+                                           background connection health
+                                           checker.
+    - ``ALCHEMICAL_POOL_SIZING_OPTIONS``: a dictionary with options for the
+                                          adaptive sizing of the connection
+                                          pools.
     - ``ALCHEMICAL_AUTOCOMMIT``: If set to ``True``, the session is
                                  automatically committed at the end of the
-                                 request if no errors have occurred.
+                                 request if no errors have occurred and the
+                                 session has changes to commit, including
+                                 statements executed directly on its
+                                 connections.
+    - ``ALCHEMICAL_REQUEST_TIMEOUT``: The number of seconds the ``db.session``
+                                      session of a request is allowed to run
+                                      statements, counting from the start of
+                                      the request. Outside of a request, the
+                                      time counts from the moment the session
+                                      is first used.
+    - ``ALCHEMICAL_SERVER_TIMING``: If set to ``True``, the time spent in the
+                                    database is recorded for each request and
+                                    reported in a ``Server-Timing`` response
+                                    header.
 
     :param app: the Flask application instance. If the application instance
                 isn't provided here, the :func:`Alchemical.init_app` method
@@ -28,6 +49,7 @@ class Alchemical(BaseAlchemical):
                    ``Alchemical`` class.
     """
     def __init__(self, app=None, **kwargs):
+        self.summary_handlers = []
         super().__init__(**kwargs)
         if app:  # pragma: no cover
             self.init_app(app)
@@ -44,17 +66,95 @@ class Alchemical(BaseAlchemical):
         self.initialize(
             url=database_url,
             binds=app.config.get('ALCHEMICAL_BINDS'),
-            engine_options=app.config.get('ALCHEMICAL_ENGINE_OPTIONS'))
+            engine_options=app.config.get('ALCHEMICAL_ENGINE_OPTIONS'),
+            health_check_options=app.config.get(
+                'ALCHEMICAL_HEALTH_CHECK_OPTIONS'),
+            timing=app.config.get('ALCHEMICAL_SERVER_TIMING', False),
+            pool_sizing_options=app.config.get(
+                'ALCHEMICAL_POOL_SIZING_OPTIONS'))
+
+        if self.timing:
+            def start_timing():
+                timing = g.alchemical_timing = DatabaseTiming()
+                g.alchemical_timing_token = database_timing.set(timing)
+
+            def add_timing_header(response):
+                timing = g.get('alchemical_timing')
+                if timing is not None and timing.binds:
+                    response.headers.add('Server-Timing',
+                                         timing.server_timing())
+                return response
+
+            def stop_timing(exc):
+                token = g.pop('alchemical_timing_token', None)
+                if token is not None:
+                    database_timing.reset(token)
+
+            app.before_request(start_timing)
+            app.after_request(add_timing_header)
+            # registered before the session teardown so that it runs after it
+            # and the automatic commit is also timed
+            app.teardown_appcontext(stop_timing)
+
+        def start_deadline():
+            timeout = app.config.get('ALCHEMICAL_REQUEST_TIMEOUT')
+            if timeout:
+                g.alchemical_deadline = time.monotonic() + timeout
+
+        app.before_request(start_deadline)
 
         def teardown_session(exc):
-            if hasattr(g, 'alchemical_session'):
-                if exc is None and app.config.get('ALCHEMICAL_AUTOCOMMIT'):
-                    g.alchemical_session.commit()
-                g.alchemical_session.close()
-                del g.alchemical_session
+            session = g.pop('alchemical_session', None)
+            if session is None:
+                return
+            committed = False
+            try:
+                if exc is None and app.config.get('ALCHEMICAL_AUTOCOMMIT') \
+                        and session.has_changes():
+                    session.commit()
+                    committed = True
+            finally:
+                session.close()
+            if self.summary_handlers:
+                summary = dict(session.stats, committed=committed)
+                if self.timing:
+                    summary['timing'] = g.get('alchemical_timing')
+                for handler in self.summary_handlers:
+                    handler(summary)
 
         app.teardown_appcontext(teardown_session)
 
+    def request_summary_handler(self, f):
+        """Register a function to receive a summary of each request session.
+
+        This method can be used as a decorator. The decorated function is
+        invoked at the end of each request that used ``db.session``, with a
+        dictionary that has the ``transactions``, ``statements``, ``writes``
+        and ``flushes`` counts of the session, and a ``committed`` flag that
+        indicates if the session was automatically committed. When database
+        timing is enabled, the summary also includes the
+        :class:`~alchemical.core.DatabaseTiming` instance of the request in
+        the ``timing`` key. Requests that did not use the session do not
+        produce a summary.
+
+        :param f: the function to register.
+        """
+        self.summary_handlers.append(f)
+        return f
+
+    @property
+    def request_timing(self):
+        """The :class:`~alchemical.core.DatabaseTiming` instance of the
+        current request, or ``None`` if timing is not enabled.
+
+        The time of the automatic commit issued when the
+        ``ALCHEMICAL_AUTOCOMMIT`` option is enabled is recorded after the
+        response is sent, so it is not included in the ``Server-Timing``
+        header, but it is included in the ``timing`` key of the request
+        summaries passed to the :func:`request_summary_handler` functions.
+        """
+        return g.get('alchemical_timing')
+
     @property
     def session(self):
         """Context-based database session.
@@ -62,6 +162,11 @@ class Alchemical(BaseAlchemical):
         The session can be accessed as ``db.session``. An application context
         must be active.
         """
-        if not hasattr(g, 'alchemical_session'):
-            g.alchemical_session = self.Session()
-        return g.alchemical_session
+        session = g.get('alchemical_session')
+        if session is None:
+            deadline = g.get('alchemical_deadline')
+            timeout = current_app.config.get('ALCHEMICAL_REQUEST_TIMEOUT')
+            if deadline is None and timeout:
+                deadline = time.monotonic() + timeout
+            session = g.alchemical_session = self.Session(deadline=deadline)
+        return session
@@ -0,0 +1,24 @@
+from sqlalchemy import text
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
+from alchemical import Alchemical
+from alchemical.core import BaseModel
+
+
+class Base(BaseModel, DeclarativeBase):
+    # a base of its own, so that the shared Model class is not modified
+    __abstract__ = True
+    __metadatas__ = {}
+
+
+db = Alchemical(model_class=Base)  # initialized by the tests
+
+
+class User(db.Model):
+    id: Mapped[int] = mapped_column(primary_key=True)
+    name: Mapped[str]
+
+
+def count_partition(session, ids):
+    return ids, session.execute(text(
+        'select count(*), sum(id) from user where id >= :start and '
+        'id < :stop'), {'start': ids.start, 'stop': ids.stop}).one()
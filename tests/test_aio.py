@@ -1,10 +1,21 @@
 import asyncio
+import importlib.util
+import io
 import sqlite3
+import tempfile
+import threading
 import unittest
+from unittest import mock
 import pytest
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, event, select, text
+from sqlalchemy.exc import InvalidRequestError, OperationalError
+from sqlalchemy.ext.asyncio import AsyncAttrs
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from sqlalchemy.orm import Mapped, mapped_column, relationship, clear_mappers
-from alchemical.aio import Alchemical, Model
+from sqlalchemy.util.concurrency import greenlet_spawn
+from alchemical.aio import Alchemical, Model, StatementTimeout, \
+    TimeoutMiddleware, ServerTimingMiddleware, AlchemicalAsyncSession, \
+    BridgedAsyncSession, PoolSizer
 
 
 def async_test(f):
@@ -218,3 +229,642 @@ class TestAio(unittest.TestCase):
         async with db.Session() as session:
             all = (await session.execute(User.select())).scalars().all()
         assert len(all) == 0
+
+    @async_test
+    async def test_reset_after_fork(self):
+        db = Alchemical('sqlite://')
+
+        class User(db.Model):
+            id: Mapped[int] = mapped_column(primary_key=True)
+            name: Mapped[str]
+
+        await db.create_all()
+        session_class = db.Session
+        pool = db.get_engine().sync_engine.pool
+        assert db._sync is not None
+
+        db._reset_after_fork()
+        assert db._sync is None
+        assert db.get_engine().sync_engine.pool is not pool
+        assert db.Session is not session_class
+
+        await db.create_all()
+        async with db.begin() as session:
+            session.add(User(name='susan'))
+        async with db.Session() as session:
+            all = (await session.execute(User.select())).scalars().all()
+        assert len(all) == 1
+
+    @async_test
+    async def test_health_checker(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db = Alchemical(
+                f'sqlite:///{tmpdir}/test.sqlite',
+                engine_options={'poolclass': AsyncAdaptedQueuePool},
+                health_check_options={'interval': 0.01, 'min_idle': 2})
+            assert db.health_checkers == {}
+            async with db.Session():
+                pass
+            pool = db.get_engine().sync_engine.pool
+            checker = db.health_checkers[None]
+            for _ in range(100):
+                if pool.checkedin() == 2:
+                    break
+                await asyncio.sleep(0.01)
+            assert pool.checkedin() == 2
+
+            db.initialize(f'sqlite:///{tmpdir}/test.sqlite')
+            assert db.health_checkers == {}
+            with pytest.raises(asyncio.CancelledError):
+                await checker.task
+            await db.get_engine().dispose()
+            await checker.engine.dispose()
+
+            calls = []
+
+            def options(bind_key):
+                calls.append(bind_key)
+                return {'interval': 60} if bind_key is None else None
+
+            db = Alchemical(
+                f'sqlite:///{tmpdir}/test.sqlite',
+                binds={'other': f'sqlite:///{tmpdir}/other.sqlite'},
+                health_check_options=options)
+
+            class Other(db.Model):
+                __bind_key__ = 'other'
+                id: Mapped[int] = mapped_column(primary_key=True)
+
+            for _ in range(3):
+                async with db.Session():
+                    pass
+            assert sorted(calls, key=str) == [None, 'other']
+            assert list(db.health_checkers) == [None]
+            db.health_checkers[None].stop()
+            for engine in db.engines.values():
+                await engine.dispose()
+
+    @async_test
+    async def test_pool_sizer(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db = Alchemical(
+                f'sqlite:///{tmpdir}/test.sqlite',
+                engine_options={'poolclass': AsyncAdaptedQueuePool,
+                                'pool_size': 1},
+                pool_sizing_options={'min_size': 1, 'max_size': 4,
+                                     'interval': 3600})
+            async with db.Session():
+                pass
+            engine = db.get_engine()
+            pool = engine.sync_engine.pool
+            sizer = db.pool_sizers[None]
+            assert isinstance(sizer, PoolSizer)
+
+            conns = [await engine.connect() for _ in range(3)]
+            assert await greenlet_spawn(sizer.adjust) == 4
+            for conn in conns:
+                await conn.close()
+            assert await greenlet_spawn(sizer.adjust) == 4
+            assert await greenlet_spawn(sizer.adjust) == 3
+            assert await greenlet_spawn(sizer.adjust) == 2
+            assert engine.sync_engine.pool is pool
+            assert pool.size() == 2
+            assert pool.checkedin() == 2
+            async with engine.connect():
+                pass
+            assert pool.checkedin() == 2
+            assert sizer.metrics['resizes'] == 3
+
+            db.initialize(f'sqlite:///{tmpdir}/test.sqlite')
+            assert db.pool_sizers == {}
+            with pytest.raises(asyncio.CancelledError):
+                await sizer.task
+            assert 'raw_connection' not in engine.sync_engine.__dict__
+            await engine.dispose()
+
+    @async_test
+    async def test_transaction(self):
+        db = Alchemical('sqlite://')
+
+        class User(db.Model):
+            id: Mapped[int] = mapped_column(primary_key=True)
+            name: Mapped[str]
+
+        await db.create_all()
+        calls = []
+
+        async def add_user(session):
+            calls.append(session)
+            session.add(User(name=f'user{len(calls)}'))
+            await session.flush()
+            if len(calls) < 3:
+                raise OperationalError('x', {}, sqlite3.OperationalError(
+                    'database is locked'))
+            return len(calls)
+
+        assert await db.transaction(add_user, backoff=0) == 3
+        async with db.Session() as session:
+            names = (await session.scalars(User.select())).all()
+        assert [user.name for user in names] == ['user3']
+
+        calls.clear()
+        with pytest.raises(OperationalError):
+            await db.transaction(add_user, retries=1, backoff=0)
+        assert len(calls) == 2
+
+        # a dropped connection during the commit is not retried
+        async def add_susan(session):
+            calls.append(session)
+            session.add(User(name='susan'))
+
+        calls.clear()
+        dropped = OperationalError('COMMIT', {}, Exception('gone'),
+                                   connection_invalidated=True)
+        with mock.patch.object(db.get_engine().sync_engine.dialect,
+                               'do_commit', side_effect=dropped):
+            with pytest.raises(OperationalError):
+                await db.transaction(add_susan, backoff=0)
+        assert len(calls) == 1
+
+    @async_test
+    async def test_copy(self):
+        db = Alchemical('sqlite://')
+
+        class User(db.Model):
+            id: Mapped[int] = mapped_column(primary_key=True)
+            name: Mapped[str]
+
+        await db.create_all()
+
+        async with db.begin() as session:
+            assert await User.copy_from(
+                session, [{'name': 'mary'}, {'name': 'joe'}],
+                columns=['name']) == 2
+
+        output = io.BytesIO()
+        async with db.Session() as session:
+            assert await User.copy_to(session, output) == 2
+        assert output.getvalue() == b'1,mary\n2,joe\n'
+
+    @async_test
+    async def test_fetch_columns(self):
+        pytest.importorskip('numpy')
+        db = Alchemical('sqlite://')
+
+        class User(db.Model):
+            id: Mapped[int] = mapped_column(primary_key=True)
+            name: Mapped[str]
+
+        await db.create_all()
+        async with db.begin() as session:
+            for name in ['mary', 'joe', 'susan']:
+                session.add(User(name=name))
+
+        columns = await db.fetch_columns(User.select(), batch_size=2)
+        assert columns['id'].tolist() == [1, 2, 3]
+        assert columns['name'].tolist() == ['mary', 'joe', 'susan']
+
+        batches = [batch['name'].tolist() async for batch in db.iter_columns(
+            User.select(), batch_size=2)]
+        assert batches == [['mary', 'joe'], ['susan']]
+
+    @async_test
+    async def test_get_many(self):
+        db = Alchemical('sqlite://')
+
+        class User(db.Model):
+            id: Mapped[int] = mapped_column(primary_key=True)
+            name: Mapped[str]
+
+        await db.create_all()
+        async with db.begin() as session:
+            for name in ['mary', 'joe', 'susan']:
+                session.add(User(name=name))
+
+        async with db.Session() as session:
+            users = await User.get_many(session, [3, 4, 1])
+            assert [u.name if u else None for u in users] == [
+                'susan', None, 'mary']
+            assert await session.get(User, 1) is users[2]
+
+    @async_test
+    async def test_load_data(self):
+        tmpdir = tempfile.mkdtemp()
+        db = Alchemical(f'sqlite:///{tmpdir}/main.sqlite',
+                        binds={'logs': f'sqlite:///{tmpdir}/logs.sqlite'})
+
+        class User(db.Model):
+            id: Mapped[int] = mapped_column(primary_key=True)
+            name: Mapped[str]
+
+        class Post(db.Model):
+            id: Mapped[int] = mapped_column(primary_key=True)
+            user_id: Mapped[int] = mapped_column(ForeignKey('user.id'))
+
+        class Log(db.Model):
+            __bind_key__ = 'logs'
+            id: Mapped[int] = mapped_column(primary_key=True)
+            message: Mapped[str]
+
+        await db.create_all()
+        users = io.StringIO('id,name\n1,mary\n2,joe\n')
+        assert await db.load_data(users, model=User, format='csv') == {
+            'user': 2}
+        assert await db.load_data({
+            Post: [{'id': i, 'user_id': '1'} for i in range(3)],
+            Log: [{'id': i, 'message': 'log'} for i in range(4)],
+        }, parallel=True, workers=2) == {'log': 4, 'post': 3}
+        async with db.Session() as session:
+            assert (await session.get(User, 2)).name == 'joe'
+            assert (await session.get(Post, 2)).user_id == 1
+            assert (await session.get(Log, 3)).message == 'log'
+
+    @async_test
+    async def test_dump_restore(self):
+        tmpdir = tempfile.mkdtemp()
+        db = Alchemical(f'sqlite:///{tmpdir}/main.sqlite',
+                        binds={'logs': f'sqlite:///{tmpdir}/logs.sqlite'})
+
+        class User(db.Model):
+            id: Mapped[int] = mapped_column(primary_key=True)
+            name: Mapped[str]
+
+        class Post(db.Model):
+            id: Mapped[int] = mapped_column(primary_key=True)
+            user_id: Mapped[int] = mapped_column(ForeignKey('user.id'))
+
+        class Log(db.Model):
+            __bind_key__ = 'logs'
+            id: Mapped[int] = mapped_column(primary_key=True)
+
+        await db.create_all()
+        async with db.begin() as session:
+            session.add_all([User(id=i, name=f'user{i}') for i in range(10)] +
+                            [Post(id=1, user_id=3), Log(id=1)])
+        assert await db.dump(f'{tmpdir}/dump', batch_size=3) == {
+            'user': 10, 'post': 1, 'log': 1}
+        assert await db.dump(f'{tmpdir}/logs', binds=['logs'],
+                             consistent=False) == {'log': 1}
+
+        await db.drop_all()
+        await db.create_all()
+        assert await db.restore(f'{tmpdir}/dump', workers=1) == {
+            'user': 10, 'log': 1, 'post': 1}
+        async with db.Session() as session:
+            assert (await session.get(User, 9)).name == 'user9'
+            assert (await session.get(Post, 1)).user_id == 3
+
+    @async_test
+    async def test_copy_table(self):
+        tmpdir = tempfile.mkdtemp()
+        db = Alchemical(
+            f'sqlite:///{tmpdir}/main.sqlite',
+            binds={'archive': f'sqlite:///{tmpdir}/archive.sqlite'})
+
+        class User(db.Model):
+            id: Mapped[int] = mapped_column(primary_key=True)
+            name: Mapped[str]
+
+        class ArchivedUser(db.Model):
+            __bind_key__ = 'archive'
+            __tablename__ = 'user'
+            id: Mapped[int] = mapped_column(primary_key=True)
+            name: Mapped[str]
+
+        await db.create_all()
+        async with db.begin() as session:
+            session.add_all([User(id=i, name=f'user{i}')
+                             for i in range(1, 51)])
+        stats = []
+        assert await db.copy_table(User, None, 'archive', chunk_size=8,
+                                   partitions=2, progress=stats.append) == 50
+        assert stats[-1]['rows'] == 50
+        async with db.Session() as session:
+            assert (await session.get(ArchivedUser, 50)).name == 'user50'
+
+    @async_test
+    async def test_count(self):
+        db = Alchemical('sqlite://')
+
+        class User(db.Model):
+            id: Mapped[int] = mapped_column(primary_key=True)
+            name: Mapped[str]
+
+        await db.create_all()
+        async with db.begin() as session:
+            for name in ['mary', 'joe', 'susan']:
+                session.add(User(name=name))
+
+        async with db.Session() as session:
+            assert await User.count(session) == 3
+            assert await User.count(session, User.select().where(
+                User.name == 'joe'), estimate=True) == 1
+
+    @async_test
+    async def test_batch_lazy_loading(self):
+        db = Alchemical('sqlite://')
+
+        class User(db.Model):
+            id: Mapped[int] = mapped_column(primary_key=True)
+            name: Mapped[str]
+
+        class Post(AsyncAttrs, db.Model):
+            __lazy_loading__ = 'batch'
+            id: Mapped[int] = mapped_column(primary_key=True)
+            author_id: Mapped[int] = mapped_column(ForeignKey('user.id'))
+            author: Mapped[User] = relationship()
+
+        await db.create_all()
+        async with db.begin() as session:
+            users = [User(name=name) for name in ['mary', 'joe', 'susan']]
+            session.add_all(Post(author=user) for user in users)
+
+        async with db.Session() as session:
+            posts = (await session.scalars(Post.select())).all()
+            assert (await posts[0].awaitable_attrs.author).name == 'mary'
+            # the siblings were loaded in the same query
+            assert [post.author.name for post in posts] == [
+                'mary', 'joe', 'susan']
+
+    @async_test
+    async def test_fetch_lite(self):
+        db = Alchemical('sqlite://')
+
+        class User(db.Model):
+            id: Mapped[int] = mapped_column(primary_key=True)
+            name: Mapped[str]
+
+        await db.create_all()
+        async with db.begin() as session:
+            for name in ['mary', 'joe', 'susan']:
+                session.add(User(name=name))
+
+        async with db.Session() as session:
+            users = await User.fetch_lite(
+                session, User.select().order_by(User.name), format='dict')
+            assert users == [{'id': 2, 'name': 'joe'},
+                             {'id': 1, 'name': 'mary'},
+                             {'id': 3, 'name': 'susan'}]
+            assert len(session.sync_session.identity_map) == 0
+
+    @async_test
+    async def test_statement_timeout(self):
+        db = Alchemical('sqlite://')
+        slow = text('WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL '
+                    'SELECT x + 1 FROM c) SELECT count(*) FROM c')
+
+        with pytest.raises(StatementTimeout):
+            async with db.begin(timeout=0.05) as session:
+                await session.execute(slow)
+
+        async def app(scope, receive, send):
+            async with db.Session() as session:
+                await session.execute(slow)
+
+        middleware = TimeoutMiddleware(app, timeout=0.05)
+        with pytest.raises(StatementTimeout):
+            await middleware({'type': 'http'}, None, None)
+
+        async def lifespan_app(scope, receive, send):
+            async with db.Session() as session:
+                assert session.sync_session.deadline is None
+
+        await TimeoutMiddleware(lifespan_app, timeout=0.05)(
+            {'type': 'lifespan'}, None, None)
+
+    @async_test
+    async def test_server_timing(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        # the second URL uses the thread bridge
+        for url in ['sqlite://', f'sqlite+pysqlite:///{tmpdir.name}/db']:
+            db = Alchemical(url, timing=True)
+
+            async def app(scope, receive, send):
+                if scope['path'] == '/db':
+                    async with db.begin() as session:
+                        await session.execute(text('SELECT 1'))
+                await send({'type': 'http.response.start', 'status': 200,
+                            'headers': [(b'content-type', b'text/plain')]})
+                await send({'type': 'http.response.body', 'body': b''})
+
+            messages = []
+            timings = []
+
+            async def send(message):
+                messages.append(message)
+
+            middleware = ServerTimingMiddleware(
+                app, callback=lambda scope, timing: timings.append(timing))
+            await middleware({'type': 'http', 'path': '/db'}, None, send)
+            headers = dict(messages[0]['headers'])
+            assert headers[b'content-type'] == b'text/plain'
+            assert headers[b'server-timing'].startswith(b'db;dur=')
+            assert b'desc="1 statements"' in headers[b'server-timing']
+            assert timings[0].binds[None]['statements'] == 1
+            assert timings[0].binds[None]['commit'] > 0
+
+            await middleware({'type': 'http', 'path': '/'}, None, send)
+            assert b'server-timing' not in dict(messages[2]['headers'])
+            assert timings[1].binds == {}
+
+    @async_test
+    async def test_cancelled_cleanup(self):
+        db = Alchemical('sqlite://')
+        db.cleanup_timeout = 0.5
+
+        class User(db.Model):
+            id: Mapped[int] = mapped_column(primary_key=True)
+            name: Mapped[str]
+
+        await db.create_all()
+        rollback = AlchemicalAsyncSession.rollback
+        started = asyncio.Event()
+
+        async def slow_rollback(session):
+            started.set()
+            await asyncio.sleep(0.1)
+            await rollback(session)
+
+        async def add_user():
+            async with db.begin() as session:
+                session.add(User(name='susan'))
+                await session.flush()
+                await asyncio.sleep(10)
+
+        with mock.patch.object(AlchemicalAsyncSession, 'rollback',
+                               slow_rollback):
+            task = asyncio.ensure_future(add_user())
+            await asyncio.sleep(0.05)
+            task.cancel()  # cancel the transaction
+            await started.wait()
+            task.cancel()  # cancel the rollback
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            await asyncio.sleep(0.2)
+
+        assert db.cleanup_stats == {'cancelled': 1}
+        async with db.Session() as session:
+            all = (await session.execute(User.select())).scalars().all()
+        assert all == []
+
+    @async_test
+    async def test_cleanup_timeout(self):
+        db = Alchemical('sqlite://')
+        db.cleanup_timeout = 0.05
+
+        async def hung_rollback(session):
+            await asyncio.sleep(10)
+
+        with mock.patch.object(AlchemicalAsyncSession, 'rollback',
+                               hung_rollback):
+            with pytest.raises(RuntimeError):
+                async with db.begin() as session:
+                    await session.execute(text('select 1'))
+                    raise RuntimeError()
+        assert db.cleanup_stats == {'timed_out': 1, 'invalidated': 1}
+
+    @async_test
+    async def test_cancelled_commit(self):
+        db = Alchemical('sqlite://')
+
+        async def hung_commit(session):
+            await asyncio.sleep(10)
+
+        async def transaction():
+            async with db.begin() as session:
+                await session.execute(text('select 1'))
+
+        with mock.patch.object(AlchemicalAsyncSession, 'commit',
+                               hung_commit):
+            task = asyncio.ensure_future(transaction())
+            await asyncio.sleep(0.05)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+        assert db.cleanup_stats == {'invalidated': 1}
+
+    @async_test
+    async def test_thread_bridge(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db = Alchemical(f'sqlite+pysqlite:///{tmpdir}/test.sqlite',
+                            engine_options={'pool_size': 2,
+                                            'max_overflow': 1})
+
+            class User(db.Model):
+                id: Mapped[int] = mapped_column(primary_key=True)
+                name: Mapped[str]
+
+            await db.create_all()
+            assert db.bridge.size == 3
+            assert not hasattr(db.get_engine(), 'sync_engine')
+
+            async with db.begin() as session:
+                assert isinstance(session, BridgedAsyncSession)
+                for name in ['mary', 'joe', 'susan']:
+                    session.add(User(name=name))
+
+            async with db.Session() as session:
+                all = (await session.execute(User.select())).scalars().all()
+                assert len(all) == 3
+                user = await session.get(User, 2)
+                assert user.name == 'joe'
+                await session.delete(user)
+                await session.commit()
+                assert await session.scalar(
+                    User.select().where(User.id == 2)) is None
+                names = await User.fetch_lite(session, format='tuple')
+                assert names == [(1, 'mary'), (3, 'susan')]
+
+            async with db.Session() as session:
+                result = await session.stream(
+                    User.select().order_by(User.id),
+                    execution_options={'yield_per': 1})
+                assert [user.name async for user in result.scalars()] == \
+                    ['mary', 'susan']
+                result = await session.stream_scalars(select(User.name))
+                assert [names async for names in result.partitions(1)] == \
+                    [['mary'], ['susan']]
+                result = await session.stream(select(User.id))
+                assert (await result.fetchone()) == (1,)
+                assert (await result.all()) == [(3,)]
+                assert (await session.get_one(User, 3)).name == 'susan'
+
+            async with db.Session() as session:
+                user = await session.get(User, 1)
+                session.expire(user)
+                with pytest.raises(InvalidRequestError):
+                    user.name
+                assert await session.run_sync(lambda _: user.name) == 'mary'
+
+            if importlib.util.find_spec('numpy'):
+                batches = [batch['id'].tolist()
+                           async for batch in db.iter_columns(
+                               User.select(), batch_size=1)]
+                assert batches == [[1], [3]]
+
+            with pytest.raises(RuntimeError):
+                async with db.begin() as session:
+                    session.add(User(name='david'))
+                    await session.flush()
+                    raise RuntimeError()
+
+            async def count():
+                async with db.Session() as session:
+                    await asyncio.sleep(0.05)
+                    return len((await session.scalars(User.select())).all())
+
+            assert await asyncio.gather(*[count() for _ in range(6)]) == \
+                [2] * 6
+            assert db.bridge.idle.qsize() == 3
+            await db.drop_all()
+            db.get_engine().dispose()
+            db.bridge.shutdown()
+
+    @async_test
+    async def test_bridged_bind(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db = Alchemical(f'sqlite+aiosqlite:///{tmpdir}/app.sqlite', binds={
+                'sync': f'sqlite+pysqlite:///{tmpdir}/test.sqlite'})
+
+            class User(db.Model):
+                id: Mapped[int] = mapped_column(primary_key=True)
+                name: Mapped[str]
+
+            class Log(db.Model):
+                __bind_key__ = 'sync'
+                id: Mapped[int] = mapped_column(primary_key=True)
+                thread: Mapped[int]
+
+            engine = db.get_engine()
+            assert db._bridged
+            assert engine.dialect.driver == 'pysqlite'
+            for bind_engine in db.engines.values():
+                event.listen(bind_engine, 'connect',
+                             lambda conn, rec: conn.create_function(
+                                 'thread_id', 0, threading.get_ident))
+            await db.create_all()
+
+            async with db.begin() as session:
+                assert isinstance(session, BridgedAsyncSession)
+                session.add(User(name='susan'))
+                session.add_all([Log(thread=text('thread_id()')),
+                                 Log(thread=text('thread_id()'))])
+
+            async with db.Session() as session:
+                assert (await session.scalar(User.select())).name == 'susan'
+                log = await session.scalar(Log.select())
+                assert log.thread != threading.get_ident()
+                result = await session.execute(text('SELECT thread_id()'))
+                assert result.scalar() != threading.get_ident()
+
+            if importlib.util.find_spec('numpy'):
+                batches = [batch['id'].tolist()
+                           async for batch in db.iter_columns(
+                               Log.select(), batch_size=1)]
+                assert batches == [[1], [2]]
+
+            await db.drop_all()
+            for bind_engine in db.engines.values():
+                bind_engine.dispose()
+            db.bridge.shutdown()
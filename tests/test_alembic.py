@@ -1,8 +1,10 @@
+import json
 import os
 import re
 import shutil
 import sqlite3
 import subprocess
+import tempfile
 import unittest
 
 
@@ -115,6 +117,241 @@ class TestAlembic(unittest.TestCase):
             'CONSTRAINT pk_groups PRIMARY KEY (id))'
         ]
 
+    def test_advise_indexes(self):
+        run_cmd('python -m alchemical.alembic.cli init migrations')
+        configure_alembic('app1:db')
+        run_cmd('alembic revision --autogenerate -m "first revision"')
+        run_cmd('alembic upgrade head')
+
+        log_file = os.path.join(tempfile.mkdtemp(), 'statements.jsonl')
+        with open(log_file, 'wt') as f:
+            f.write('{"bind": null, "table": "user", "equality": ["name"], '
+                    '"count": 10, "duration": 1.5}\n')
+            f.write('{"bind": "groups", "table": "groups", '
+                    '"order_by": ["name"], "count": 1, "duration": 0.5}\n')
+            f.write('{"bind": null, "table": "user", "equality": ["id"], '
+                    '"count": 100, "duration": 0.1}\n')
+        output = subprocess.run(
+            'python -m alchemical.alembic.cli advise-indexes --revision '
+            f'-m "add indexes" {log_file}', shell=True, check=True,
+            capture_output=True, text=True).stdout
+        assert 'ix_user_name ON user (name)' in output
+        assert 'ix_groups_name ON groups (name) [groups]' in output
+        assert 'Generated revision' in output
+
+        run_cmd('alembic upgrade head')
+        conn = sqlite3.connect('users.sqlite')
+        assert conn.execute(
+            'SELECT name FROM sqlite_master WHERE name LIKE "ix_%"'
+        ).fetchall() == [('ix_user_name',)]
+        conn.close()
+        conn = sqlite3.connect('groups.sqlite')
+        assert conn.execute(
+            'SELECT name FROM sqlite_master WHERE name LIKE "ix_%"'
+        ).fetchall() == [('ix_groups_name',)]
+        conn.close()
+        run_cmd('alembic downgrade -1')
+        conn = sqlite3.connect('groups.sqlite')
+        assert conn.execute(
+            'SELECT name FROM sqlite_master WHERE name LIKE "ix_%"'
+        ).fetchall() == []
+        conn.close()
+
+    def test_non_transactional_ops(self):
+        run_cmd('python -m alchemical.alembic.cli init migrations')
+        configure_alembic('app1:db')
+        run_cmd('alembic revision --autogenerate -m "first revision"')
+        run_cmd('alembic upgrade head')
+        run_cmd('alembic revision --autogenerate -m "second revision"')
+        revision = [f for f in os.listdir('migrations/versions')
+                    if f.endswith('second_revision.py')][0]
+        with open(os.path.join('migrations/versions', revision), 'at') as f:
+            f.write("""
+from alchemical.alembic.ops import autocommit_block, \\
+    create_index_concurrently, drop_index_concurrently, non_transactional, \\
+    run_with_lock_timeout
+
+
+def upgrade_():
+    op.execute("INSERT INTO \\"user\\" (name) VALUES ('susan')")
+    with autocommit_block():
+        op.execute("INSERT INTO \\"user\\" (name) VALUES ('john')")
+    create_index_concurrently('ix_user_name', 'user', ['name'])
+    attempts = []
+
+    def add_column():
+        attempts.append(None)
+        if len(attempts) == 1:
+            raise sa.exc.OperationalError(
+                'ALTER TABLE', {}, Exception('database is locked'))
+        op.add_column('user', sa.Column('age', sa.Integer()))
+
+    run_with_lock_timeout(add_column, retries=1, backoff=0)
+
+
+@non_transactional
+def downgrade_():
+    drop_index_concurrently('ix_user_name', table_name='user')
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.drop_column('age')
+""")
+        run_cmd('alembic upgrade head')
+        conn = sqlite3.connect('users.sqlite')
+        assert conn.execute('SELECT name FROM user').fetchall() == [
+            ('susan',), ('john',)]
+        assert get_schema('users.sqlite') == [
+            'CREATE TABLE user '
+            '(id INTEGER NOT NULL, name VARCHAR(128), age INTEGER, '
+            'CONSTRAINT pk_user PRIMARY KEY (id))'
+        ]
+        assert conn.execute(
+            'SELECT name FROM sqlite_master WHERE name LIKE "ix_%"'
+        ).fetchall() == [('ix_user_name',)]
+        conn.close()
+
+        run_cmd('alembic downgrade -1')
+        conn = sqlite3.connect('users.sqlite')
+        assert conn.execute(
+            'SELECT name FROM sqlite_master WHERE name LIKE "ix_%"'
+        ).fetchall() == []
+        conn.close()
+
+    def test_timing_report(self):
+        run_cmd('python -m alchemical.alembic.cli init migrations')
+        configure_alembic('app1:db')
+        run_cmd('alembic revision --autogenerate -m "first revision"')
+        report_file = os.path.join(tempfile.mkdtemp(), 'report.json')
+
+        # dry run against copies of the databases
+        output = subprocess.run(
+            'python -m alchemical.alembic.cli --dry-run-timing '
+            f'--timing-report {report_file} upgrade head', shell=True,
+            check=True, capture_output=True, text=True).stdout
+        assert 'Statements' in output
+        assert '(dry run against scratch databases)' in output
+        assert get_schema('users.sqlite') == []
+        assert get_schema('groups.sqlite') == []
+        with open(report_file) as f:
+            report = json.load(f)
+        assert report['dry_run'] is True
+        assert [(step['bind'], step['description'], step['direction'])
+                for step in report['steps']] == [
+            (None, 'first revision', 'upgrade'),
+            ('groups', 'first revision', 'upgrade'),
+        ]
+        assert all(step['statements'] > 0 for step in report['steps'])
+        assert report['totals']['statements'] == sum(
+            step['statements'] for step in report['steps'])
+
+        # real run
+        output = subprocess.run(
+            'python -m alchemical.alembic.cli '
+            f'--timing-report {report_file} upgrade head', shell=True,
+            check=True, capture_output=True, text=True).stdout
+        assert 'first revision' in output
+        assert get_schema('users.sqlite') == [
+            'CREATE TABLE user '
+            '(id INTEGER NOT NULL, name VARCHAR(128), '
+            'CONSTRAINT pk_user PRIMARY KEY (id))'
+        ]
+        with open(report_file) as f:
+            assert json.load(f)['dry_run'] is False
+
+    def test_baseline(self):
+        run_cmd('python -m alchemical.alembic.cli init migrations')
+        configure_alembic('app1:db')
+        run_cmd('alembic revision --autogenerate -m "first revision"')
+        run_cmd('alembic upgrade head')
+        configure_alembic('app2:db')
+        run_cmd('alembic revision --autogenerate -m "second revision"')
+        head = subprocess.run('alembic heads', shell=True, check=True,
+                              capture_output=True, text=True).stdout.split()[0]
+        os.remove('users.sqlite')
+        os.remove('groups.sqlite')
+
+        # create the schema without running the migrations
+        run_cmd('python -m alchemical.alembic.cli baseline')
+        assert get_schema('users.sqlite') == [
+            'CREATE TABLE user '
+            '(id INTEGER NOT NULL, name VARCHAR(64), email VARCHAR(64), '
+            'CONSTRAINT pk_user PRIMARY KEY (id))'
+        ]
+        for db in ['users.sqlite', 'groups.sqlite']:
+            conn = sqlite3.connect(db)
+            assert conn.execute(
+                'SELECT version_num FROM alembic_version').fetchall() == [
+                    (head,)]
+            conn.close()
+        assert subprocess.run(
+            'python -m alchemical.alembic.cli baseline', shell=True,
+            capture_output=True).returncode != 0
+
+        # squash the revisions into a baseline revision
+        os.remove('users.sqlite')
+        os.remove('groups.sqlite')
+        output = subprocess.run(
+            'python -m alchemical.alembic.cli baseline --squash -m "squashed"',
+            shell=True, check=True, capture_output=True, text=True).stdout
+        assert 'Run again with --yes' in output
+        assert not os.path.exists('migrations/archive')
+        assert not os.path.exists('users.sqlite')
+        output = subprocess.run(
+            'python -m alchemical.alembic.cli baseline --squash '
+            '-m "squashed" --yes',
+            shell=True, check=True, capture_output=True, text=True).stdout
+        assert 'Moved 2 replaced revisions' in output
+        assert len(os.listdir('migrations/archive')) == 2
+        revisions = [f for f in os.listdir('migrations/versions')
+                     if f.endswith('.py')]
+        assert len(revisions) == 1 and revisions[0].endswith('squashed.py')
+        head = revisions[0].split('_')[0]
+        conn = sqlite3.connect('groups.sqlite')
+        assert conn.execute(
+            'SELECT version_num FROM alembic_version').fetchall() == [(head,)]
+        conn.close()
+
+        # the baseline revision can also create the schema
+        run_cmd('alembic downgrade base')
+        assert get_schema('users.sqlite') == []
+        run_cmd('alembic upgrade head')
+        assert get_schema('users.sqlite') == [
+            'CREATE TABLE user '
+            '(id INTEGER NOT NULL, name VARCHAR(64), email VARCHAR(64), '
+            'CONSTRAINT pk_user PRIMARY KEY (id))'
+        ]
+        assert get_schema('groups.sqlite') == [
+            'CREATE TABLE groups '
+            '(id INTEGER NOT NULL, name VARCHAR(64), '
+            'CONSTRAINT pk_groups PRIMARY KEY (id))'
+        ]
+
+    def test_copy_table(self):
+        run_cmd('python -m alchemical.alembic.cli init migrations')
+        configure_alembic('app1:db')
+        run_cmd('alembic revision --autogenerate -m "first revision"')
+        run_cmd('alembic upgrade head')
+        conn = sqlite3.connect('users.sqlite')
+        conn.executemany('INSERT INTO user (id, name) VALUES (?, ?)',
+                         [(i, f'user{i}') for i in range(1, 11)])
+        conn.commit()
+        conn.close()
+        copy_file = os.path.join(tempfile.mkdtemp(), 'copy.sqlite')
+        conn = sqlite3.connect(copy_file)
+        conn.execute('CREATE TABLE user (id INTEGER PRIMARY KEY, '
+                     'name VARCHAR(128))')
+        conn.close()
+
+        output = subprocess.run(
+            'python -m alchemical.alembic.cli copy-table user '
+            f'--to sqlite:///{copy_file} --chunk-size 4 --partitions 2',
+            shell=True, check=True, capture_output=True, text=True).stdout
+        assert 'rows/s' in output
+        assert 'Copied 10 rows' in output
+        conn = sqlite3.connect(copy_file)
+        assert conn.execute('SELECT count(*), sum(id) FROM user').fetchall() \
+            == [(10, 55)]
+        conn.close()
+
     def test_alembic_async(self):
         # create the migration repository
         run_cmd('python -m alchemical.alembic.cli init migrations')
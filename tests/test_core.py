@@ -1,18 +1,42 @@
+from datetime import date, datetime
+import enum
+import gzip
+import io
+import json
+import multiprocessing
+import os
 import sqlite3
+import sys
+import contextvars
+import tempfile
+import threading
+import time
 import unittest
+from typing import List, Optional
+from unittest import mock
 import pytest
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, JSON, String, event, func, select, \
+    text
+from sqlalchemy.exc import DBAPIError, IntegrityError, OperationalError
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import asyncpg as pg_asyncpg, \
+    psycopg as pg_psycopg
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.schema import CreateTable
 from sqlalchemy.orm import Mapped, mapped_column, relationship, \
     declarative_base, clear_mappers
 from alchemical import Alchemical
+from alchemical.core import check_pool, is_transient_error, Record, \
+    StatementTimeout, request_deadline, track_database_time, \
+    create_partitions, drop_partitions
 
 
 class TestCore(unittest.TestCase):
-    def create_alchemical(self, url=None, binds=None):
+    def create_alchemical(self, url=None, binds=None, **kwargs):
         if not binds:
-            db = Alchemical(url)
+            db = Alchemical(url, **kwargs)
         else:
-            db = Alchemical()
+            db = Alchemical(**kwargs)
             db.initialize(url, binds=binds)
         db.Model.metadata.clear()
         db.Model.__metadatas__.clear()
@@ -186,6 +210,231 @@ class TestCore(unittest.TestCase):
         assert db.engine_options == {'foo': 'baz'}
         assert db.session_options == {'baz': 'foo'}
 
+    def test_load_data(self):
+        tmpdir = tempfile.mkdtemp()
+        db = self.create_alchemical(
+            f'sqlite:///{tmpdir}/main.sqlite',
+            binds={'logs': f'sqlite:///{tmpdir}/logs.sqlite'})
+
+        class User(db.Model):
+            id: Mapped[int] = mapped_column(primary_key=True)
+            name: Mapped[str]
+            active: Mapped[bool]
+            joined: Mapped[Optional[datetime]]
+
+        class Post(db.Model):
+            id: Mapped[int] = mapped_column(primary_key=True)
+            user_id: Mapped[int] = mapped_column(ForeignKey('user.id'))
+            data: Mapped[dict] = mapped_column(JSON)
+
+        class Log(db.Model):
+            __bind_key__ = 'logs'
+            id: Mapped[int] = mapped_column(primary_key=True)
+            message: Mapped[str]
+            level: Mapped[str] = mapped_column(default='info')
+
+        db.create_all()
+        with open(os.path.join(tmpdir, 'users.csv'), 'wt') as f:
+            f.write('id,name,active,joined\n'
+                    '1,mary,true,2024-01-15T10:30:00\n'
+                    '2,joe,0,\n')
+        with gzip.open(os.path.join(tmpdir, 'posts.jsonl.gz'), 'wt') as f:
+            for i in range(5):
+                f.write(json.dumps({'id': i + 1, 'user_id': i % 2 + 1,
+                                    'data': {'n': i}}) + '\n')
+
+        assert db.load_data({
+            Post: os.path.join(tmpdir, 'posts.jsonl.gz'),
+            User: os.path.join(tmpdir, 'users.csv'),
+        }, batch_size=2) == {'user': 2, 'post': 5}
+        with db.Session() as session:
+            mary, joe = session.scalars(User.select().order_by(User.id))
+            assert (mary.active, mary.joined) == (
+                True, datetime(2024, 1, 15, 10, 30))
+            assert (joe.active, joe.joined) == (False, None)
+            assert session.get(Post, 5).data == {'n': 4}
+
+        assert db.load_data(
+            {Log: [{'id': i, 'message': f'log {i}'} for i in range(10)],
+             User: io.StringIO('{"id": 3, "name": "susan", "active": 1}\n')},
+            format='jsonl', parallel=True) == {'user': 1, 'log': 10}
+        with db.Session() as session:
+            assert session.get(User, 3).active is True
+            assert session.scalar(select(func.count()).select_from(
+                Log)) == 10
+
+        assert db.load_data([
+            {'id': 4, 'name': 'bob', 'active': True},
+            {'id': 5, 'name': 'al', 'active': False,
+             'joined': '2024-02-01T00:00:00'},
+        ], model=User) == {'user': 2}
+        assert db.load_data(io.StringIO(
+            '{"id": 6, "user_id": 1, "data": "text"}\n'
+            '{"id": 7, "user_id": 1, "data": ["text"]}\n'),
+            model=Post, format='jsonl') == {'post': 2}
+        with db.Session() as session:
+            assert session.get(User, 5).joined == datetime(2024, 2, 1)
+            assert session.get(Post, 6).data == 'text'
+            assert session.get(Post, 7).data == ['text']
+
+        # omitted keys get the default of their column
+        assert db.load_data([
+            {'id': 10, 'message': 'a'},
+            {'id': 11, 'message': 'b', 'level': 'error'},
+            {'message': 'c', 'id': 12},
+        ], model=Log) == {'log': 3}
+        with db.Session() as session:
+            assert session.scalars(select(Log.level).where(
+                Log.id >= 10).order_by(Log.id)).all() == [
+                    'info', 'error', 'info']
+
+        with pytest.raises(ValueError):
+            db.load_data([{'id': 4, 'nickname': 'bob'}], model=User)
+        with pytest.raises(ValueError):
+            db.load_data([{'id': 8, 'name': 'x', 'active': True},
+                          {'id': 9, 'nickname': 'bob'}], model=User)
+
+    def test_dump_restore(self):
+        tmpdir = tempfile.mkdtemp()
+        db = self.create_alchemical(
+            f'sqlite:///{tmpdir}/main.sqlite',
+            binds={'logs': f'sqlite:///{tmpdir}/logs.sqlite'})
+
+        class User(db.Model):
+            id: Mapped[int] = mapped_column(primary_key=True)
+            name: Mapped[str]
+            joined: Mapped[Optional[date]]
+            avatar: Mapped[Optional[bytes]]
+            data: Mapped[Optional[dict]] = mapped_column(JSON)
+
+        class Post(db.Model):
+            id: Mapped[int] = mapped_column(primary_key=True)
+            user_id: Mapped[int] = mapped_column(ForeignKey('user.id'))
+
+        class Log(db.Model):
+            __bind_key__ = 'logs'
+            id: Mapped[int] = mapped_column(primary_key=True)
+
+        db.create_all()
+        with db.begin() as session:
+            session.add_all([
+                User(id=1, name='mary', joined=date(2024, 1, 15),
+                     avatar=b'\x00\xff', data={'a': [1, 2]}),
+                User(id=2, name='joe', data='text'),
+                Post(id=1, user_id=2),
+            ])
+
+        dump_dir = os.path.join(tmpdir, 'dump')
+        assert db.dump(dump_dir, batch_size=1) == {
+            'user': 2, 'post': 1, 'log': 0}
+        with open(os.path.join(dump_dir, 'manifest.json')) as f:
+            manifest = json.load(f)
+        assert [(t['bind'], t['file'], t['rows'])
+                for t in manifest['tables']] == [
+            (None, 'user.jsonl.gz', 2), (None, 'post.jsonl.gz', 1),
+            ('logs', 'logs/log.jsonl.gz', 0)]
+        assert db.dump(os.path.join(tmpdir, 'csv'), tables=[User],
+                       format='csv', consistent=False) == {'user': 2}
+
+        db.drop_all()
+        db.create_all()
+        assert db.restore(dump_dir) == {'user': 2, 'log': 0, 'post': 1}
+        with db.Session() as session:
+            mary, joe = session.scalars(User.select().order_by(User.id))
+            assert (mary.joined, mary.avatar, mary.data) == (
+                date(2024, 1, 15), b'\x00\xff', {'a': [1, 2]})
+            assert (joe.joined, joe.avatar, joe.data) == (None, None, 'text')
+            assert session.get(Post, 1).user_id == 2
+
+        db.drop_all()
+        db.create_all()
+        assert db.restore(os.path.join(tmpdir, 'csv'),
+                          tables=['user']) == {'user': 2}
+        with db.Session() as session:
+            mary = session.get(User, 1)
+            assert (mary.joined, mary.avatar, mary.data) == (
+                date(2024, 1, 15), b'\x00\xff', {'a': [1, 2]})
+            assert session.get(User, 2).data == 'text'
+
+        with gzip.open(os.path.join(dump_dir, 'post.jsonl.gz'), 'wt') as f:
+            f.write('{"id": 2, "user_id": 1}\n')
+        with pytest.raises(ValueError):
+            db.restore(dump_dir, tables=[Post])
+
+    def test_copy_table(self):
+        tmpdir = tempfile.mkdtemp()
+        db = self.create_alchemical(
+            f'sqlite:///{tmpdir}/main.sqlite',
+            binds={'archive': f'sqlite:///{tmpdir}/archive.sqlite'})
+
+        class User(db.Model):
+            id: Mapped[int] = mapped_column(primary_key=True)
+            name: Mapped[str]
+            joined: Mapped[Optional[date]]
+
+        class ArchivedUser(db.Model):
+            __bind_key__ = 'archive'
+            __tablename__ = 'user'
+            id: Mapped[int] = mapped_column(primary_key=True)
+            name: Mapped[str]
+            joined: Mapped[Optional[date]]
+
+        db.create_all()
+        with db.begin() as session:
+            session.add_all([User(id=i, name=f'user{i}',
+                                  joined=date(2024, 1, i % 28 + 1))
+                             for i in range(1, 101)])
+
+        def count_archived():
+            with db.Session() as session:
+                return session.execute(select(
+                    func.count(), func.sum(ArchivedUser.id))).one()
+
+        stats = []
+        assert db.copy_table(User, None, 'archive', chunk_size=7,
+                             partitions=3, progress=stats.append) == 100
+        assert count_archived() == (100, 5050)
+        assert stats[-1]['rows'] == 100 and len(stats) >= 15
+        assert stats[-1]['rows_per_second'] > 0
+
+        with db.begin() as session:
+            session.execute(ArchivedUser.delete())
+        checkpoint = os.path.join(tmpdir, 'copy.json')
+
+        def interrupt(stats):
+            raise RuntimeError()
+
+        with pytest.raises(RuntimeError):
+            db.copy_table(User, None, 'archive', chunk_size=30,
+                          checkpoint=checkpoint, progress=interrupt)
+        with open(checkpoint) as f:
+            assert json.load(f)['partitions'][0]['last'] == [30]
+        with db.begin() as session:
+            # a chunk that was written without updating the checkpoint
+            session.add(ArchivedUser(id=31, name='user31'))
+        assert db.copy_table(
+            User.__table__, None, f'sqlite:///{tmpdir}/archive.sqlite',
+            chunk_size=30, checkpoint=checkpoint) == 70
+        assert count_archived() == (100, 5050)
+        assert not os.path.exists(checkpoint)
+        with db.Session() as session:
+            assert session.get(ArchivedUser, 31).joined == date(2024, 1, 4)
+
+        # more partitions than the connection pools can serve at once
+        small_db = Alchemical(
+            f'sqlite:///{tmpdir}/main.sqlite',
+            binds={'archive': f'sqlite:///{tmpdir}/archive.sqlite'},
+            engine_options={'pool_size': 1, 'max_overflow': 0,
+                            'pool_timeout': 0.01})
+        with small_db.get_engine('archive').begin() as conn:
+            conn.execute(ArchivedUser.__table__.delete())
+        assert small_db.copy_table(
+            User.__table__, None, 'archive', chunk_size=10, partitions=4,
+            progress=lambda stats: time.sleep(0.05)) == 100
+        assert count_archived() == (100, 5050)
+        for engine in small_db.engines.values():
+            engine.dispose()
+
     def test_reinitialize(self):
         db = self.create_alchemical('sqlite://')
 
@@ -204,15 +453,888 @@ class TestCore(unittest.TestCase):
             all = session.execute(User.select()).scalars().all()
         assert len(all) == 0
 
+    @unittest.skipIf(not hasattr(os, 'fork'), 'fork not available')
+    def test_fork(self):
+        db = self.create_alchemical('sqlite://')
+
+        class User(db.Model):
+            id: Mapped[int] = mapped_column(primary_key=True)
+            name: Mapped[str]
+
+        db.create_all()
+        session_class = db.Session
+        pool = db.get_engine().pool
+        conn = pool.connect()
+
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            ok = db.get_engine().pool is not pool and \
+                db.session_class is None and db.Session is not session_class
+            os._exit(0 if ok else 1)
+        _, status = os.waitpid(pid, 0)
+        assert os.WEXITSTATUS(status) == 0
+
+        # the parent's connection must still be usable after the fork
+        cur = conn.cursor()
+        cur.execute('select * from user;')
+        assert cur.fetchall() == []
+        conn.close()
+        assert db.get_engine().pool is pool
+
+    def test_check_pool(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db = self.create_alchemical(
+                f'sqlite:///{tmpdir}/test.sqlite',
+                engine_options={'poolclass': QueuePool, 'pool_size': 3})
+            engine = db.get_engine()
+            assert check_pool(engine, min_idle=2) == 0
+            assert engine.pool.checkedin() == 2
+
+            pings = [None, RuntimeError('dead')]
+            with mock.patch.object(engine.dialect, 'do_ping',
+                                   side_effect=pings) as do_ping:
+                assert check_pool(engine) == 1
+            assert do_ping.call_count == 2
+            assert engine.pool.checkedin() == 2
+
+            assert check_pool(engine, min_idle=5) == 0
+            assert engine.pool.checkedin() == 3
+
+            checked_out = []
+
+            def ping(dbapi_connection):
+                checked_out.append(engine.pool.checkedout())
+
+            with mock.patch.object(engine.dialect, 'do_ping',
+                                   side_effect=ping):
+                assert check_pool(engine) == 0
+                assert checked_out == [1, 1, 1]
+                assert check_pool(engine, max_checks=2) == 0
+                assert checked_out == [1, 1, 1, 1, 1]
+            assert engine.pool.checkedin() == 3
+            engine.dispose()
+
+            db = self.create_alchemical(
+                f'sqlite:///{tmpdir}/test.sqlite',
+                engine_options={'poolclass': QueuePool, 'pool_size': 3,
+                                'pool_use_lifo': True})
+            engine = db.get_engine()
+            assert check_pool(engine, min_idle=3) == 0
+            pinged = []
+            with mock.patch.object(engine.dialect, 'do_ping',
+                                   side_effect=pinged.append):
+                assert check_pool(engine) == 0
+            assert len(pinged) == 3
+            assert len({id(c) for c in pinged}) == 3
+            assert engine.pool.checkedin() == 3
+            engine.dispose()
+
+    def test_health_checker(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db = self.create_alchemical(
+                f'sqlite:///{tmpdir}/test.sqlite',
+                engine_options={'poolclass': QueuePool},
+                health_check_options={'interval': 0.01, 'min_idle': 2})
+            engine = db.get_engine()
+            checker = db.health_checkers[None]
+            for _ in range(100):
+                if engine.pool.checkedin() == 2:
+                    break
+                time.sleep(0.01)
+            assert engine.pool.checkedin() == 2
+
+            db.initialize(f'sqlite:///{tmpdir}/test.sqlite')
+            assert db.health_checkers == {}
+            checker.thread.join()
+            engine.dispose()
+
+    def test_pool_sizer(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db = self.create_alchemical(
+                f'sqlite:///{tmpdir}/test.sqlite',
+                engine_options={'poolclass': QueuePool, 'pool_size': 1},
+                pool_sizing_options={'min_size': 2, 'max_size': 8,
+                                     'interval': 3600})
+            engine = db.get_engine()
+            sizer = db.pool_sizers[None]
+            assert engine.pool.size() == 2
+
+            conns = [engine.connect() for _ in range(4)]
+            assert sizer.adjust() == 5
+            assert sizer.metrics['peak'] == 4
+            assert sizer.metrics['resizes'] == 1
+            old_pool = engine.pool
+            assert old_pool.size() == 5
+            for conn in conns:
+                conn.close()
+            assert engine.pool.checkedin() == 4
+            assert sizer.adjust() == 5  # connections were in use until now
+            assert [sizer.adjust() for _ in range(4)] == [4, 3, 2, 2]
+            # the pool is resized in place, closing the excess connections
+            assert engine.pool is old_pool
+            assert engine.pool.size() == 2
+            assert engine.pool.checkedin() == 2
+            assert engine.pool.checkedout() == 0
+            assert sizer.metrics == {'size': 2, 'min_size': 2, 'max_size': 8,
+                                     'peak': 0, 'max_wait': 0.0, 'waits': 0,
+                                     'resizes': 4}
+
+            sizer.target_wait = -1  # all checkouts are too slow
+            with engine.connect():
+                pass
+            assert sizer.adjust() == 3
+            assert engine.pool.checkedin() == 2  # idle connections are kept
+
+            db.initialize(f'sqlite:///{tmpdir}/test.sqlite')
+            assert db.pool_sizers == {}
+            sizer.thread.join()
+            assert 'raw_connection' not in engine.__dict__
+            assert not any(event.contains(*listener)
+                           for listener in sizer._listeners)
+            with engine.connect():
+                pass
+            # the checkout is not tracked anymore, so the pool does not grow
+            assert sizer.adjust() == 2
+            engine.dispose()
+
+        with pytest.raises(ValueError):
+            self.create_alchemical(
+                'sqlite://', pool_sizing_options={'max_size': 5}).get_engine()
+
+    def test_is_transient_error(self):
+        class PGError(Exception):
+            sqlstate = '40001'
+
+        class MySQLError(Exception):
+            pass
+
+        assert is_transient_error(OperationalError(
+            'x', {}, sqlite3.OperationalError('database is locked')))
+        assert is_transient_error(OperationalError('x', {}, PGError()))
+        assert is_transient_error(OperationalError(
+            'x', {}, MySQLError(1213, 'Deadlock found')))
+        assert is_transient_error(OperationalError(
+            'x', {}, Exception(), connection_invalidated=True))
+        assert not is_transient_error(IntegrityError(
+            'x', {}, sqlite3.IntegrityError('UNIQUE constraint failed')))
+        assert not is_transient_error(RuntimeError('database is locked'))
+
+    def test_transaction(self):
+        db = self.create_alchemical('sqlite://')
+
+        class User(db.Model):
+            id: Mapped[int] = mapped_column(primary_key=True)
+            name: Mapped[str]
+
+        db.create_all()
+        calls = []
+
+        def add_user(session):
+            calls.append(session)
+            session.add(User(name=f'user{len(calls)}'))
+            session.flush()
+            if len(calls) < 3:
+                raise OperationalError('x', {}, sqlite3.OperationalError(
+                    'database is locked'))
+            return len(calls)
+
+        assert db.transaction(add_user, backoff=0) == 3
+        with db.Session() as session:
+            names = session.scalars(User.select()).all()
+        assert [user.name for user in names] == ['user3']
+
+        calls.clear()
+        with pytest.raises(OperationalError):
+            db.transaction(add_user, retries=1, backoff=0)
+        assert len(calls) == 2
+
+        def fail(session):
+            calls.append(session)
+            raise IntegrityError('x', {}, sqlite3.IntegrityError('error'))
+
+        calls.clear()
+        with pytest.raises(IntegrityError):
+            db.transaction(fail, backoff=0)
+        assert len(calls) == 1
+
+        # a locked database during the commit is retried, a dropped
+        # connection is not, since the commit may have been applied
+        engine = db.get_engine()
+        commit_errors = [
+            sqlite3.OperationalError('database is locked'),
+            sqlite3.ProgrammingError('Cannot operate on a closed database.'),
+        ]
+
+        def do_commit(dbapi_connection):
+            if commit_errors:
+                raise commit_errors.pop(0)
+
+        def add_susan(session):
+            calls.append(session)
+            session.add(User(name='susan'))
+
+        calls.clear()
+        with mock.patch.object(engine.dialect, 'do_commit',
+                               side_effect=do_commit):
+            with pytest.raises(DBAPIError) as exc_info:
+                db.transaction(add_susan, retries=5, backoff=0)
+        assert exc_info.value.connection_invalidated
+        assert len(calls) == 2
+        assert commit_errors == []
+
+    def test_copy(self):
+        db = self.create_alchemical('sqlite://')
+
+        class User(db.Model):
+            id: Mapped[int] = mapped_column(primary_key=True)
+            name: Mapped[str]
+
+        db.create_all()
+
+        with db.begin() as session:
+            assert User.copy_from(session, [(1, 'mary'), (2, 'joe')]) == 2
+            assert User.copy_from(session, iter([{'name': 'susan'}]),
+                                  columns=['name'], batch_size=1) == 1
+            assert User.copy_from(session, []) == 0
+
+        with db.Session() as session:
+            names = [u.name for u in session.scalars(
+                User.select().order_by(User.id))]
+        assert names == ['mary', 'joe', 'susan']
+
+        output = io.BytesIO()
+        with db.Session() as session:
+            assert User.copy_to(session, output, batch_size=2) == 3
+        assert output.getvalue() == b'1,mary\n2,joe\n3,susan\n'
+
+        output = io.BytesIO()
+        with db.Session() as session:
+            assert User.copy_to(session, output, User.select().where(
+                User.name != 'joe').order_by(User.name.desc())) == 2
+        assert output.getvalue() == b'3,susan\n1,mary\n'
+
+    def test_copy_from_psycopg(self):
+        db = self.create_alchemical('sqlite://')
+
+        class Mood(enum.Enum):
+            happy = 1
+            sad = 2
+
+        class User(db.Model):
+            id: Mapped[int] = mapped_column(primary_key=True)
+            name: Mapped[str] = mapped_column(String(50))
+            created: Mapped[datetime]
+            mood: Mapped[Mood]
+
+        conn = mock.MagicMock()
+        conn.dialect = pg_psycopg.dialect()
+        session = mock.Mock(spec=['connection'])
+        session.connection.return_value = conn
+        cursor = conn.connection.driver_connection.cursor.return_value
+        copy = cursor.__enter__.return_value.copy.return_value.__enter__ \
+            .return_value
+        row = (1, 'mary', datetime(2024, 1, 15), Mood.sad)
+
+        assert User.copy_from(session, [row]) == 1
+        cursor.__enter__.return_value.copy.assert_called_with(
+            'COPY "user" (id, name, created, mood) FROM STDIN')
+        copy.set_types.assert_not_called()
+        copy.write_row.assert_called_with(
+            (1, 'mary', datetime(2024, 1, 15), 'sad'))
+
+        assert User.copy_from(session, [row], binary=True) == 1
+        cursor.__enter__.return_value.copy.assert_called_with(
+            'COPY "user" (id, name, created, mood) FROM STDIN '
+            '(FORMAT BINARY)')
+        copy.set_types.assert_called_with(
+            ['int4', 'varchar', 'timestamp', 'mood'])
+        copy.write_row.assert_called_with(row)
+
+    def test_copy_from_asyncpg(self):
+        db = self.create_alchemical('sqlite://')
+
+        class User(db.Model):
+            id: Mapped[int] = mapped_column(primary_key=True)
+            name: Mapped[str] = mapped_column(String(50))
+
+        # the rows copied outside of a transaction are committed right away
+        committed = []
+        pending = []
+        conn = mock.MagicMock()
+        conn.dialect = pg_asyncpg.dialect()
+        driver_connection = conn.connection.driver_connection
+        driver_connection.is_in_transaction.side_effect = \
+            lambda: conn.exec_driver_sql.called
+
+        def copy_records_to_table(name, records, schema_name, columns):
+            rows = list(records)
+            if driver_connection.is_in_transaction():
+                pending.extend(rows)
+            else:
+                committed.extend(rows)
+            return f'COPY {len(rows)}'
+
+        driver_connection.copy_records_to_table.side_effect = \
+            copy_records_to_table
+        session = mock.Mock(spec=['connection'])
+        session.connection.return_value = conn
+
+        with mock.patch('alchemical.core.await_only', lambda value: value):
+            assert User.copy_from(session, [(1, 'mary'), (2, 'joe')]) == 2
+            conn.exec_driver_sql.assert_called_once_with('SELECT 1')
+            assert User.copy_from(session, [(3, 'susan')]) == 1
+            conn.exec_driver_sql.assert_called_once_with('SELECT 1')
+        pending.clear()  # rollback
+        assert committed == []
+
+    def test_fetch_columns(self):
+        numpy = pytest.importorskip('numpy')
+        db = self.create_alchemical('sqlite://', binds={'one': 'sqlite://'})
+
+        class Group(db.Model):
+            id: Mapped[int] = mapped_column(primary_key=True)
+
+        class User(db.Model):
+            __bind_key__ = 'one'
+            id: Mapped[int] = mapped_column(primary_key=True)
+            name: Mapped[str]
+            created: Mapped[datetime]
+
+        db.create_all()
+        with db.begin() as session:
+            for i, name in enumerate(['mary', 'joe', 'susan']):
+                session.add(User(name=name, created=datetime(2024, 1, i + 1)))
+
+        columns = db.fetch_columns(User.select().order_by(User.id),
+                                   batch_size=2)
+        assert list(columns) == ['id', 'name', 'created']
+        assert isinstance(columns['id'], numpy.ndarray)
+        assert columns['id'].tolist() == [1, 2, 3]
+        assert columns['name'].tolist() == ['mary', 'joe', 'susan']
+        assert columns['created'][2] == datetime(2024, 1, 3)
+
+        batches = list(db.iter_columns(
+            select(User.name).where(User.id > 1), bind='one', batch_size=1))
+        assert [batch['name'].tolist() for batch in batches] == \
+            [['joe'], ['susan']]
+
+        columns = db.fetch_columns(select(User.name).where(User.id > 5))
+        assert columns['name'].tolist() == []
+        with pytest.raises(ValueError):
+            db.fetch_columns(User.select(), format='foo')
+
+    def test_fetch_columns_arrow(self):
+        pytest.importorskip('pyarrow')
+        db = self.create_alchemical('sqlite://')
+
+        class User(db.Model):
+            id: Mapped[int] = mapped_column(primary_key=True)
+            name: Mapped[str]
+
+        db.create_all()
+        with db.begin() as session:
+            for name in ['mary', 'joe', 'susan']:
+                session.add(User(name=name))
+
+        table = db.fetch_columns(User.select(), format='arrow', batch_size=2)
+        assert table.num_rows == 3
+        assert table.column_names == ['id', 'name']
+        assert table.column('name').to_pylist() == ['mary', 'joe', 'susan']
+        table = db.fetch_columns(User.select().where(User.id > 5),
+                                 format='arrow')
+        assert table.num_rows == 0
+
+    def test_get_many(self):
+        db = self.create_alchemical('sqlite://')
+
+        class User(db.Model):
+            id: Mapped[int] = mapped_column(primary_key=True)
+            name: Mapped[str]
+
+        class Membership(db.Model):
+            user_id: Mapped[int] = mapped_column(primary_key=True)
+            group_id: Mapped[int] = mapped_column(primary_key=True)
+
+        db.create_all()
+        with db.begin() as session:
+            for name in ['mary', 'joe', 'susan', 'david']:
+                session.add(User(name=name))
+            session.add_all([Membership(user_id=1, group_id=1),
+                             Membership(user_id=1, group_id=2)])
+
+        statements = []
+        event.listen(db.get_engine(), 'before_cursor_execute',
+                     lambda *args: statements.append(args[2]))
+        with db.Session() as session:
+            joe = session.get(User, 2)
+            statements.clear()
+            users = User.get_many(session, [3, 2, 99, 1, 3], chunk_size=2)
+            assert [u.name if u else None for u in users] == [
+                'susan', 'joe', None, 'mary', 'susan']
+            assert users[1] is joe
+            assert users[0] is users[4]
+            assert len(statements) == 2  # [3, 99] and [1]
+
+            statements.clear()
+            assert User.get_many(session, [1, 2, 3]) == [
+                users[3], users[1], users[0]]
+            assert statements == []
+
+            assert User.get_many(session, []) == []
+            memberships = Membership.get_many(session, [(1, 2), (2, 1)])
+            assert memberships[0].group_id == 2
+            assert memberships[1] is None
+
+    def test_count(self):
+        db = self.create_alchemical('sqlite://')
+
+        class User(db.Model):
+            id: Mapped[int] = mapped_column(primary_key=True)
+            name: Mapped[str]
+
+        db.create_all()
+        with db.begin() as session:
+            for name in ['mary', 'joe', 'susan']:
+                session.add(User(name=name))
+
+        statements = []
+        event.listen(db.get_engine(), 'before_cursor_execute',
+                     lambda *args: statements.append(args[2]))
+        with db.Session() as session:
+            assert User.count(session) == 3
+            assert User.count(session) == 3
+            assert len(statements) == 2
+            assert User.count(session, max_age=5) == 3
+            assert User.count(session, max_age=5) == 3
+            assert len(statements) == 3
+            query = User.select().where(User.name.like('%r%'))
+            assert User.count(session, query, max_age=5) == 1
+            assert len(statements) == 4
+
+            # writes invalidate the cached counts
+            session.add(User(name='david'))
+            session.flush()
+            assert User.count(session, max_age=5) == 4
+            assert User.count(session) == 4
+            assert len(statements) == 7
+            session.commit()
+
+        # so do writes issued with text statements and core connections
+        with db.Session() as session:
+            assert User.count(session, max_age=5) == 4
+        with db.get_engine().begin() as conn:
+            conn.execute(text("INSERT INTO user (name) VALUES ('ruth')"))
+        with db.Session() as session:
+            assert User.count(session, max_age=5) == 5
+            session.execute(text("DELETE FROM user WHERE name = 'ruth'"))
+            assert User.count(session, max_age=5) == 4
+
+            # estimates fall back to exact counts until there are statistics
+            assert User.count(session, estimate=True) == 4
+            session.commit()
+            session.execute(text('ANALYZE'))
+            session.add(User(name='robert'))
+            session.commit()
+            assert User.count(session, estimate=True) == 4
+            assert User.count(session) == 5
+            assert User.count(session, query, estimate=True) == 2
+
+    def test_partitioning(self):
+        db = self.create_alchemical('sqlite://')
+
+        class Event(db.Model):
+            __partition_by__ = ('range', 'created_at', 'month')
+            __table_args__ = ({'comment': 'events'},)
+            id: Mapped[int] = mapped_column(primary_key=True)
+            created_at: Mapped[datetime] = mapped_column(primary_key=True)
+
+        class Reading(db.Model):
+            __partition_by__ = ('range', 'sensor_id', 1000)
+            id: Mapped[int] = mapped_column(primary_key=True)
+            sensor_id: Mapped[int] = mapped_column(primary_key=True)
+
+        with pytest.raises(ValueError):
+            class Bad(db.Model):
+                __partition_by__ = ('range', 'id', 'hour')
+                id: Mapped[int] = mapped_column(primary_key=True)
+
+        ddl = str(CreateTable(Event.__table__).compile(
+            dialect=postgresql.dialect()))
+        # the primary key name depends on the naming convention of the base
+        ddl = ddl.replace('CONSTRAINT pk_event ', '')
+        assert ddl.replace('\n', '').replace('\t', '') == (
+            'CREATE TABLE event (id INTEGER NOT NULL, '
+            'created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL, '
+            'PRIMARY KEY (id, created_at)) PARTITION BY RANGE (created_at)')
+        assert Event.__table__.comment == 'events'
+
+        # other databases get regular tables
+        db.create_all()
+        with db.begin() as session:
+            session.add(Event(id=1, created_at=datetime(2024, 1, 15)))
+        assert db.maintain_partitions(retain=1) == {}
+
+        conn = mock.MagicMock()
+        conn.dialect = postgresql.dialect()
+        conn.execute.return_value = [
+            ('event_2023_11', "FOR VALUES FROM ('2023-11-01 00:00:00') "
+                              "TO ('2023-12-01 00:00:00')"),
+            ('event_2023_12', "FOR VALUES FROM ('2023-12-01 00:00:00') "
+                              "TO ('2024-01-01 00:00:00')"),
+            ('event_2024_01', "FOR VALUES FROM ('2024-01-01 00:00:00') "
+                              "TO ('2024-02-01 00:00:00')"),
+            ('event_default', 'DEFAULT'),
+        ]
+        assert create_partitions(conn, Event, ahead=2,
+                                 now=date(2024, 1, 15)) == \
+            ['event_2024_02', 'event_2024_03']
+        assert [c.args[0] for c in conn.exec_driver_sql.call_args_list] == [
+            'CREATE TABLE IF NOT EXISTS event_2024_02 PARTITION OF event '
+            "FOR VALUES FROM ('2024-02-01') TO ('2024-03-01')",
+            'CREATE TABLE IF NOT EXISTS event_2024_03 PARTITION OF event '
+            "FOR VALUES FROM ('2024-03-01') TO ('2024-04-01')",
+        ]
+        conn.exec_driver_sql.reset_mock()
+        assert drop_partitions(conn, Event, retain=1,
+                               now=date(2024, 1, 15)) == ['event_2023_11']
+        assert [c.args[0] for c in conn.exec_driver_sql.call_args_list] == [
+            'DROP TABLE event_2023_11']
+
+        conn.execute.return_value = []
+        conn.exec_driver_sql.reset_mock()
+        assert create_partitions(conn, Reading, ahead=1, now=2500) == \
+            ['reading_2000', 'reading_3000']
+        assert [c.args[0] for c in conn.exec_driver_sql.call_args_list] == [
+            'CREATE TABLE IF NOT EXISTS reading_2000 PARTITION OF reading '
+            'FOR VALUES FROM (2000) TO (3000)',
+            'CREATE TABLE IF NOT EXISTS reading_3000 PARTITION OF reading '
+            'FOR VALUES FROM (3000) TO (4000)',
+        ]
+
+        # partition names can be customized in the naming convention
+        naming_convention = Reading.metadata.naming_convention
+        Reading.metadata.naming_convention = dict(
+            naming_convention, partition='%(table_name)s_p%(partition_range)s')
+        conn.exec_driver_sql.reset_mock()
+        assert create_partitions(conn, Reading, ahead=0, now=2500) == \
+            ['reading_p2000']
+        Reading.metadata.naming_convention = naming_convention
+
+        # maintain_partitions runs the same statements on PostgreSQL binds
+        db.metadatas[None].remove(Reading.__table__)
+        conn.reset_mock()
+        conn.execute.return_value = [
+            ('event_2023_12', "FOR VALUES FROM ('2023-12-01 00:00:00') "
+                              "TO ('2024-01-01 00:00:00')"),
+        ]
+        engine = mock.MagicMock()
+        engine.dialect = conn.dialect
+        engine.begin.return_value.__enter__.return_value = conn
+        with mock.patch.object(db, 'get_engine', return_value=engine):
+            assert db.maintain_partitions(
+                ahead=0, retain=0, now=date(2024, 1, 15)) == {
+                    'event': {'created': ['event_2024_01'],
+                              'dropped': ['event_2023_12']}}
+        assert [c.args[0] for c in conn.exec_driver_sql.call_args_list] == [
+            'CREATE TABLE IF NOT EXISTS event_2024_01 PARTITION OF event '
+            "FOR VALUES FROM ('2024-01-01') TO ('2024-02-01')",
+            'DROP TABLE event_2023_12',
+        ]
+
+    def test_advise_indexes(self):
+        db = self.create_alchemical('sqlite://')
+
+        class User(db.Model):
+            id: Mapped[int] = mapped_column(primary_key=True)
+            name: Mapped[str] = mapped_column(index=True)
+            email: Mapped[str]
+            age: Mapped[int]
+
+        class Post(db.Model):
+            id: Mapped[int] = mapped_column(primary_key=True)
+            user_id: Mapped[int] = mapped_column(ForeignKey('user.id'))
+            title: Mapped[str]
+
+        db.create_all()
+        with db.begin() as session:
+            session.add(User(name='mary', email='m@example.com', age=30))
+
+        with db.capture_statements() as log:
+            with db.Session() as session:
+                for i in range(3):
+                    session.scalars(User.select().where(
+                        User.email == 'm@example.com', User.age > i)).all()
+                session.scalars(User.select().where(
+                    User.name == 'mary').order_by(User.age)).all()
+                session.scalars(Post.select().join(
+                    User, Post.user_id == User.id)).all()
+                session.get(User, 1)
+        with db.Session() as session:
+            session.scalars(User.select().where(User.age == 1)).all()
+
+        entries = list(log.entries.values())
+        assert {'bind': None, 'table': 'user', 'equality': ['email'],
+                'range': ['age'], 'join': [], 'order_by': [], 'count': 3,
+                'duration': entries[0]['duration']} in entries
+        path = os.path.join(tempfile.mkdtemp(), 'statements.jsonl')
+        log.save(path)
+
+        suggestions = db.advise_indexes(path)
+        assert [(s['table'], s['columns'], s['name'], s['count'])
+                for s in sorted(suggestions, key=lambda s: s['name'])] == [
+            ('post', ['user_id'], 'ix_post_user_id', 1),
+            ('user', ['email', 'age'], 'ix_user_email_age', 3),
+            ('user', ['name', 'age'], 'ix_user_name_age', 1),
+        ]
+        assert [s['columns'] for s in db.advise_indexes(
+            log, min_count=2)] == [['email', 'age']]
+
+    def test_batch_lazy_loading(self):
+        db = self.create_alchemical('sqlite://')
+
+        class User(db.Model):
+            __lazy_loading__ = 'batch'
+            id: Mapped[int] = mapped_column(primary_key=True)
+            name: Mapped[str]
+            manager_id: Mapped[Optional[int]] = mapped_column(
+                ForeignKey('user.id'))
+            manager: Mapped['User'] = relationship(
+                back_populates='reports', remote_side=[id])
+            reports: Mapped[List['User']] = relationship(
+                back_populates='manager')
+            posts: Mapped[List['Post']] = relationship(
+                back_populates='author', order_by='Post.id.desc()')
+
+        class Post(db.Model):
+            id: Mapped[int] = mapped_column(primary_key=True)
+            author_id: Mapped[int] = mapped_column(ForeignKey('user.id'))
+            author: Mapped[User] = relationship(
+                back_populates='posts', lazy='batch')
+
+        db.create_all()
+        with db.begin() as session:
+            boss = User(name='boss')
+            users = [User(name=name, manager=boss)
+                     for name in ['mary', 'joe', 'susan']]
+            session.add_all(Post(author=users[i % 3]) for i in range(6))
+
+        statements = []
+        event.listen(db.get_engine(), 'before_cursor_execute',
+                     lambda *args: statements.append(args[2]))
+        with db.Session() as session:
+            users = session.scalars(User.select().order_by(User.id)).all()
+            statements.clear()
+            assert [[post.id for post in user.posts] for user in users] == [
+                [], [4, 1], [5, 2], [6, 3]]
+            assert [user.manager.name if user.manager else None
+                    for user in users] == [None, 'boss', 'boss', 'boss']
+            assert [len(user.reports) for user in users] == [3, 0, 0, 0]
+            # managers are found in the identity map without a query
+            assert len(statements) == 2
+
+        with db.Session() as session:
+            posts = session.scalars(Post.select()).all()
+            statements.clear()
+            assert [post.author.name for post in posts] == [
+                'mary', 'joe', 'susan', 'mary', 'joe', 'susan']
+            assert len(statements) == 1
+
+        # without batch loading support relationships load one at a time
+        with mock.patch('alchemical.core._BATCH_LOADING', False):
+            with db.Session() as session:
+                posts = session.scalars(Post.select()).all()
+                statements.clear()
+                assert [post.author.name for post in posts] == [
+                    'mary', 'joe', 'susan', 'mary', 'joe', 'susan']
+                assert len(statements) == 3
+
+    def test_fetch_lite(self):
+        db = self.create_alchemical('sqlite://')
+
+        class User(db.Model):
+            id: Mapped[int] = mapped_column(primary_key=True)
+            username: Mapped[str] = mapped_column('name')
+
+        db.create_all()
+        with db.begin() as session:
+            for name in ['mary', 'joe', 'susan']:
+                session.add(User(username=name))
+
+        with db.Session() as session:
+            users = User.fetch_lite(session)
+            assert len(session.identity_map) == 0
+            assert isinstance(users[0], Record)
+            assert not hasattr(users[0], '__dict__')
+            assert users[0].id == 1
+            assert users[0].username == 'mary'
+            assert users[1]._asdict() == {'id': 2, 'username': 'joe'}
+            assert repr(users[2]) == "UserRecord(id=3, username='susan')"
+            assert User.fetch_lite(session)[0] == users[0]
+            assert type(User.fetch_lite(session)[0]) is type(users[0])
+
+            stmt = User.select().where(User.id > 1).order_by(User.username)
+            assert User.fetch_lite(session, stmt, format='dict') == [
+                {'id': 2, 'username': 'joe'}, {'id': 3, 'username': 'susan'}]
+            assert User.fetch_lite(session, stmt, format='tuple') == [
+                (2, 'joe'), (3, 'susan')]
+            names = User.fetch_lite(session, select(User.username))
+            assert [user.username for user in names] == \
+                ['mary', 'joe', 'susan']
+            assert len(session.identity_map) == 0
+            with pytest.raises(ValueError):
+                User.fetch_lite(session, format='foo')
+
+    def test_statement_timeout(self):
+        db = self.create_alchemical('sqlite://')
+        slow = text('WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL '
+                    'SELECT x + 1 FROM c) SELECT count(*) FROM c')
+        fast = text('WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL '
+                    'SELECT x + 1 FROM c WHERE x < 1000) SELECT count(*) '
+                    'FROM c')
+
+        with db.Session(statement_timeout=0.05) as session:
+            assert session.execute(fast).scalar() == 1000
+            with pytest.raises(StatementTimeout):
+                session.execute(slow)
+
+        with pytest.raises(StatementTimeout):
+            with db.begin(timeout=0.05) as session:
+                session.execute(slow)
+
+        # the timeout does not carry over to sessions that do not have one
+        with db.Session() as session:
+            assert session.get_statement_timeout() is None
+            assert session.execute(fast).scalar() == 1000
+
+        token = request_deadline.set(time.monotonic() + 0.05)
+        try:
+            with db.Session(statement_timeout=10) as session:
+                assert session.get_statement_timeout() <= 0.05
+                with pytest.raises(StatementTimeout):
+                    session.execute(slow)
+        finally:
+            request_deadline.reset(token)
+
+    def test_database_timing(self):
+        db = self.create_alchemical('sqlite://', binds={'logs': 'sqlite://'},
+                                    timing=True)
+
+        class Log(db.Model):
+            __bind_key__ = 'logs'
+            id: Mapped[int] = mapped_column(primary_key=True)
+
+        with db.Session() as session:
+            session.execute(text('SELECT 1'))  # not tracked
+
+        with track_database_time() as timing:
+            with db.begin() as session:
+                session.execute(text('SELECT 1'))
+                session.execute(text('SELECT 2'))
+            with db.get_engine('logs').connect() as conn:
+                conn.execute(text('SELECT 1'))
+
+        assert set(timing.binds) == {None, 'logs'}
+        assert timing.binds[None]['statements'] == 2
+        assert timing.binds[None]['commit'] > 0
+        assert timing.binds['logs']['statements'] == 1
+        assert timing.binds['logs']['commit'] == 0
+        # only the logs bind opened a new connection
+        assert timing.binds[None]['checkout'] == 0
+        assert timing.binds['logs']['checkout'] > 0
+        assert timing.total >= timing.binds[None]['time'] > 0
+        header = timing.server_timing()
+        assert header.startswith('db;dur=')
+        assert 'desc="2 statements"' in header
+        assert 'db.logs-checkout;dur=' in header
+        assert 'db-total;dur=' in header
+
+    def test_scoped_session(self):
+        db = self.create_alchemical('sqlite://')
+        Session = db.scoped_session()
+        assert db.scoped_session() is Session
+        session = Session()
+        assert Session() is session
+
+        other = []
+        thread = threading.Thread(target=lambda: other.append(Session()))
+        thread.start()
+        thread.join()
+        assert other[0] is not session
+        Session.remove()
+        assert Session() is not session
+        Session.remove()
+
+        ContextSession = db.scoped_session('context')
+        session = ContextSession()
+        assert ContextSession() is session
+        assert contextvars.copy_context().run(ContextSession) is not session
+        assert contextvars.Context().run(ContextSession) is not session
+        assert ContextSession() is session
+
+        other = []
+        context = contextvars.copy_context()
+        thread = threading.Thread(target=context.run, args=(
+            lambda: other.append(ContextSession()),))
+        thread.start()
+        thread.join()
+        assert other[0] is not session
+        assert context.run(ContextSession) is other[0]
+        assert ContextSession() is session
+        ContextSession.remove()
+
+        with pytest.raises(ValueError):
+            db.scoped_session('foo')
+
+    def test_thread_map(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db = self.create_alchemical(
+                f'sqlite:///{tmpdir}/test.sqlite',
+                engine_options={'pool_size': 2, 'max_overflow': 2})
+
+            class User(db.Model):
+                id: Mapped[int] = mapped_column(primary_key=True)
+                name: Mapped[str]
+
+            db.create_all()
+            names = [f'user{i}' for i in range(20)]
+            threads = set()
+
+            def add_user(session, name):
+                threads.add(threading.get_ident())
+                user = User(name=name)
+                session.add(user)
+                session.flush()
+                return user.id
+
+            ids = db.thread_map(add_user, names)
+            assert sorted(ids) == list(range(1, 21))
+            assert 1 <= len(threads) <= 4
+            assert db.get_engine().pool.checkedout() == 0
+
+            def rename(session, user_id):
+                user = session.get(User, user_id)
+                if user_id == 5:
+                    raise ValueError()
+                user.name = user.name.upper()
+
+            with db.Session() as session:
+                name = session.get(User, 5).name
+            with pytest.raises(ValueError):
+                db.thread_map(rename, ids, workers=6)
+            with db.Session() as session:
+                assert session.get(User, 5).name == name
+            assert db.get_engine().pool.checkedout() == 0
+            db.get_engine().dispose()
+
 
 class TestCoreWithCustomBase(TestCore):
-    def create_alchemical(self, url=None, binds=None):
+    def create_alchemical(self, url=None, binds=None, **kwargs):
         class CustomModel:
             def foo(self):
                 return 42
 
         Model = declarative_base(cls=CustomModel)
-        db = Alchemical(url, binds=binds, model_class=Model)
+        db = Alchemical(url, binds=binds, model_class=Model, **kwargs)
         db.Model.__metadatas__.clear()
         clear_mappers()
         return db
@@ -234,3 +1356,46 @@ class TestCoreWithCustomBase(TestCore):
         with db.Session() as session:
             user = session.scalar(User.select())
             assert user.foo() == 42
+
+
+@pytest.fixture
+def partition_db():
+    # the worker processes are started with the default method of the
+    # platform, so the function and the declarative base must be importable
+    sys.modules.pop('partitionapp', None)
+    import partitionapp
+    with tempfile.TemporaryDirectory() as tmpdir:
+        partitionapp.db.initialize(f'sqlite:///{tmpdir}/partitions.sqlite')
+        partitionapp.db.create_all()
+        try:
+            yield partitionapp
+        finally:
+            partitionapp.db.drop_all()
+            partitionapp.db.get_engine().dispose()
+            sys.modules.pop('partitionapp', None)
+
+
+def test_map_partitions(partition_db):
+    db, User = partition_db.db, partition_db.User
+    count_partition = partition_db.count_partition
+    assert db.map_partitions(User, count_partition) == []
+
+    with db.begin() as session:
+        for i in range(101):
+            session.add(User(name=f'user{i}'))
+
+    results = db.map_partitions(User, count_partition, workers=2,
+                                partitions=4)
+    assert [r[0] for r in results] == [
+        range(1, 27), range(27, 53), range(53, 79), range(79, 102)]
+    assert sum(r[1][0] for r in results) == 101
+    assert sum(r[1][1] for r in results) == sum(range(1, 102))
+
+    # spawned processes do not inherit the database instance
+    assert db.map_partitions(
+        User, count_partition, partitions=1,
+        mp_context=multiprocessing.get_context('spawn')) == [
+            (range(1, 102), (101, sum(range(1, 102))))]
+
+    with pytest.raises(ValueError):
+        db.map_partitions(User, count_partition, partition_by=User.name)
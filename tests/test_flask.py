@@ -1,9 +1,11 @@
 import sqlite3
+import time
 import unittest
 from flask import Flask
 import pytest
+from sqlalchemy import event, select, text
 from sqlalchemy.orm import Mapped, mapped_column, clear_mappers
-from alchemical.flask import Alchemical, Model
+from alchemical.flask import Alchemical, Model, StatementTimeout
 
 
 class TestFlask(unittest.TestCase):
@@ -180,6 +182,133 @@ class TestFlask(unittest.TestCase):
             all = session.execute(User.select()).scalars().all()
         assert len(all) == 3
 
+    def test_db_session_lifecycle(self):
+        db = Alchemical()
+
+        class User(db.Model):
+            id: Mapped[int] = mapped_column(primary_key=True)
+            name: Mapped[str]
+
+        app = Flask(__name__)
+        app.config['ALCHEMICAL_DATABASE_URL'] = 'sqlite://'
+        app.config['ALCHEMICAL_AUTOCOMMIT'] = True
+        db.init_app(app)
+
+        db.drop_all()
+        db.create_all()
+
+        commits = []
+        event.listen(db.get_engine(), 'commit', lambda conn: commits.append(1))
+        summaries = []
+        db.request_summary_handler(summaries.append)
+
+        with app.app_context():
+            pass
+        assert summaries == []
+
+        with app.app_context():
+            db.session.add(User(name='mary'))
+        assert len(commits) == 1
+        assert summaries[-1] == {'transactions': 1, 'statements': 0,
+                                 'writes': 0, 'flushes': 1,
+                                 'committed': True}
+
+        with app.app_context():
+            db.session.scalars(User.select()).all()
+        assert len(commits) == 1
+        assert summaries[-1] == {'transactions': 1, 'statements': 1,
+                                 'writes': 0, 'flushes': 0,
+                                 'committed': False}
+
+        with app.app_context():
+            db.session.execute(User.update().values(name='joe'))
+            db.session.commit()
+        assert len(commits) == 2
+        assert summaries[-1]['writes'] == 1
+        assert not summaries[-1]['committed']
+
+        with app.app_context():
+            db.session.get(User, 1).name = 'susan'
+        assert len(commits) == 3
+        assert summaries[-1]['committed']
+
+        with app.app_context():
+            db.session.connection().execute(text(
+                "INSERT INTO user (name) VALUES ('joe')"))
+        assert len(commits) == 4
+        assert summaries[-1]['committed']
+        with app.app_context():
+            User.copy_from(db.session, [('david',)], columns=['name'])
+        assert len(commits) == 5
+        with db.Session() as session:
+            assert session.scalars(select(User.name).order_by(
+                User.id)).all() == ['susan', 'joe', 'david']
+
+        with db.Session() as session:
+            assert session.get(User, 1).name == 'susan'
+
+    def test_server_timing(self):
+        db = Alchemical()
+
+        class User(db.Model):
+            id: Mapped[int] = mapped_column(primary_key=True)
+            name: Mapped[str]
+
+        app = Flask(__name__)
+        app.config['ALCHEMICAL_DATABASE_URL'] = 'sqlite://'
+        app.config['ALCHEMICAL_AUTOCOMMIT'] = True
+        app.config['ALCHEMICAL_SERVER_TIMING'] = True
+        db.init_app(app)
+        db.create_all()
+
+        summaries = []
+        db.request_summary_handler(summaries.append)
+
+        @app.route('/')
+        def index():
+            db.session.add(User(name='mary'))
+            db.session.flush()
+            return str(db.request_timing.binds[None]['statements'])
+
+        @app.route('/nodb')
+        def nodb():
+            return ''
+
+        client = app.test_client()
+        rv = client.get('/')
+        assert rv.data == b'1'
+        assert rv.headers['Server-Timing'].startswith('db;dur=')
+        assert 'desc="1 statements"' in rv.headers['Server-Timing']
+        timing = summaries[0]['timing']
+        assert timing.binds[None]['commit'] > 0
+
+        rv = client.get('/nodb')
+        assert 'Server-Timing' not in rv.headers
+
+        with app.app_context():
+            assert db.request_timing is None
+
+    def test_request_timeout(self):
+        db = Alchemical()
+        app = Flask(__name__)
+        app.config['ALCHEMICAL_DATABASE_URL'] = 'sqlite://'
+        app.config['ALCHEMICAL_REQUEST_TIMEOUT'] = 0.05
+        db.init_app(app)
+
+        with app.app_context():
+            with pytest.raises(StatementTimeout):
+                db.session.execute(text(
+                    'WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL '
+                    'SELECT x + 1 FROM c) SELECT count(*) FROM c'))
+
+        @app.route('/')
+        def index():
+            time.sleep(0.02)
+            return str(db.session.deadline - time.monotonic())
+
+        remaining = float(app.test_client().get('/').get_data(as_text=True))
+        assert remaining < 0.035
+
     def test_reinit(self):
         db = Alchemical()
 